@@ -0,0 +1,4 @@
+"""Offline benchmark suite for the strains apps.
+
+Run with `python -m benchmarks --help` from the repository root.
+"""
@@ -0,0 +1,336 @@
+"""In-memory stand-ins for the Google Sheets, Directory and SMTP backends.
+
+The fakes implement only the calls made by the strains apps:
+- gspread: authorize -> open -> worksheets -> get_all_records/get_all_values.
+- Directory API: build(...).members().list(groupKey=...).execute().
+- Drive API: build(...).files().get(fileId=...).execute() and files().list.
+- SMTP: the subset of smtplib.SMTP used by Flask-Mail.
+- Google OAuth: a local HTTP server (run_oauth_server) issuing signed ID
+    tokens, with token, JWKS and people/me endpoints.
+
+Use patch_google_sheets, patch_directory, patch_drive and patch_smtp (context
+managers) to swap them in for the real libraries.
+"""
+
+import json
+import time
+import base64
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+
+class FakeWorksheet(object):
+    def __init__(self, title, records=None, values=None):
+        self.title = title
+        self._records = records or []
+        self._values = values
+
+    def get_all_records(self):
+        return [dict(i) for i in self._records]
+
+    def get_all_values(self):
+        if self._values is not None:
+            return [list(i) for i in self._values]
+        if not self._records:
+            return []
+        headers = list(self._records[0])
+        return [headers] + [[i[h] for h in headers] for i in self._records]
+
+    def row_values(self, row):
+        return self.get_all_values()[row - 1]
+
+
+class FakeSpreadsheet(object):
+    def __init__(self, title, worksheets):
+        self.title = title
+        self._worksheets = list(worksheets)
+
+    def worksheets(self):
+        return list(self._worksheets)
+
+    def worksheet(self, title):
+        return [i for i in self._worksheets if i.title == title][0]
+
+
+class FakeGspreadClient(object):
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.n_opened = 0
+
+    def open(self, title):
+        self.n_opened += 1
+        return self.spreadsheet
+
+
+def make_spreadsheet(sheet_records, lab_emails=None):
+    """Build fake 'C-GEM strains list' spreadsheet.
+
+    Args:
+        sheet_records (dict): {lab: records}, e.g. from make_sheet_records.
+        lab_emails (dict): {lab: [email, ...]} for the 'Emails' worksheet.
+    """
+    if lab_emails is None:
+        lab_emails = {lab: ['{}@example.com'.format(lab.lower())]
+                      for lab in sheet_records}
+    email_rows = [['Lab', 'Email']]
+    for lab, emails in lab_emails.items():
+        email_rows.extend([[lab, email] for email in emails])
+    wsheets = [FakeWorksheet('Introduction', values=[['C-GEM strains']])]
+    wsheets += [FakeWorksheet(lab, records=records)
+                for lab, records in sheet_records.items()]
+    wsheets.append(FakeWorksheet('Emails', values=email_rows))
+    return FakeSpreadsheet('C-GEM strains list', wsheets)
+
+
+class FakeDirectoryService(object):
+    """Directory API service with members().list(groupKey).execute()."""
+
+    def __init__(self, members):
+        self._members = members
+
+    def members(self):
+        return self
+
+    def list(self, groupKey=None):
+        self._request = {'members': list(self._members)}
+        return self
+
+    def execute(self):
+        return self._request
+
+
+class FakeDriveService(object):
+    """Drive API service serving metadata of a single spreadsheet file.
+
+    Update metadata['version'] to simulate an edit of the spreadsheet.
+    """
+
+    def __init__(self, metadata=None):
+        self.metadata = metadata or {'id': 'strains-sheet-id', 'version': '1',
+                                     'modifiedTime': '2020-01-01T00:00:00.000Z'}
+        self.n_requests = 0
+
+    def files(self):
+        return self
+
+    def get(self, fileId=None, **kwargs):
+        self._response = dict(self.metadata)
+        return self
+
+    def list(self, q=None, **kwargs):
+        self._response = {'files': [dict(self.metadata)]}
+        return self
+
+    def execute(self):
+        self.n_requests += 1
+        return self._response
+
+
+class FakeCredentials(object):
+    def with_subject(self, subject):
+        return self
+
+
+def make_members(n_members=50):
+    """Get list of Directory API member resources."""
+    return [{'id': str(10 ** 20 + i), 'email': 'member{}@gem-net.net'.format(i)}
+            for i in range(n_members)]
+
+
+class FakeSMTP(object):
+    """Records messages instead of sending them. Shared across instances."""
+    sent = []
+
+    def __init__(self, host='', port=0, *args, **kwargs):
+        self.host = host
+        self.port = port
+
+    def set_debuglevel(self, level):
+        pass
+
+    def ehlo(self, *args):
+        pass
+
+    def starttls(self, *args, **kwargs):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, sender, recipients, msg, mail_options=(),
+                 rcpt_options=()):
+        FakeSMTP.sent.append((sender, recipients, msg))
+        return {}
+
+    def send_message(self, msg, *args, **kwargs):
+        FakeSMTP.sent.append((msg['From'], msg['To'], msg.as_string()))
+        return {}
+
+    def quit(self):
+        pass
+
+
+@contextmanager
+def patch_google_sheets(spreadsheet):
+    """Serve gspread calls from fake spreadsheet. Yields FakeGspreadClient."""
+    client = FakeGspreadClient(spreadsheet)
+    with mock.patch('oauth2client.service_account.ServiceAccountCredentials.'
+                    'from_json_keyfile_name', return_value=FakeCredentials()), \
+            mock.patch('gspread.authorize', return_value=client):
+        yield client
+
+
+@contextmanager
+def patch_directory(members):
+    """Serve Directory API group member lists from members list."""
+    service = FakeDirectoryService(members)
+    with mock.patch('google.oauth2.service_account.Credentials.'
+                    'from_service_account_file',
+                    return_value=FakeCredentials()), \
+            mock.patch('googleapiclient.discovery.build',
+                       return_value=service):
+        yield service
+
+
+@contextmanager
+def patch_drive(metadata=None):
+    """Serve Drive API file metadata requests. Yields FakeDriveService."""
+    service = FakeDriveService(metadata)
+    with mock.patch('google.oauth2.service_account.Credentials.'
+                    'from_service_account_file',
+                    return_value=FakeCredentials()), \
+            mock.patch('googleapiclient.discovery.build',
+                       return_value=service):
+        yield service
+
+
+@contextmanager
+def patch_smtp():
+    """Record outgoing mail in FakeSMTP.sent. Yields the list of messages."""
+    FakeSMTP.sent = []
+    with mock.patch('smtplib.SMTP', FakeSMTP), \
+            mock.patch('smtplib.SMTP_SSL', FakeSMTP):
+        yield FakeSMTP.sent
+
+
+def _b64encode(value):
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+class FakeOAuthServer(ThreadingHTTPServer):
+    """Local stand-in for Google's OAuth token, JWKS and people/me endpoints.
+
+    The authorization code is the index of the member signing in. Set
+    id_tokens to False to omit ID tokens, so that the profile API is used.
+    """
+    key_id = 'fake-key-1'
+    issuer = 'https://accounts.example.com'
+
+    def __init__(self, members, client_id):
+        import rsa
+        super(FakeOAuthServer, self).__init__(('127.0.0.1', 0),
+                                              FakeOAuthHandler)
+        self.members = members
+        self.client_id = client_id
+        self.id_tokens = True
+        self._tokens = {}  # {member id: ID token}, signed once
+        self.n_requests = Counter()  # {path: number of requests}
+        public_key, private_key = rsa.newkeys(2048)
+        self.private_pem = private_key.save_pkcs1()
+        self.jwks = {'keys': [{
+            'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': self.key_id,
+            'n': _b64encode(public_key.n.to_bytes(256, 'big')),
+            'e': _b64encode(public_key.e.to_bytes(3, 'big')),
+        }]}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def get_credentials(self):
+        """Get endpoint entries for app.config['OAUTH_CREDENTIALS']."""
+        return {'authorize_url': self.url + '/auth',
+                'access_token_url': self.url + '/token',
+                'base_url': self.url + '/v1/',
+                'certs_url': self.url + '/certs',
+                'issuer': self.issuer}
+
+    def make_id_token(self, member):
+        """Get ID token for member, valid for an hour. Cached per member."""
+        from google.auth import crypt, jwt
+        token = self._tokens.get(member['id'])
+        if token is not None:
+            return token
+        signer = crypt.RSASigner.from_string(self.private_pem, self.key_id)
+        now = int(time.time())
+        token = jwt.encode(signer, {
+            'iss': self.issuer, 'aud': self.client_id, 'iat': now,
+            'exp': now + 3600, 'sub': member['id'], 'email': member['email'],
+            'email_verified': True, 'name': member['email'].split('@')[0],
+        }).decode('ascii')
+        self._tokens[member['id']] = token
+        return token
+
+
+class FakeOAuthHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        from urllib.parse import parse_qs
+        server = self.server
+        server.n_requests[self.path] += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        member = server.members[int(form['code'][0])]
+        token = {'access_token': 'token-{}'.format(member['id']),
+                 'token_type': 'Bearer', 'expires_in': 3600}
+        if server.id_tokens:
+            token['id_token'] = server.make_id_token(member)
+        self.send_json(token)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        server.n_requests[path] += 1
+        if path == '/certs':
+            self.send_json(server.jwks,
+                           {'Cache-Control': 'public, max-age=3600'})
+        elif path == '/v1/people/me':
+            member_id = self.headers['Authorization'].split('token-')[-1]
+            member = [i for i in server.members if i['id'] == member_id][0]
+            meta = {'primary': True, 'source': {'id': member['id']}}
+            self.send_json({
+                'emailAddresses': [{'metadata': meta,
+                                    'value': member['email']}],
+                'names': [{'metadata': meta,
+                           'displayName': member['email'].split('@')[0]}],
+            })
+        else:
+            self.send_error(404)
+
+
+@contextmanager
+def run_oauth_server(members, client_id):
+    """Run FakeOAuthServer in a background thread. Yields the server."""
+    server = FakeOAuthServer(members, client_id)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
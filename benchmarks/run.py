@@ -0,0 +1,541 @@
+"""Time the strains data, Bokeh and Flask code paths on synthetic data.
+
+All Google and mail traffic is served by the fakes in benchmarks.fakes, so the
+suite runs offline. Results are written as JSON for regression comparison:
+
+    python -m benchmarks --rows 20000 --output bench.json
+    python -m benchmarks --rows 20000 --baseline bench.json
+
+The environment (SNAPSHOT_DIR, database URL etc.) is pointed at a temporary
+directory before the app modules are imported, so nothing outside it is read
+or written.
+"""
+
+import argparse
+import datetime as dt
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+SUITES = ['data', 'bokeh', 'flask', 'startup']
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timeit(func, repeat=5, number=1):
+    """Time func, returning per-call summary statistics in seconds."""
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            times.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return OrderedDict([
+        ('repeat', repeat),
+        ('number', number),
+        ('min', min(times)),
+        ('median', statistics.median(times)),
+        ('mean', statistics.mean(times)),
+    ])
+
+
+def configure_env(workdir, env=None):
+    """Write benchmark env file in workdir and point the apps at it."""
+    settings = OrderedDict([
+        ('FLASK_ENV', 'development'),
+        ('FEATHER_PATH', os.path.join(workdir, 'df.feather')),
+        ('SNAPSHOT_DIR', os.path.join(workdir, 'snapshots')),
+        ('CREDS_JSON', os.path.join(workdir, 'creds.json')),
+        ('SERVICE_USER', 'service@gem-net.net'),
+        ('GROUP_KEY', 'bench'),
+        ('APP_URL', 'http://localhost:5101/bk_server'),
+        ('DATABASE_URL_DEV', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite')),
+        ('SQLALCHEMY_ECHO', 'False'),
+        ('MAIL_SERVER', 'localhost'),
+        ('MAIL_SENDER', 'donotreply@example.com'),
+    ])
+    if env:
+        settings.update(env)
+    env_path = os.path.join(workdir, '.env.bench')
+    with open(env_path, 'w') as f:
+        for key, val in settings.items():
+            f.write('{}={}\n'.format(key, val))
+    os.environ.update(settings)
+    os.environ['ENV_NAME'] = env_path
+    return settings
+
+
+def _top_bars(source_c, categs):
+    """Get indices of the largest non-'All' bar in each of categs."""
+    inds = []
+    data = source_c.data
+    for categ in categs:
+        best = None
+        for ind, (c, val) in enumerate(data['categ_val']):
+            if c != categ or val == 'All':
+                continue
+            if best is None or data['n'][ind] > data['n'][best]:
+                best = ind
+        if best is not None:
+            inds.append(best)
+    return inds
+
+
+def bench_data(params, repeat):
+    import numpy as np
+    from bk_server import data, filters, snapshot, refresh, export, ingest, \
+        similar
+    from benchmarks import synthetic, fakes
+
+    results = OrderedDict()
+    df = synthetic.make_strains(**params)
+    data.save_snapshot(df)
+    spreadsheet = fakes.make_spreadsheet(synthetic.make_sheet_records(df))
+
+    results['load_df'] = timeit(data.load_df, repeat)
+    # memory of snapshot: mapped files, and dataframe held by each process
+    for kind, n_bytes in snapshot.last_memory.items():
+        results['snapshot_{}_mb'.format(kind)] = OrderedDict([
+            ('repeat', 1), ('number', 1), ('min', n_bytes / 1e6)])
+    wsheet = spreadsheet.worksheets()[1]  # first lab worksheet
+    n_edits = [0]
+
+    def edit_one_lab():
+        n_edits[0] += 1
+        wsheet._records[0] = dict(wsheet._records[0],
+                                  Description='edit {}'.format(n_edits[0]))
+
+    def remove_manifest():
+        os.remove(os.path.join(data.SNAPSHOT_DIR, snapshot.MANIFEST_NAME))
+
+    with fakes.patch_google_sheets(spreadsheet):
+        # unchanged worksheets: no partition or manifest written
+        results['load_df_gsheet'] = timeit(
+            lambda: data.load_df(load_gsheet=True), repeat)
+        results['refresh_one_lab'] = timeit(
+            lambda: edit_one_lab() or data.refresh_snapshot(), repeat)
+        results['refresh_all_labs'] = timeit(
+            lambda: remove_manifest() or data.refresh_snapshot(), repeat)
+        for stage, seconds in ingest.last_timings.items():
+            if stage != 'workers':
+                results['refresh_all_labs.' + stage] = OrderedDict([
+                    ('repeat', 1), ('number', 1), ('min', seconds)])
+        # same, with labs built in a pool of worker processes
+        min_rows, workers = ingest.INGEST_MIN_ROWS, ingest.INGEST_WORKERS
+        ingest.INGEST_MIN_ROWS, ingest.INGEST_WORKERS = 0, max(2, workers)
+        remove_manifest()
+        data.refresh_snapshot()  # starts pool
+        results['refresh_all_labs_pool'] = timeit(
+            lambda: remove_manifest() or data.refresh_snapshot(), repeat)
+        ingest.INGEST_MIN_ROWS, ingest.INGEST_WORKERS = min_rows, workers
+        ingest.shutdown_pool()
+        with fakes.patch_drive() as drive:
+            refresh.refresh()
+            # spreadsheet metadata unchanged: worksheets not fetched
+            results['refresh_check_unchanged'] = timeit(
+                refresh.refresh, repeat)
+
+            def edit_metadata():
+                version = int(drive.metadata['version']) + 1
+                drive.metadata['version'] = str(version)
+            results['refresh_check_changed'] = timeit(
+                lambda: edit_metadata() or refresh.refresh(), repeat)
+    results['load_df_uncached'] = timeit(
+        lambda: snapshot._loaded.clear() or data.load_df(), repeat)
+    df = data.load_df()
+    counts = data.counts_from_strains(df)
+    pairs_df = counts[['categ', 'val']]
+    results['counts_from_strains'] = timeit(
+        lambda: data.counts_from_strains(df), repeat)
+    results['counts_from_strains_pairs'] = timeit(
+        lambda: data.counts_from_strains(df, pairs_df=pairs_df), repeat)
+
+    codes = filters.encode_strains(df, data.PLOT_COLS)
+    half = np.arange(0, len(df), 2)
+    results['counts_from_codes'] = timeit(
+        lambda: data.counts_from_codes(codes, half, pairs_df), repeat)
+    results['encode_strains'] = timeit(
+        lambda: filters.encode_strains(df, data.PLOT_COLS), repeat)
+
+    # a fifth of organism, marker and origin cells spelled differently,
+    # mapped back by a vocabulary of the synthetic values
+    variant_df = synthetic.make_strains(**dict(params, variant_ratio=0.2))
+    vocabulary = synthetic.make_vocabulary(df)
+    results['normalise_values'] = timeit(
+        lambda: vocabulary.normalise(variant_df), repeat)
+    for name, categs in [('single', ['lab']),
+                         ('multi', ['lab', 'marker1', 'origin'])]:
+        selection = OrderedDict(
+            (categ, set(df[categ].value_counts().index[:2]))
+            for categ in categs)
+        results['filter_mask_' + name] = timeit(
+            lambda: filters.filter_mask(codes, include=selection), repeat)
+        results['filter_mask_exclude_' + name] = timeit(
+            lambda: filters.filter_mask(codes, exclude=selection), repeat)
+        results['filter_strains_' + name] = timeit(
+            lambda: filters.filter_strains(df, codes, include=selection),
+            repeat)
+
+    # similar-strain index: build, and top-k lookups of catalogue strains
+    index = similar.SimilarityIndex(df)
+    results['similar_index_build'] = timeit(
+        lambda: similar.SimilarityIndex(df), repeat)
+    queries = df.sample(n=min(100, len(df)), random_state=0).to_dict(
+        orient='records')
+    next_query = iter(queries * repeat).__next__
+    results['similar_query'] = timeit(
+        lambda: index.similar(next_query()), repeat, number=len(queries))
+
+    # streamed export of full catalogue, and of a filtered view
+    query = 'lab={}'.format(df['lab'].value_counts().index[0])
+    for fmt in export.FORMATS:
+        results['export_' + fmt] = timeit(
+            lambda: sum(len(i) for i in export.iter_export(fmt)), repeat)
+        results['export_{}_filtered'.format(fmt)] = timeit(
+            lambda: sum(len(i) for i in export.iter_export(fmt, query)),
+            repeat)
+    return results
+
+
+def bench_bokeh(params, repeat):
+    import importlib
+    import runpy
+    from bokeh.document import Document
+    from bokeh.io.doc import curdoc, set_curdoc
+    from bk_server import data
+    from benchmarks import synthetic
+
+    results = OrderedDict()
+    data.save_snapshot(synthetic.make_strains(**params))
+
+    start = time.perf_counter()
+    main = importlib.import_module('bk_server.main')
+    doc = curdoc()
+    results['document_build'] = OrderedDict([
+        ('repeat', 1), ('number', 1),
+        ('min', time.perf_counter() - start)])
+
+    def build_session():
+        # bokeh serve re-runs main.py in a fresh module for each session
+        set_curdoc(Document())
+        runpy.run_module('bk_server.main', run_name='bk_session')
+    results['session_build'] = timeit(build_session, repeat)
+    set_curdoc(doc)
+
+    selections = OrderedDict([
+        ('plot_select_none', []),
+        ('plot_select_single', _top_bars(main.source_c, [data.LAB_COL])),
+        ('plot_select_multi', _top_bars(main.source_c, ['lab', 'marker1'])),
+    ])
+    def plot_select_uncached():
+        main.RESULT_CACHE.clear()
+        main.plot_select(main.data_dict)
+
+    for name, inds in selections.items():
+        main.source_c.selected.indices = inds  # fires plot_select once
+        results[name] = timeit(plot_select_uncached, repeat)
+        results[name + '_cached'] = timeit(
+            lambda: main.plot_select(main.data_dict), repeat)
+    main.search_input.value = 'gfp'
+    results['plot_select_search'] = timeit(plot_select_uncached, repeat)
+    main.search_input.value = ''
+    main.source_c.selected.indices = []
+    results['update_sources'] = timeit(
+        lambda: main.update_sources(main.data_dict), repeat)
+    results['update_sources_orig'] = timeit(
+        lambda: main.update_sources(main.data_dict, update_orig=True), repeat)
+    return results
+
+
+def populate_db(db, df, n_users=50, n_requests=500, n_comments=2, seed=0):
+    """Fill database with users, strains, requests and comments."""
+    import random
+    from oauth.models import User, Strain, Request, Comment
+    from oauth.events import log_event
+    from benchmarks.fakes import make_members
+
+    rnd = random.Random(seed)
+    members = make_members(n_users)
+    users = [User(social_id=i['id'], display_name=i['email'].split('@')[0],
+                  email=i['email']) for i in members]
+    db.session.add_all(users)
+    sample = df.sample(n=min(n_requests, len(df)), random_state=seed)
+    strains = [Strain(**row) for row in sample.to_dict(orient='records')]
+    db.session.add_all(strains)
+    statuses = ['unassigned', 'processing', 'shipped', 'received']
+    for ind in range(n_requests):
+        rq = Request(requester=users[ind % 2 and rnd.randrange(n_users)],
+                     strain=strains[ind % len(strains)],
+                     status=rnd.choice(statuses),
+                     delivery_address='{} Science Hill'.format(ind),
+                     preferred_email=users[0].email)
+        log_event(rq, 'created', user=rq.requester)
+        if rq.status != 'unassigned':
+            rq.shipper = users[(ind + 1) % 2 and rnd.randrange(n_users)]
+            log_event(rq, 'status', user=rq.shipper, value=rq.status)
+        db.session.add(rq)
+        for _ in range(n_comments):
+            db.session.add(Comment(request=rq, commenter=rnd.choice(users),
+                                   content='Comment on request {}'.format(ind)))
+            log_event(rq, 'comment', user=rq.requester)
+    db.session.commit()
+    return members
+
+
+def bench_flask(params, repeat, n_requests=500):
+    from benchmarks import synthetic, fakes
+
+    from bk_server import data, similar
+
+    results = OrderedDict()
+    df = synthetic.make_strains(**params)
+    spreadsheet = fakes.make_spreadsheet(synthetic.make_sheet_records(df))
+    data.save_snapshot(df)
+
+    from oauth import app, db
+    from oauth.admin import get_requests_df
+    from oauth.models import Request
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        members = populate_db(db, df, n_requests=n_requests)
+
+        def query_requests_df():
+            db.session.remove()
+            rqs = Request.query.order_by(Request.creation_time.desc()).all()
+            return get_requests_df(rqs)
+        results['get_requests_df'] = timeit(query_requests_df, repeat)
+
+    with fakes.patch_google_sheets(spreadsheet), \
+            fakes.patch_directory(members), fakes.patch_smtp():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = '1'
+            sess['_fresh'] = True
+        client.get('/requests')  # triggers before_first_request loaders
+        similar.get_index(wait=True)  # started by first request
+        for route in ['/requests', '/my-requests', '/my-shipments',
+                      '/request/1']:
+            def get(route=route):
+                response = client.get(route)
+                assert response.status_code == 200, (route, response.status)
+            results['GET ' + route] = timeit(get, repeat)
+
+            # repeat visit: unchanged page revalidated by ETag
+            etag = client.get(route).headers['ETag']
+
+            def get_unchanged(route=route, etag=etag):
+                response = client.get(route, headers={'If-None-Match': etag})
+                assert response.status_code == 304, (route, response.status)
+            results['GET {} (304)'.format(route)] = timeit(get_unchanged,
+                                                           repeat)
+
+        def export_csv():
+            response = client.get('/export/csv')
+            assert response.status_code == 200, response.status
+            return sum(len(i) for i in response.response)
+        results['GET /export/csv'] = timeit(export_csv, repeat)
+
+        strain = df.iloc[0]
+
+        def get_similar():
+            response = client.get('/strains/similar?lab={}&entry={}'.format(
+                strain['lab'], strain['entry']))
+            assert response.status_code == 200, response.status
+        results['GET /strains/similar'] = timeit(get_similar, repeat)
+
+        # basket of 20 strains, some not yet in database, in one request
+        basket = json.dumps(df.sample(n=min(20, len(df)), random_state=1)
+                            .replace('<blank>', '').to_dict(orient='records'))
+
+        def post_basket():
+            response = client.post('/request', data={
+                'strains': basket, 'email': 'lab@example.com',
+                'address': '1 Science Hill', 'submit': 'Submit'})
+            assert response.status_code == 302, response.status
+        results['POST /request (20 strains)'] = timeit(post_basket, repeat)
+
+        # bulk status update of 10 of the user's shipments
+        with app.app_context():
+            shipment_ids = [i.id for i in Request.query.filter_by(
+                shipper_id=1).limit(10)]
+
+        def post_bulk_status():
+            response = client.post('/my-shipments', data={
+                'request_ids': shipment_ids, 'status': 'shipped',
+                'shipper_id': '0', 'submit': 'Update selected'})
+            assert response.status_code == 302, response.status
+        if shipment_ids:
+            results['POST /my-shipments (10 requests)'] = timeit(
+                post_bulk_status, repeat)
+
+        # request feed: unchanged (answered from memory, without waiting)
+        # and changed since first version
+        from oauth import feed
+        feed.POLL_TIMEOUT = 0
+        version = client.get('/request/1/updates').get_json()['version']
+        for name, since, status in [('unchanged', version, 204),
+                                    ('changed', 0, 200)]:
+            def poll(since=since, status=status):
+                response = client.get(
+                    '/request/1/updates?since={}'.format(since))
+                assert response.status_code == status, response.status
+            results['GET /request/1/updates ({})'.format(name)] = timeit(
+                poll, repeat)
+
+        def get_stats():
+            response = client.get('/request-stats')
+            assert response.status_code == 200, response.status
+        results['GET /request-stats'] = timeit(get_stats, repeat)
+
+        # request list read from a replica (the same sqlite file here)
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': app.config['SQLALCHEMY_DATABASE_URI']}
+        with client.session_transaction() as sess:
+            sess.pop('db_primary_until', None)  # after earlier POSTs
+
+        def get_replica():
+            response = client.get('/requests')
+            assert response.status_code == 200, response.status
+        results['GET /requests (replica)'] = timeit(get_replica, repeat)
+        app.config['SQLALCHEMY_BINDS'] = None
+
+        # sign-in via local OAuth stand-in: ID token verified locally, and
+        # fallback to profile API when there is no ID token
+        from oauth import OAuthSignIn
+        google = app.config['OAUTH_CREDENTIALS']['google']
+        google['id'] = google['id'] or 'bench-client-id'
+        with fakes.run_oauth_server(members, google['id']) as server:
+            google.update(server.get_credentials())
+            OAuthSignIn.load_providers(app.config)
+            for name, id_tokens in [('id_token', True), ('profile', False)]:
+                def sign_in(id_tokens=id_tokens):
+                    server.id_tokens = id_tokens
+                    response = app.test_client().get('/callback/google?code=1')
+                    assert response.status_code == 302, response.status
+                results['GET /callback/google ({})'.format(name)] = timeit(
+                    sign_in, repeat)
+    return results
+
+
+def _time_subprocess(code, repeat):
+    """Time a fresh python process running code, from the source root."""
+    cmd = [sys.executable, '-W', 'ignore', '-c', code]
+    return timeit(lambda: subprocess.run(cmd, cwd=ROOT_DIR, check=True,
+                                         stdout=subprocess.DEVNULL),
+                  repeat)
+
+
+def bench_startup(params, repeat):
+    """Time process start: bare interpreter, app imports and first session."""
+    from bk_server import data
+    from benchmarks import synthetic
+
+    results = OrderedDict()
+    if data.get_data_version() is None:
+        data.save_snapshot(synthetic.make_strains(**params))
+    results['python'] = _time_subprocess('pass', repeat)
+    results['import_flask_app'] = _time_subprocess('import oauth', repeat)
+    results['import_bk_data'] = _time_subprocess('import bk_server.data',
+                                                 repeat)
+    # first session: imports plus bokeh document build from the feather file
+    results['first_session'] = _time_subprocess('import bk_server.main',
+                                                repeat)
+    return results
+
+
+def compare(baseline, current, threshold=1.1):
+    """Get {name: ratio} of current/baseline min times, flagging slowdowns."""
+    lines = []
+    ratios = OrderedDict()
+    for suite, suite_results in current['results'].items():
+        base_suite = baseline.get('results', {}).get(suite, {})
+        for name, res in suite_results.items():
+            if name not in base_suite:
+                continue
+            ratio = res['min'] / base_suite[name]['min']
+            ratios['{}.{}'.format(suite, name)] = ratio
+            flag = ' SLOWER' if ratio > threshold else ''
+            lines.append('{:<45} {:>8.3f}x{}'.format(
+                '{}.{}'.format(suite, name), ratio, flag))
+    print('\n'.join(lines))
+    return ratios
+
+
+def run(params, suites=SUITES, repeat=5, n_requests=500):
+    """Run benchmark suites in a temporary directory. Returns results dict."""
+    workdir = tempfile.mkdtemp(prefix='strains-bench-')
+    configure_env(workdir)
+    results = OrderedDict()
+    if 'data' in suites:
+        results['data'] = bench_data(params, repeat)
+    if 'bokeh' in suites:
+        results['bokeh'] = bench_bokeh(params, repeat)
+    if 'flask' in suites:
+        results['flask'] = bench_flask(params, repeat, n_requests=n_requests)
+    if 'startup' in suites:
+        results['startup'] = bench_startup(params, repeat)
+    meta = OrderedDict([
+        ('time', dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('params', params),
+        ('n_requests', n_requests),
+        ('workdir', workdir),
+    ])
+    return OrderedDict([('meta', meta), ('results', results)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark strains app code paths on synthetic data.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--labs', type=int, default=5)
+    parser.add_argument('--cardinality', type=int, default=20)
+    parser.add_argument('--blank-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--variant-ratio', type=float, default=0.0,
+                        help='fraction of cells with spelling variants')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='number of Request rows for Flask benchmarks')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--suites', default=','.join(SUITES),
+                        help='comma-separated subset of: ' + ', '.join(SUITES))
+    parser.add_argument('--output', help='path for JSON results')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    args = parser.parse_args(argv)
+
+    params = OrderedDict([('n_rows', args.rows), ('n_labs', args.labs),
+                          ('cardinality', args.cardinality),
+                          ('blank_ratio', args.blank_ratio),
+                          ('seed', args.seed),
+                          ('variant_ratio', args.variant_ratio)])
+    suites = [i for i in args.suites.split(',') if i]
+    res = run(params, suites=suites, repeat=args.repeat,
+              n_requests=args.requests)
+    out = json.dumps(res, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), res)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Synthetic strain catalogues with the same columns as the real strains sheet.
+
+make_strains builds a dataframe shaped like the output of load_df, while
+make_sheet_records turns such a dataframe back into per-lab worksheet records
+(as returned by gspread's get_all_records) for the fake Google backends.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from bk_server.data import table_cols, col_dict_r
+from bk_server.vocab import VOCAB_COLS, Vocabulary
+
+LAB_NAMES = ['Francis', 'Schepartz', 'Soll', 'Cate', 'Chatterjee']
+
+KEY_COLS = ['lab', 'entry']
+WORDS = ['promoter', 'reporter', 'knockout', 'tagged', 'variant', 'fusion',
+         'library', 'mutant', 'expression', 'cassette', 'tRNA', 'synthetase',
+         'ribosome', 'orthogonal', 'amber', 'suppressor', 'GFP', 'His6']
+
+
+def lab_names(n_labs):
+    """Get list of n_labs lab names, starting with the real C-GEM labs."""
+    names = LAB_NAMES[:n_labs]
+    names += ['Lab{}'.format(i) for i in range(len(names), n_labs)]
+    return names
+
+
+def _zipf_choice(rs, values, size, skew=1.2):
+    """Draw values with a long-tailed (Zipf-like) frequency distribution."""
+    weights = 1.0 / np.arange(1, len(values) + 1) ** skew
+    weights /= weights.sum()
+    return rs.choice(np.asarray(values, dtype=object), size=size, p=weights)
+
+
+def make_strains(n_rows=1000, n_labs=5, cardinality=20, blank_ratio=0.1,
+                 seed=0, variant_ratio=0.0):
+    """Build synthetic strains dataframe with columns matching table_cols.
+
+    Args:
+        n_rows (int): number of strains.
+        n_labs (int): number of labs (lab column cardinality).
+        cardinality (int): number of distinct values in each categorical
+            column (organism, strain, marker, origin, promoter, submitter...).
+        blank_ratio (float): fraction of non-key cells set to '<blank>'.
+        seed (int): random seed, for reproducible catalogues.
+        variant_ratio (float): fraction of organism, marker and origin cells
+            spelled differently (upper or title case, trailing space).
+
+    Returns:
+        pd.DataFrame in the format produced by load_df.
+    """
+    rs = np.random.RandomState(seed)
+    labs = lab_names(n_labs)
+    lab = _zipf_choice(rs, labs, n_rows, skew=0.5)
+    lab_series = pd.Series(lab)
+    entry = (lab_series.groupby(lab_series).cumcount() + 1).astype(str)
+
+    data = OrderedDict()
+    for col in table_cols:
+        if col == 'lab':
+            data[col] = lab
+        elif col == 'entry':
+            data[col] = entry.values
+        elif col == 'benchling_url':
+            data[col] = ['https://benchling.com/s/seq-{:06d}'.format(i)
+                         for i in range(n_rows)]
+        elif col == 'desc':
+            words = rs.choice(WORDS, size=(n_rows, 4))
+            data[col] = [' '.join(i) for i in words]
+        elif col == 'plasmid':
+            data[col] = ['p{}{:05d}'.format(i[:3], j)
+                         for i, j in zip(lab, rs.randint(0, 10 ** 5, n_rows))]
+        else:
+            vals = ['{}_{}'.format(col, i) for i in range(cardinality)]
+            data[col] = _zipf_choice(rs, vals, n_rows)
+    df = pd.DataFrame(data)
+    for col in df.columns:
+        if col in KEY_COLS:
+            continue
+        is_blank = rs.random_sample(n_rows) < blank_ratio
+        df.loc[is_blank, col] = '<blank>'
+    spellings = [str.upper, str.title, lambda v: v + ' ']
+    for col in VOCAB_COLS:
+        is_variant = (rs.random_sample(n_rows) < variant_ratio) & \
+            (df[col] != '<blank>').values
+        variants = rs.randint(0, len(spellings), is_variant.sum())
+        df.loc[is_variant, col] = [
+            spellings[i](v) for i, v in zip(variants, df.loc[is_variant, col])]
+    return df.astype(str)
+
+
+def make_vocabulary(df):
+    """Get vocabulary with the values of df as canonical labels."""
+    terms = OrderedDict()
+    for col, kind in VOCAB_COLS.items():
+        kind_terms = terms.setdefault(kind, OrderedDict())
+        for val in df[col].unique():
+            if val != '<blank>' and val.strip() == val and val.islower():
+                kind_terms[val] = []
+    return Vocabulary(terms)
+
+
+def make_sheet_records(df):
+    """Get {lab: records} in worksheet format from strains dataframe.
+
+    Records use the spreadsheet column headers (e.g. 'Entry #') and empty
+    strings for blank cells, as returned by gspread's get_all_records.
+    """
+    sheet_cols = [i for i in df.columns if i != 'lab']
+    headers = [col_dict_r[i] for i in sheet_cols]
+    sheets = OrderedDict()
+    for lab, lab_df in df.groupby('lab', sort=False):
+        vals = lab_df[sheet_cols].replace('<blank>', '').values.tolist()
+        sheets[lab] = [OrderedDict(zip(headers, i)) for i in vals]
+    return sheets
@@ -0,0 +1,26 @@
+"""Bokeh server lifecycle hooks for the strains app.
+
+Bokeh calls these functions for a directory app (bokeh serve bk_server), in
+each server process.
+"""
+
+from tornado.ioloop import PeriodicCallback
+
+from . import sessions
+from .refresh import start_scheduler
+
+
+def check_sessions():
+    sessions.expire_idle()
+    sessions.log_stats()
+
+
+def on_server_loaded(server_context):
+    """Start checking for spreadsheet changes and idle sessions."""
+    start_scheduler()
+    PeriodicCallback(check_sessions, sessions.STATS_INTERVAL * 1000).start()
+
+
+def on_session_destroyed(session_context):
+    """Forget session once Bokeh has discarded it (e.g. tab closed)."""
+    sessions.release(session_context.id)
@@ -0,0 +1,57 @@
+"""Process-wide cache of filter results, shared by all Bokeh sessions.
+
+Bokeh runs main.py afresh for every session, but modules imported from the app
+package are imported once per server process. RESULT_CACHE therefore persists
+across sessions: results are keyed by (dataset version, filter key) and hold
+the matching row positions plus the filtered counts dataframe, so popular
+views cost a dictionary lookup instead of a filter and recount.
+
+Cached values are shared between sessions and must not be modified.
+"""
+
+import threading
+from collections import OrderedDict
+
+from .data import RESULT_CACHE_SIZE
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used mapping with a maximum size."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                val = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = val  # move to most recent
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = val
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+RESULT_CACHE = LRUCache(RESULT_CACHE_SIZE)
@@ -0,0 +1,516 @@
+"""Strains data loading and counting, independent of the Bokeh document.
+
+Functions here fetch the strains catalogue from Google Sheets (or the local
+snapshot copy) and derive the 'counts' dataframe used by the bar plot. They
+are imported by main.py, and can be used offline (e.g. by the benchmark suite)
+without building a Bokeh document.
+
+Labs are discovered from the worksheets of the strains spreadsheet. Local
+copies are versioned snapshots in SNAPSHOT_DIR (see snapshot.py), with one
+partition per lab, so a refresh only re-encodes and writes the labs whose
+worksheets changed. The snapshot manifest also holds the plot 'layout': counts
+of the full catalogue, summed from per-partition counts, from which each new
+Bokeh session builds its bar plot (x-range factors and bar heights) without
+recounting. Values beyond the TOP_N_BARS most common in each category (except
+lab) are shown as a single 'Other' bar, whose bucket of values is stored with
+the layout. Changed labs are parsed, normalised (spellings of markers,
+origins and organisms mapped to canonical values, see vocab.py), counted,
+encoded and written in a pool of worker processes (see ingest.py). A legacy
+feather file at FEATHER_PATH is imported as the first snapshot if no snapshot
+exists. The Google Sheets client libraries are only imported when the sheet
+is actually fetched.
+"""
+
+import os
+import json
+import time
+import hashlib
+import datetime as dt
+from collections import OrderedDict, Counter
+from dotenv import load_dotenv, find_dotenv
+
+import numpy as np
+import pandas as pd
+
+from . import snapshot, vocab
+from .filters import ALL_VAL, OTHER_VAL, encode_strains
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+env_path = os.getenv('ENV_NAME', find_dotenv())
+load_dotenv(env_path)
+CREDS_JSON = os.environ.get('CREDS_JSON')
+FEATHER_PATH = os.environ.get('FEATHER_PATH') or 'df.feather'
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR') or \
+    os.path.splitext(FEATHER_PATH)[0] + '_snapshots'
+# number of filtered views cached per server process, shared across sessions
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE') or 256)
+# filter in the browser, after sending the full table once (see main.py)
+CLIENT_FILTERING = os.environ.get('CLIENT_FILTERING') == 'True'
+# seconds between checks for spreadsheet changes (0 disables, see refresh.py)
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL') or 300)
+# bars per category, beyond which values are collapsed into an 'Other' bar
+TOP_N_BARS = int(os.environ.get('TOP_N_BARS') or 20)
+# live Bokeh sessions per server process, and seconds before idle ones expire
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS') or 50)
+SESSION_IDLE_TIMEOUT = float(os.environ.get('SESSION_IDLE_TIMEOUT') or 3600)
+# synonym vocabulary mapping spellings to canonical values (see vocab.py)
+VOCAB_PATH = os.environ.get('VOCAB_PATH') or \
+    os.path.join(basedir, 'vocabulary.json')
+# processes building changed lab partitions on refresh (see ingest.py), by
+# default sharing the CPUs between the BOKEH_NUM_PROCS server processes (0:
+# one per CPU, as in start_strains_bokeh.sh)
+_CPUS = os.cpu_count() or 1
+_BOKEH_PROCS = int(os.environ.get('BOKEH_NUM_PROCS') or 1) or _CPUS
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS') or
+                     max(1, _CPUS // _BOKEH_PROCS))
+SHEET_ID = os.environ.get('SHEET_ID')  # optional, else found by SHEET_TITLE
+SHEET_TITLE = 'C-GEM strains list'
+SHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+
+# select_cols = ['marker1', 'marker2', 'strain', 'origin', 'origin2', 'lab', 'submitter']  # organism
+NON_LAB_SHEETS = ['Introduction', 'Emails']  # all other worksheets are labs
+PLOT_COLS = ['marker1', 'strain', 'origin', 'lab', 'submitter']  # organism, origin2, marker2
+LAB_COL = 'lab'
+
+col_dict = {
+    'Name': 'submitter',
+    'Description': 'desc',
+    'Lab': 'lab',
+    'Benchling File': 'benchling_url',
+    'Entry #': 'entry',
+    'Organism': 'organism',
+    'Marker 1': 'marker1',
+    'Marker 2': 'marker2',
+    'Origin': 'origin',
+    'Origin 2': 'origin2',
+    'Plasmid': 'plasmid',
+    'Promoter': 'promoter',
+    'Strain': 'strain',
+}
+col_dict_r = {col_dict[i]: i for i in col_dict}
+
+table_cols = OrderedDict([
+    ('lab', {'width': 70}),
+    ('entry', {'width': 38}),
+    ('organism', {'width': 60}),
+    ('strain', {'width': 80}),
+    ('plasmid', {'width': 165}),
+    ('marker1', {'width': 55}),
+    ('marker2', {'width': 55}),
+    ('origin', {'width': 55}),
+    ('origin2', {'width': 45}),
+    ('promoter', {'width': 60}),
+    ('benchling_url', {'width': 90}),
+    ('desc', {'width': 320}),
+    ('submitter', {'width': 70})])
+
+
+def get_gsheet_dict():
+    """Get dictionary of sheet_name: sheet object."""
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    scope = ['https://spreadsheets.google.com/feeds',
+             'https://www.googleapis.com/auth/drive']
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(
+        CREDS_JSON, scope)
+
+    gc = gspread.authorize(credentials)
+    # display('List spreadsheet files:', gc.list_spreadsheet_files())
+    file = gc.open(SHEET_TITLE)
+    wsheets = file.worksheets()
+    sheet_dict = OrderedDict([(i.title, i) for i in wsheets])
+    return sheet_dict
+
+
+def get_sheet_metadata():
+    """Get Drive metadata of the strains spreadsheet, without its contents.
+
+    Returns:
+        dict with 'id', 'modifiedTime' (RFC 3339) and 'version', a number
+        that increases with every change to the spreadsheet.
+    """
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+
+    credentials = service_account.Credentials.from_service_account_file(
+        CREDS_JSON, scopes=DRIVE_SCOPES)
+    service = build('drive', 'v3', credentials=credentials,
+                    cache_discovery=False)
+    fields = 'id, modifiedTime, version'
+    if SHEET_ID:
+        return service.files().get(fileId=SHEET_ID, fields=fields,
+                                   supportsAllDrives=True).execute()
+    query = "name = '{}' and mimeType = '{}' and trashed = false".format(
+        SHEET_TITLE, SHEET_MIME_TYPE)
+    res = service.files().list(q=query, fields='files({})'.format(fields),
+                               supportsAllDrives=True,
+                               includeItemsFromAllDrives=True).execute()
+    return res['files'][0]
+
+
+def sheet_revision(records):
+    """Get revision identifier (content digest) for worksheet records."""
+    data = json.dumps(records, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def load_df(load_gsheet=False):
+    """Load COMPLETE strains dataframe from Google Sheets or local snapshot."""
+    df, manifest = load_snapshot(load_gsheet=load_gsheet)
+    return df
+
+
+def load_snapshot(load_gsheet=False):
+    """Get (strains dataframe, snapshot manifest).
+
+    Reads the latest local snapshot unless load_gsheet is True or there is
+    none, in which case changed lab worksheets are fetched from Google Sheets
+    and published as a new snapshot. Dataframes read from snapshots have
+    categorical columns and are shared within the process, so must not be
+    modified.
+
+    Snapshots are written under the snapshot write lock, so of several
+    processes starting without a snapshot, one writes it and the others read
+    it once published.
+    """
+    manifest = snapshot.read_manifest(SNAPSHOT_DIR)
+    if manifest is None or load_gsheet:
+        with snapshot.write_lock(SNAPSHOT_DIR):
+            if not load_gsheet:  # may have been published while waiting
+                manifest = snapshot.read_manifest(SNAPSHOT_DIR)
+            if manifest is None and os.path.exists(FEATHER_PATH) and \
+                    not load_gsheet:
+                manifest = save_snapshot(pd.read_feather(FEATHER_PATH))
+            if manifest is None or load_gsheet:
+                manifest, changed = refresh_snapshot()
+    df = snapshot.read_snapshot(SNAPSHOT_DIR, manifest)
+    return df[[i for i in table_cols]], manifest
+
+
+def get_lab_names(sheet_dict):
+    """Get lab names: titles of all worksheets except NON_LAB_SHEETS."""
+    return [i for i in sheet_dict if i not in NON_LAB_SHEETS]
+
+
+def lab_df_from_records(lab, records):
+    """Get strains dataframe for one lab from its worksheet records."""
+    records = [i for i in records if set(i.values()) != {''}]  # remove empty rows
+    df = pd.DataFrame(records, dtype=str)
+    df.insert(0, 'Lab', lab)
+    df.rename(columns=col_dict, inplace=True)
+    df = df.reindex(columns=list(table_cols), fill_value='')
+    df = df.replace('', '<blank>')
+    return df
+
+
+def refresh_snapshot(**extra):
+    """Fetch lab worksheets, writing partitions only for changed sheets.
+
+    Labs are discovered from the worksheet titles. A new snapshot version is
+    published if any lab's worksheet changed, or labs were added or removed.
+    extra (e.g. spreadsheet metadata) is stored in the new manifest. Stage
+    timings are logged if any partition was written (see ingest.py).
+
+    Returns:
+        (manifest, list of labs with new partitions).
+    """
+    from . import ingest
+
+    sheet_dict = get_gsheet_dict()
+    labs = get_lab_names(sheet_dict)
+    prev = snapshot.read_manifest(SNAPSHOT_DIR)
+    prev_parts = prev.get('partitions', {}) if prev else {}
+    partitions, changed, timings = ingest.ingest_labs(
+        sheet_dict, labs, prev_parts, SNAPSHOT_DIR)
+    if prev is not None and not changed and list(prev_parts) == labs:
+        return prev, changed
+    start = time.perf_counter()
+    manifest = publish_snapshot(partitions, **extra)
+    timings['publish'] = time.perf_counter() - start
+    if changed:
+        ingest.log_timings(timings, changed, manifest['n_rows'])
+        ingest.log_unknown_values(manifest)
+    return manifest, changed
+
+
+def normalise_values(df):
+    """Get (df with canonical values, partition metadata on normalisation).
+
+    Metadata has the digest of the vocabulary used and the values not found
+    in it (see vocab.py).
+    """
+    vocabulary = vocab.load_vocabulary(VOCAB_PATH)
+    df, unknown = vocabulary.normalise(df)
+    return df, OrderedDict([('vocabulary', vocabulary.digest),
+                            ('unknown_values', unknown)])
+
+
+def vocabulary_changed(manifest):
+    """Check if any partition was built with a different vocabulary."""
+    digest = vocab.load_vocabulary(VOCAB_PATH).digest
+    return any(i.get('vocabulary') != digest
+               for i in manifest.get('partitions', {}).values())
+
+
+def lab_value_counts(df):
+    """Get {col: {value: count}} of plotted columns, for partition metadata."""
+    return OrderedDict(
+        (col, OrderedDict((str(k), int(v))
+                          for k, v in df[col].value_counts().items()))
+        for col in PLOT_COLS)
+
+
+def write_lab_partition(lab, df, prev=None, revision=None):
+    """Write snapshot partition for one lab, including its value counts."""
+    df, normalised = normalise_values(df)
+    return snapshot.write_partition(SNAPSHOT_DIR, lab, df, prev=prev,
+                                    revision=revision,
+                                    value_counts=lab_value_counts(df),
+                                    **normalised)
+
+
+def publish_snapshot(partitions, **extra):
+    """Publish partitions as new snapshot, with layout from their counts."""
+    labs = list(partitions)
+    value_counts = OrderedDict()
+    for col in PLOT_COLS:
+        col_counts = Counter()
+        for part in partitions.values():
+            col_counts.update(part['value_counts'][col])
+        vc = pd.Series(col_counts, dtype=int)
+        value_counts[col] = vc[vc > 0].sort_values(ascending=False)
+    n_strains = sum(i['n_rows'] for i in partitions.values())
+    counts = counts_from_value_counts(value_counts, n_strains, labs=labs)
+    return snapshot.publish(
+        SNAPSHOT_DIR, partitions, list(table_cols), labs=labs,
+        layout=build_layout(counts),
+        unknown_values=vocab.sum_unknown(partitions.values()), **extra)
+
+
+def save_snapshot(df, sheet_revisions=None):
+    """Write strains dataframe as new snapshot, partitioned by lab."""
+    df = df[[i for i in table_cols]]
+    sheet_revisions = sheet_revisions or {}
+    prev = snapshot.read_manifest(SNAPSHOT_DIR)
+    prev_parts = prev.get('partitions', {}) if prev else {}
+    partitions = OrderedDict()
+    for lab, lab_df in df.groupby(LAB_COL, sort=False):
+        partitions[lab] = write_lab_partition(
+            lab, lab_df, prev=prev_parts.get(lab),
+            revision=sheet_revisions.get(lab))
+    return publish_snapshot(partitions)
+
+
+def counts_from_value_counts(value_counts, n_strains, labs=None,
+                             pairs_df=None, other=None):
+    """Get counts dataframe from {col: value counts series}.
+
+    Value counts must be sorted in descending order. If labs is given, lab
+    counts include every lab, including labs without strains. If pairs_df is
+    given, counts are for its (categ, val) pairs, where 'Other' bars count
+    the values listed in other ({categ: vals}).
+    """
+    count_list = []
+    for col in PLOT_COLS:
+        vc = value_counts[col]
+        if col == LAB_COL and labs is not None:
+            vc = vc.reindex(labs, fill_value=0).sort_values(ascending=False)
+        # if (vc > 1).any() & (len(vc) < 10):
+        vc.index.name = 'val'
+        vc.name = 'n'
+        if len(vc) > 1:
+            s_all = pd.Series(name='n',
+                              index=pd.Index(name='val', data=['All']),
+                              data=[n_strains])
+            vc = pd.concat([s_all, vc])
+        vcd = vc.reset_index()
+        vcd.insert(0, 'categ', col)
+        count_list.append(vcd)
+    counts = pd.concat(count_list, axis=0, ignore_index=True, sort=False)
+    if pairs_df is not None:
+        counts = pairs_df.merge(counts, how='left', on=['categ', 'val']).fillna(0)
+        for categ, vals in (other or {}).items():
+            is_other = (counts['categ'] == categ) & (counts['val'] == OTHER_VAL)
+            counts.loc[is_other, 'n'] = \
+                value_counts[categ].reindex(vals).fillna(0).sum()
+    return counts
+
+
+def counts_from_strains(strains, pairs_df=None, labs=None, other=None):
+    """Get counts dataframe from strains table."""
+    value_counts = OrderedDict()
+    for col in PLOT_COLS:
+        vc = strains[col].value_counts()
+        if isinstance(strains[col].dtype, pd.CategoricalDtype):
+            vc = vc[vc > 0]  # drop unused categories
+            vc.index = vc.index.astype(object)
+        value_counts[col] = vc
+    return counts_from_value_counts(value_counts, len(strains), labs=labs,
+                                    pairs_df=pairs_df, other=other)
+
+
+def collapse_counts(counts, top_n=TOP_N_BARS):
+    """Collapse values beyond top_n of each category into an 'Other' bar.
+
+    Lab bars are never collapsed.
+
+    Returns:
+        (counts dataframe, {categ: list of vals in 'Other' bucket}).
+    """
+    parts = []
+    other = OrderedDict()
+    for categ, categ_counts in counts.groupby('categ', sort=False):
+        is_val = categ_counts['val'] != ALL_VAL
+        if categ == LAB_COL or is_val.sum() <= top_n + 1:
+            parts.append(categ_counts)
+            continue
+        vals = categ_counts[is_val].sort_values('n', ascending=False,
+                                                kind='mergesort')
+        rest = vals.iloc[top_n:]
+        other[categ] = list(rest['val'])
+        bucket = pd.DataFrame(OrderedDict([
+            ('categ', [categ]), ('val', [OTHER_VAL]), ('n', [rest['n'].sum()])]))
+        parts.extend([categ_counts[~is_val], vals.iloc[:top_n], bucket])
+    counts = pd.concat(parts, ignore_index=True, sort=False)
+    return counts, other
+
+
+def expand_counts(counts, codes, other, categs):
+    """Replace 'Other' bars of categs by one bar per value in their bucket.
+
+    Args:
+        counts (pd.DataFrame): full counts with 'Other' bars.
+        codes (dict): encoding of full strains data (see encode_strains).
+        other (dict): {categ: list of vals in 'Other' bucket}.
+        categs (list): categories to expand.
+    """
+    parts = []
+    for categ, categ_counts in counts.groupby('categ', sort=False):
+        if categ in categs and categ in other:
+            col_codes, values = codes[categ]
+            col_n = np.bincount(col_codes[col_codes >= 0],
+                                minlength=len(values))
+            inds = values.get_indexer(other[categ])
+            bucket = pd.DataFrame(OrderedDict([
+                ('categ', categ), ('val', other[categ]),
+                ('n', np.where(inds >= 0, col_n[inds], 0))]))
+            categ_counts = pd.concat([
+                categ_counts[categ_counts['val'] != OTHER_VAL],
+                bucket.sort_values('n', ascending=False, kind='mergesort')])
+        parts.append(categ_counts)
+    return pd.concat(parts, ignore_index=True, sort=False)
+
+
+def counts_from_codes(codes, rows, pairs_df, other=None):
+    """Get counts dataframe for subset of full strains data, from codes.
+
+    Equivalent to counts_from_strains(df.iloc[rows], pairs_df, other=other),
+    where codes is the encoding of df (see filters.encode_strains), but
+    counts each column with a single np.bincount over its integer codes.
+    """
+    n_strains = len(rows)
+    categs = pairs_df['categ'].values
+    vals = pairs_df['val'].values
+    n = np.zeros(len(pairs_df), dtype=int)
+    for col in PLOT_COLS:
+        col_codes, values = codes[col]
+        sub_codes = col_codes[rows]
+        col_n = np.bincount(sub_codes[sub_codes >= 0], minlength=len(values))
+        is_col = categs == col
+        inds = values.get_indexer(vals[is_col])
+        col_counts = np.where(inds >= 0, col_n[inds], 0)
+        # 'All' bar, as in counts_from_strains: lab counts include every lab
+        n_vals = len(values) if col == LAB_COL else np.count_nonzero(col_n)
+        col_counts[vals[is_col] == ALL_VAL] = n_strains if n_vals > 1 else 0
+        if other and col in other:
+            inds = values.get_indexer(other[col])
+            col_counts[vals[is_col] == OTHER_VAL] = col_n[inds[inds >= 0]].sum()
+        n[is_col] = col_counts
+    counts = pairs_df.copy()
+    counts['n'] = n
+    return counts
+
+
+def counts_source_data(counts):
+    """Get ColumnDataSource data dict for counts barplot."""
+    return OrderedDict([
+        ('categ_val', list(zip(counts['categ'], counts['val']))),
+        ('n', list(counts['n'])),
+    ])
+
+
+def build_layout(counts):
+    """Get JSON-serializable plot layout metadata from full strains counts."""
+    counts, other = collapse_counts(counts)
+    return OrderedDict([
+        ('other', other),
+        ('columns', list(table_cols)),
+        ('categs', list(counts['categ'].unique())),
+        ('counts', OrderedDict([('categ', list(counts['categ'])),
+                                ('val', list(counts['val'])),
+                                ('n', [int(i) for i in counts['n']])])),
+    ])
+
+
+def update_data_dict(data_dict=None, strains=None, write_orig=False,
+                     layout=None):
+    """Update data_dict from strains dataframe.
+
+    With write_orig, strains is the full data: the encoding used for
+    filtering and the full counts are updated too. Full counts, with 'Other'
+    bars and their buckets of values ('other'), are taken from layout metadata
+    if provided.
+    """
+    data_dict['current'] = strains
+    if write_orig:
+        # Update all data
+        data_dict['df'] = strains  # shared, not modified
+        data_dict['codes'] = encode_strains(data_dict['df'], PLOT_COLS)
+        data_dict.pop('search_text', None)  # built on first search
+        if layout is not None and 'other' in layout:
+            counts = pd.DataFrame(layout['counts'])
+            other = layout['other']
+        elif layout is not None:  # snapshot from before 'Other' bars
+            counts, other = collapse_counts(pd.DataFrame(layout['counts']))
+        else:
+            counts, other = collapse_counts(counts_from_strains(strains))
+        data_dict['other'] = other
+        data_dict['counts_orig'] = counts
+        data_dict['counts'] = counts.copy()
+        data_dict['pairs_df'] = counts[['categ', 'val']]
+    else:
+        # Update counts but don't overwrite pairs_df.
+        counts = counts_from_strains(strains, pairs_df=data_dict['pairs_df'],
+                                     other=data_dict['other'])
+        data_dict['counts'] = counts.copy()
+    return
+
+
+def get_data_version():
+    """Get version of the latest local snapshot of strains data."""
+    manifest = snapshot.read_manifest(SNAPSHOT_DIR)
+    return manifest['version'] if manifest else None
+
+
+def get_refresh_msg(manifest=None, last_check=None):
+    """Get message on data changes to accompany refresh button.
+
+    Args:
+        manifest (dict): snapshot manifest, read if not given.
+        last_check (str): UTC time of last check for changes, if any.
+    """
+    if manifest is None:
+        manifest = snapshot.read_manifest(SNAPSHOT_DIR)
+    # spreadsheet modification time if known, else time the change was loaded
+    modtime = (manifest.get('source_modified') or manifest['mtime'])[:19]
+    modtime = dt.datetime.strptime(modtime, '%Y-%m-%dT%H:%M:%S')
+    modtime_str = modtime.strftime('%Y-%m-%d %H:%M:%S')
+    msg = 'Spreadsheet last changed at {} UTC (version {}, {} strains).'.format(
+        modtime_str, manifest['version'], manifest['n_rows'])
+    if last_check is not None:
+        msg += ' Last checked for changes at {} UTC.'.format(
+            last_check.replace('T', ' '))
+    return msg
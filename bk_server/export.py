@@ -0,0 +1,104 @@
+"""Streaming export of filtered strains data, as CSV, TSV or Parquet.
+
+Rows are read from the memory-mapped snapshot partitions (see snapshot.py)
+one batch of EXPORT_BATCH_ROWS at a time. Each batch is filtered with the
+same functions as the Bokeh app (see filters.py), given a filter key, and
+written out before the next batch is read. Memory use is therefore bounded by
+the batch size, whatever the size of the catalogue, and the first bytes are
+available as soon as the first batch is filtered.
+
+Used by the Flask export endpoint (oauth/routes.py), which links to the
+filtered view in the Bokeh app via the filter key in the page URL.
+"""
+
+import io
+import os
+from collections import OrderedDict
+
+import pyarrow as pa
+
+from . import snapshot
+from .data import SNAPSHOT_DIR, PLOT_COLS
+from .filters import encode_strains, parse_filter_key, filter_rows, \
+    build_search_text
+
+EXPORT_BATCH_ROWS = 10000
+FORMATS = OrderedDict([
+    # format: (mimetype, file extension)
+    ('csv', ('text/csv', 'csv')),
+    ('tsv', ('text/tab-separated-values', 'tsv')),
+    ('parquet', ('application/vnd.apache.parquet', 'parquet')),
+])
+
+
+class _ChunkSink(io.BytesIO):
+    """File object whose contents are handed out (drained) as written."""
+    offset = 0
+
+    def tell(self):
+        return self.offset + super().tell()
+
+    def drain(self):
+        data = self.getvalue()
+        self.offset += len(data)
+        self.seek(0)
+        self.truncate()
+        return data
+
+
+def iter_batches(manifest, snapshot_dir=SNAPSHOT_DIR,
+                 batch_rows=EXPORT_BATCH_ROWS):
+    """Yield dataframes of consecutive rows of snapshot, batch_rows at most."""
+    for name in snapshot.partition_paths(manifest):
+        path = os.path.join(snapshot_dir, name)
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        for batch in table.to_batches(max_chunksize=batch_rows):
+            yield batch.to_pandas()
+
+
+def iter_filtered(manifest, query='', snapshot_dir=SNAPSHOT_DIR,
+                  batch_rows=EXPORT_BATCH_ROWS):
+    """Yield batches of strains matching filter key query.
+
+    Blank cells are empty strings, as shown in the strains table.
+    """
+    state = parse_filter_key(query, PLOT_COLS)
+    other = manifest.get('layout', {}).get('other')
+    columns = manifest['columns']
+    for df in iter_batches(manifest, snapshot_dir, batch_rows):
+        codes = encode_strains(df, PLOT_COLS)
+        search_text = build_search_text(df) if state['search'] else None
+        rows = filter_rows(codes, state, search_text=search_text, other=other)
+        if len(rows):
+            df = df.iloc[rows][columns]
+            yield df.astype(str).replace('<blank>', '')
+
+
+def iter_export(fmt, query='', manifest=None, snapshot_dir=SNAPSHOT_DIR,
+                batch_rows=EXPORT_BATCH_ROWS):
+    """Yield bytes of filtered strains data in format fmt.
+
+    Args:
+        fmt (str): one of FORMATS.
+        query (str): filter key, i.e. URL query string (see filters.py).
+        manifest (dict): snapshot manifest. Latest snapshot if None.
+    """
+    if manifest is None:
+        manifest = snapshot.read_manifest(snapshot_dir)
+    batches = iter_filtered(manifest, query, snapshot_dir, batch_rows)
+    columns = manifest['columns']
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        schema = pa.schema([(col, pa.string()) for col in columns])
+        sink = _ChunkSink()
+        with pq.ParquetWriter(sink, schema) as writer:
+            for df in batches:
+                writer.write_table(pa.Table.from_pandas(
+                    df, schema=schema, preserve_index=False))
+                yield sink.drain()
+        yield sink.drain()  # footer
+        return
+    sep = '\t' if fmt == 'tsv' else ','
+    yield (sep.join(columns) + '\n').encode('utf-8')
+    for df in batches:
+        yield df.to_csv(sep=sep, header=False, index=False).encode('utf-8')
@@ -0,0 +1,230 @@
+"""Vectorized filtering of the strains table by plot selections.
+
+Each plotted column is dictionary-encoded once (encode_strains), giving an
+integer code per row and an index of the distinct values. A selection is a
+dictionary of {categ: set of vals}. Values within a category are ORed and
+categories are ANDed, so selecting two markers and one lab shows strains from
+that lab carrying either marker. Excluded bars have the same format and are
+kept separately: rows matching any of them are removed (e.g. 'exclude this
+marker'), so one lab can be included while a marker is excluded.
+
+Each category costs one lookup-table gather over the integer codes, so a
+selection is evaluated in a single pass per category regardless of how many
+bars are selected.
+
+High-cardinality categories show only their most common values as bars, with
+the rest collapsed into an 'Other' bar (see data.collapse_counts). Selecting
+'Other' selects every value in its bucket: expand_other replaces it by the
+bucket's values before filtering.
+
+The complete filter state (included and excluded bars, categories whose
+'Other' bar is expanded and search term) is serialised as a canonical URL
+query string by filter_key, e.g. 'lab=Cate&lab=Soll&-marker1=KanR&q=gfp',
+where excluded bars have their category prefixed with EXCLUDE_PREFIX. The
+same string is used in shareable URLs and as the key for cached filter
+results. Older keys with 'mode=exclude' (every selected bar excluded) are
+still parsed. Expanded categories are part of the key, as a selected value
+may only have a bar of its own while its 'Other' bar is expanded.
+"""
+
+from collections import OrderedDict
+from urllib.parse import urlencode, parse_qs
+
+import numpy as np
+import pandas as pd
+
+ALL_VAL = 'All'
+OTHER_VAL = '(Other)'
+MODES = ['include', 'exclude']  # whether newly selected bars are excluded
+MODE_ARG = 'mode'  # legacy key argument: exclude all selected bars
+EXCLUDE_PREFIX = '-'  # key argument prefix of excluded bars' categories
+EXPAND_ARG = 'expand'
+SEARCH_ARG = 'q'
+
+
+def encode_strains(strains, cols):
+    """Get {col: (codes, values)} integer encoding of columns cols.
+
+    codes is an integer array with one entry per row, values a pd.Index of
+    the distinct column values such that values[codes[i]] is the value in
+    row i.
+    """
+    codes = OrderedDict()
+    for col in cols:
+        if isinstance(strains[col].dtype, pd.CategoricalDtype):
+            # snapshot columns are already dictionary-encoded
+            cat = strains[col].cat
+            codes[col] = (cat.codes.values, pd.Index(cat.categories))
+            continue
+        col_codes, uniques = pd.factorize(strains[col])
+        codes[col] = (col_codes, pd.Index(uniques))
+    return codes
+
+
+def bar_codes(codes, pairs):
+    """Get encoding of bars for filtering in the browser (see main.py).
+
+    Args:
+        codes (dict): encoding from encode_strains.
+        pairs (list): (categ, val) of each bar.
+
+    Returns:
+        OrderedDict of lists, with one entry per bar: 'categ'; 'code' of the
+        bar's value in codes[categ] (-1 if not present); 'is_all' and
+        'is_other' (True for 'All' and 'Other' bars); 'n_values', the number
+        of distinct values of categ.
+    """
+    bars = OrderedDict([('categ', []), ('code', []), ('is_all', []),
+                        ('is_other', []), ('n_values', [])])
+    for categ, val in pairs:
+        values = codes[categ][1]
+        bars['categ'].append(categ)
+        bars['code'].append(int(values.get_indexer([val])[0]))
+        bars['is_all'].append(val == ALL_VAL)
+        bars['is_other'].append(val == OTHER_VAL)
+        bars['n_values'].append(len(values))
+    return bars
+
+
+def selection_from_pairs(pairs):
+    """Get {categ: set of vals} from (categ, val) pairs, ignoring 'All' bars."""
+    selection = OrderedDict()
+    for categ, val in pairs:
+        if val == ALL_VAL:
+            continue
+        selection.setdefault(categ, set()).add(val)
+    return selection
+
+
+def expand_other(selection, other):
+    """Get selection with 'Other' bars replaced by the values they stand for.
+
+    Args:
+        selection (dict): {categ: set of vals}.
+        other (dict): {categ: list of vals in 'Other' bucket}.
+    """
+    expanded = OrderedDict()
+    for categ, vals in selection.items():
+        if OTHER_VAL in vals and categ in (other or {}):
+            vals = (set(vals) - {OTHER_VAL}) | set(other[categ])
+        expanded[categ] = vals
+    return expanded
+
+
+def _value_lut(values, vals):
+    """Get boolean lookup table over codes: True where value is in vals.
+
+    The table has one extra False entry at the end so that missing values
+    (code -1) never match.
+    """
+    lut = np.zeros(len(values) + 1, dtype=bool)
+    inds = values.get_indexer(list(vals))
+    lut[inds[inds >= 0]] = True
+    return lut
+
+
+def filter_mask(codes, include=None, exclude=None):
+    """Get boolean row mask for selection: OR within, AND across categories.
+
+    Args:
+        codes (dict): encoding from encode_strains.
+        include (dict): {categ: vals}. Rows must match one of vals in
+            every included categ.
+        exclude (dict): {categ: vals}. Rows matching any of vals in any
+            excluded categ are dropped.
+    """
+    mask = None
+    for categ, vals in (include or {}).items():
+        col_codes, values = codes[categ]
+        categ_mask = _value_lut(values, vals)[col_codes]
+        mask = categ_mask if mask is None else mask & categ_mask
+    for categ, vals in (exclude or {}).items():
+        col_codes, values = codes[categ]
+        categ_mask = ~_value_lut(values, vals)[col_codes]
+        mask = categ_mask if mask is None else mask & categ_mask
+    if mask is None:
+        n_rows = len(next(iter(codes.values()))[0])
+        mask = np.ones(n_rows, dtype=bool)
+    return mask
+
+
+def filter_strains(strains, codes, include=None, exclude=None):
+    """Get subset of strains dataframe matching selection."""
+    if not include and not exclude:
+        return strains
+    return strains[filter_mask(codes, include=include, exclude=exclude)]
+
+
+def build_search_text(strains):
+    """Get lowercase text of each row (all columns joined), for searching."""
+    text = strains.iloc[:, 0].astype(str)
+    for col in strains.columns[1:]:
+        text = text + '\t' + strains[col].astype(str)
+    return text.str.lower()
+
+
+def search_mask(search_text, term):
+    """Get boolean row mask for rows containing term (case-insensitive)."""
+    return search_text.str.contains(term.lower(), regex=False).values
+
+
+def new_filter_state(selection=None, excluded=None, search='',
+                     expanded=None):
+    """Get filter state dict.
+
+    Args:
+        selection (dict): {categ: vals} of included bars.
+        excluded (dict): {categ: vals} of excluded bars.
+        search (str): search term.
+        expanded (list): categories whose 'Other' bar is expanded.
+    """
+    return {'selection': selection or OrderedDict(),
+            'excluded': excluded or OrderedDict(), 'search': search,
+            'expanded': list(expanded or [])}
+
+
+def filter_rows(codes, state, search_text=None, other=None):
+    """Get array of row positions matching filter state.
+
+    other ({categ: vals}) gives the values of 'Other' bars, if any.
+    """
+    mask = filter_mask(codes, include=expand_other(state['selection'], other),
+                       exclude=expand_other(state['excluded'], other))
+    if state['search'] and search_text is not None:
+        mask = mask & search_mask(search_text, state['search'])
+    return np.flatnonzero(mask)
+
+
+def filter_key(state):
+    """Get canonical URL query string for filter state."""
+    args = []
+    for categ in sorted(state['selection']):
+        args.extend((categ, val) for val in sorted(state['selection'][categ]))
+    for categ in sorted(state['excluded']):
+        args.extend((EXCLUDE_PREFIX + categ, val)
+                    for val in sorted(state['excluded'][categ]))
+    for categ in sorted(state.get('expanded') or ()):
+        args.append((EXPAND_ARG, categ))
+    if state['search']:
+        args.append((SEARCH_ARG, state['search']))
+    return urlencode(args)
+
+
+def parse_filter_key(query, categs):
+    """Get filter state from URL query string, ignoring unknown arguments."""
+    args = parse_qs(query)
+    legacy_exclude = args.get(MODE_ARG, [''])[0] == 'exclude'
+    selection = OrderedDict()
+    excluded = OrderedDict()
+    for categ in categs:
+        vals = set(args.get(categ, [])) - {ALL_VAL}
+        excluded_vals = set(args.get(EXCLUDE_PREFIX + categ, [])) - {ALL_VAL}
+        if legacy_exclude:
+            vals, excluded_vals = set(), vals | excluded_vals
+        if vals:
+            selection[categ] = vals
+        if excluded_vals:
+            excluded[categ] = excluded_vals
+    search = args.get(SEARCH_ARG, [''])[0].strip()
+    expanded = [i for i in categs if i in args.get(EXPAND_ARG, [])]
+    return new_filter_state(selection, excluded, search, expanded)
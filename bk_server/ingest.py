@@ -0,0 +1,244 @@
+"""Staged ingest of lab worksheets into snapshot partitions.
+
+A refresh of the strains data (data.refresh_snapshot) runs in stages:
+- fetch: records of every lab worksheet are downloaded from Google Sheets, in
+    FETCH_THREADS threads, and each worksheet's revision (content digest) is
+    computed, to find the labs whose worksheets changed.
+- build: each changed lab's records are parsed into a dataframe ('parse'),
+    mapped to canonical values ('normalise', see vocab.py), counted per
+    plotted column ('count'), dictionary-encoded as an Arrow
+    table ('encode') and written as an unpublished partition file ('write').
+    Labs are built in a pool of INGEST_WORKERS processes, so large catalogues
+    use all cores. Small refreshes (fewer than INGEST_MIN_ROWS changed rows,
+    or a single changed lab) are built in-process, as starting or feeding the
+    pool would take longer.
+- publish: the new manifest is written, with the plot layout summed from the
+    per-partition counts (see data.publish_snapshot).
+
+`bokeh serve bk_server` imports this package under a generated name
+(bokeh_app_<id>), which spawned workers cannot import, so the pool is given
+build_partition from the package imported by its directory name, with the
+repo root on sys.path (see _worker_build).
+
+Workers only send back partition metadata, not data. Partitions are merged
+when the snapshot is read, by concatenating their memory-mapped Arrow tables
+(see snapshot.read_snapshot).
+
+The duration of each stage is logged after every refresh that built
+partitions, naming the slowest. Build sub-stages are summed over labs, i.e.
+they are CPU time across workers rather than elapsed time. The timings of
+the last refresh are kept in last_timings.
+"""
+
+import os
+import sys
+import time
+import atexit
+import logging
+import importlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import snapshot, vocab
+from .data import INGEST_WORKERS, VOCAB_PATH, lab_df_from_records, \
+    lab_value_counts, normalise_values, sheet_revision
+
+FETCH_THREADS = 4  # concurrent worksheet downloads
+INGEST_MIN_ROWS = 20000  # changed rows below which labs are built in-process
+BUILD_STAGES = ['parse', 'normalise', 'count', 'encode', 'write']
+N_UNKNOWN_LOGGED = 10  # most common unknown values logged per kind
+
+log = logging.getLogger(__name__)
+
+last_timings = OrderedDict()  # {stage: seconds} of last refresh
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Get process pool, started on first use and kept between refreshes."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the Bokeh server process runs threads
+            _pool = ProcessPoolExecutor(
+                max_workers=INGEST_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown_pool():
+    """Stop worker processes, if started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+atexit.register(shutdown_pool)
+
+
+def fetch_labs(sheet_dict, labs):
+    """Get {lab: (records, revision)} of lab worksheets, fetched in threads."""
+    def fetch(lab):
+        records = sheet_dict[lab].get_all_records()
+        return records, sheet_revision(records)
+    with ThreadPoolExecutor(max_workers=FETCH_THREADS) as executor:
+        return OrderedDict(zip(labs, executor.map(fetch, labs)))
+
+
+def build_partition(snapshot_dir, lab, records, prev=None, revision=None):
+    """Parse, count, encode and write one lab's partition.
+
+    Runs in a worker process, so takes and returns picklable values only.
+
+    Returns:
+        (partition metadata, OrderedDict of {stage: seconds}).
+    """
+    timings = OrderedDict()
+    start = time.perf_counter()
+    df = lab_df_from_records(lab, records)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df, normalised = normalise_values(df)
+    timings['normalise'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    value_counts = lab_value_counts(df)
+    timings['count'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table = snapshot.table_from_df(df)
+    timings['encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    part = snapshot.write_partition(snapshot_dir, lab, table, prev=prev,
+                                    revision=revision,
+                                    value_counts=value_counts, **normalised)
+    timings['write'] = time.perf_counter() - start
+    return part, timings
+
+
+def _worker_build():
+    """Get build_partition from a module that worker processes can import.
+
+    Spawned workers inherit sys.path, but not the parent's sys.modules, so
+    functions of the package imported by Bokeh as bokeh_app_<id> cannot be
+    unpickled by them.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    root, package = os.path.split(package_dir)
+    if root not in sys.path:
+        sys.path.append(root)
+    return importlib.import_module(package + '.ingest').build_partition
+
+
+def build_partitions(snapshot_dir, jobs):
+    """Build partitions for jobs, in process pool if worthwhile.
+
+    Args:
+        snapshot_dir (str): snapshot directory.
+        jobs (OrderedDict): {lab: (records, prev partition, revision)}.
+
+    Returns:
+        ({lab: partition metadata}, {build stage: seconds summed over labs},
+            number of worker processes used).
+    """
+    n_rows = sum(len(i[0]) for i in jobs.values())
+    workers = min(INGEST_WORKERS, len(jobs))
+    if workers > 1 and n_rows >= INGEST_MIN_ROWS:
+        try:
+            build = _worker_build()  # before workers are spawned
+            pool = _get_pool()
+            futures = OrderedDict(
+                (lab, pool.submit(build, snapshot_dir, lab, records, prev,
+                                  revision))
+                for lab, (records, prev, revision) in jobs.items())
+            results = OrderedDict((lab, future.result())
+                                  for lab, future in futures.items())
+        except BrokenProcessPool:
+            log.exception('Ingest worker failed, building in-process')
+            shutdown_pool()
+        else:
+            return _merge_results(results) + (workers,)
+    results = OrderedDict(
+        (lab, build_partition(snapshot_dir, lab, records, prev, revision))
+        for lab, (records, prev, revision) in jobs.items())
+    return _merge_results(results) + (1,)
+
+
+def _merge_results(results):
+    parts = OrderedDict((lab, i[0]) for lab, i in results.items())
+    timings = OrderedDict((stage, sum(i[1][stage] for i in results.values()))
+                          for stage in BUILD_STAGES)
+    return parts, timings
+
+
+def ingest_labs(sheet_dict, labs, prev_parts, snapshot_dir):
+    """Fetch lab worksheets and build partitions for those that changed.
+
+    Partitions built with a different vocabulary are rebuilt too.
+
+    Args:
+        sheet_dict (dict): {worksheet title: worksheet}.
+        labs (list): lab names, i.e. worksheet titles to ingest.
+        prev_parts (dict): {lab: partition metadata} of previous snapshot.
+        snapshot_dir (str): snapshot directory.
+
+    Returns:
+        tuple: (partitions, changed, timings): OrderedDict of {lab: partition
+            metadata}, list of changed labs, and OrderedDict of {stage:
+            seconds}, which also holds the number of 'workers' used.
+    """
+    timings = OrderedDict()
+    start = time.perf_counter()
+    fetched = fetch_labs(sheet_dict, labs)
+    timings['fetch'] = time.perf_counter() - start
+
+    vocabulary = vocab.load_vocabulary(VOCAB_PATH).digest
+    jobs = OrderedDict()
+    for lab, (records, revision) in fetched.items():
+        part = prev_parts.get(lab)
+        if part is None or part.get('revision') != revision or \
+                part.get('vocabulary') != vocabulary:
+            jobs[lab] = (records, part, revision)
+    start = time.perf_counter()
+    built, build_timings, workers = build_partitions(snapshot_dir, jobs) \
+        if jobs else ({}, OrderedDict(), 0)
+    timings['build'] = time.perf_counter() - start
+    for stage, seconds in build_timings.items():
+        timings['build.' + stage] = seconds
+    timings['workers'] = workers
+
+    partitions = OrderedDict(
+        (lab, built.get(lab) or prev_parts[lab]) for lab in labs)
+    return partitions, list(jobs), timings
+
+
+def log_timings(timings, changed, n_rows):
+    """Log stage timings of a refresh, and keep them in last_timings."""
+    last_timings.clear()
+    last_timings.update(timings)
+    stages = [i for i in timings if i != 'workers' and '.' not in i]
+    slowest = max(stages, key=timings.get)
+    build_stages = [i for i in timings if i.startswith('build.')]
+    if slowest == 'build' and build_stages:
+        slowest = max(build_stages, key=timings.get)
+    log.info('Ingested %s changed labs (%s strains, %s workers): %s; '
+             'slowest: %s', len(changed), n_rows, timings['workers'],
+             ', '.join('{} {:.3f}s'.format(i, timings[i])
+                       for i in stages + build_stages), slowest)
+
+
+def log_unknown_values(manifest):
+    """Log number of values not in the vocabulary, and the most common."""
+    for kind, values in manifest.get('unknown_values', {}).items():
+        if values:
+            log.info('%s %s values not in vocabulary, e.g. %s', len(values),
+                     kind, ', '.join('{!r} ({})'.format(*i) for i in
+                                     list(values.items())[:N_UNKNOWN_LOGGED]))
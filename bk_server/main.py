@@ -4,7 +4,8 @@ The code sets up 'roots' (layout objects) to be added to curdoc(), which can
 then be turned into div and script elements by the bokeh server. These elements
 are embedded in the accompanying Flask app.
 
-Data are arranged in the following structures:
+Data loading and counting functions live in data.py. Data are arranged in the
+following structures:
 
 1) A dictionary of pandas dataframes.
 - df: the full strains dataframe, built from imported Google Sheets data.
@@ -12,42 +13,86 @@ Data are arranged in the following structures:
 - counts: a 'counts' dataframe with columns ['categ', 'val', 'n']. Provides
     the number of rows in df where column 'categ' has value 'val'.
 - pairs_df: dataframe with columns ['categ', 'val']. Has one row for each
-    value ('val') observed in each column ('categ').
+    bar: the most common values ('val') of each column ('categ'), an 'All'
+    bar and an 'Other' bar for the remaining values (see data.py).
+- counts_orig: counts for df, with 'Other' bars.
+- other: {categ: list of values in 'Other' bar}.
+- expanded: categories whose 'Other' bar is expanded into one bar per value.
+- codes: integer encoding of the plotted columns of df, used for filtering
+    (see filters.py).
+- search_text: lowercase text of each row of df, for text search. Built on
+    first use.
+- version: snapshot version of the loaded data (see snapshot.py), used for
+    caching filter results.
 
 2) Bokeh objects.
 - p_counts: the interactive counts barplot.
 - source_c: the data source (ColumnDataSource) underlying p_counts.
 - source_c_orig: the pre-filtered data source for p_counts, for showing
     persistent gray bars that represent counts in the full strains data.
+- source_sel: the selected bars, each with the filter mode ('include' or
+    'exclude') chosen when it was selected. Excluded bars are hatched.
 - data_table: the interactive, sortable table of (filtered) strains data.
 - source_s: the ColumnDataSource holding data for data_table.
-- button_refresh: a refresh button widget that will reload from Google Sheets.
-- text_refresh: a text widget that shows data loading status.
+- filter_mode: radio buttons choosing whether bars selected next include or
+    exclude matching strains, so that e.g. one lab can be included while a
+    marker is excluded.
+- search_input: text search box, further filtering the strains table.
+- expand_group: toggle buttons expanding the 'Other' bar of a category.
+- export_menu: downloads the filtered strains (csv, tsv or parquet), via the
+    Flask app's export endpoint (see export.py).
+- button_basket: requests delivery of the strains selected in data_table,
+    by posting them to the Flask app's request form.
+- url_state: hidden div holding the filter key (see filters.py), which is
+    mirrored to the page URL so filtered views can be bookmarked. Unused in
+    client-side filtering mode, where the browser sets the page URL itself.
+- activity: hidden div holding the time of the last user activity reported by
+    the browser, in client-side filtering mode.
+- button_refresh: a refresh button widget that will check Google Sheets for
+    changes (see refresh.py).
+- text_refresh: a text widget that shows when the data last changed and when
+    changes were last checked for.
+
+In client-side filtering mode (CLIENT_FILTERING, see data.py), the full
+strains table is sent to the browser once per data version, with the integer
+codes of the plotted columns (source_codes) and of each bar's value
+(source_bars). Included and excluded bars and search terms are then applied
+in the browser, by a CustomJS callback that recounts the bars, mirrors the
+filter key to the page URL and updates the table's view (a CustomJSFilter).
+No server callbacks run on these changes: the browser only reports user
+activity (activity), at most every ACTIVITY_PING_MS, so that the session is
+not expired as idle.
+
+Each session checks every SESSION_CHECK_MS for new data versions, loaded by
+any session or the scheduled refresh, and reapplies its filters to them.
+Sessions are registered in sessions.py, which releases their data when they
+are destroyed, idle for too long, or evicted to cap the number of sessions.
 """
 
-import os
-import datetime as dt
+import threading
+from contextlib import contextmanager
 from collections import OrderedDict
-from dotenv import load_dotenv, find_dotenv
 
-import pandas as pd
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from bokeh.io import show
-from bokeh.models import ColumnDataSource, HoverTool, FactorRange, Div, CustomJS
+from bokeh.models import ColumnDataSource, HoverTool, FactorRange, Div, \
+    CustomJS, CDSView, CustomJSFilter, TapTool
 from bokeh.plotting import figure, curdoc
 from bokeh.palettes import Spectral8
-from bokeh.transform import factor_cmap
+from bokeh.transform import factor_cmap, factor_hatch
 from bokeh.models.widgets import Button, DataTable, TableColumn, \
-    HTMLTemplateFormatter
-from bokeh.layouts import row, widgetbox, column
+    HTMLTemplateFormatter, RadioButtonGroup, TextInput, CheckboxButtonGroup, \
+    Dropdown
+from bokeh.layouts import row, column
 
+from .data import table_cols, PLOT_COLS, LAB_COL, CLIENT_FILTERING, \
+    load_snapshot, update_data_dict, counts_from_codes, counts_source_data, \
+    expand_counts, get_data_version
+from .filters import MODES, ALL_VAL, EXCLUDE_PREFIX, EXPAND_ARG, \
+    SEARCH_ARG, selection_from_pairs, new_filter_state, filter_rows, \
+    filter_key, parse_filter_key, build_search_text, bar_codes, expand_other
+from .cache import RESULT_CACHE
+from .refresh import refresh, get_status_msg
+from . import sessions
 
-basedir = os.path.abspath(os.path.dirname(__file__))
-env_path = os.getenv('ENV_NAME', find_dotenv())
-load_dotenv(env_path)
-CREDS_JSON = os.environ.get('CREDS_JSON')
-FEATHER_PATH = os.environ.get('FEATHER_PATH') or 'df.feather'
 
 bar_bg_dict = {'color': 'whitesmoke', 'nonselection_color': 'whitesmoke', 
                'alpha': 0.9, 'nonselection_alpha': 0.9}  # #1f77b4
@@ -57,164 +102,249 @@ bar_bg_dict = {'color': 'whitesmoke', 'nonselection_color': 'whitesmoke',
 #     'line_alpha': 0.1,
 #     'line_color': '#1f77b4'}
 
-# select_cols = ['marker1', 'marker2', 'strain', 'origin', 'origin2', 'lab', 'submitter']  # organism
-LABS = ['Francis', 'Schepartz', 'Soll', 'Cate', 'Chatterjee']  # TODO: remove hard-coded lab names
-PLOT_COLS = ['marker1', 'strain', 'origin', 'lab', 'submitter']  # organism, origin2, marker2
 LINK_COLS = 'benchling_url'
-LAB_COL = 'lab'
 FIG_WIDTH = 1200
 FIG_HEIGHT = 350
+FILTER_MODES = ['Include', 'Exclude']  # labels for filters.MODES
+MODE_HATCH = ['blank', 'diagonal_cross']  # marks of selected bars, per mode
+FILTER_ARG = 'filter'  # session argument holding URL-encoded filter state
+SESSION_CHECK_MS = 10000  # interval for sessions to check for new data
+ACTIVITY_PING_MS = 60000  # interval for browser to report user activity
+EXPORT_ARG = 'export'  # session argument holding Flask export route URL
+EXPORT_URL = '/export/'  # default export route, if not given by Flask app
+EXPORT_MENU = [('CSV', 'csv'), ('TSV', 'tsv'), ('Parquet', 'parquet')]
+BASKET_LABEL = 'Request selected'
+EXPIRED_MSG = '<p>This session has expired. Please reload the page.</p>'
 cell_template = """<span href="#" data-toggle="tooltip" title="<%= value %>"><%= value %></span>"""
 url_template = """<a href="<%= value %>" target="_blank"><%= value %></a>"""
+client_rows_code = """
+    /* rows of strains matching included and excluded bars and search term,
+       as filters.filter_rows on the server, or null until all data has
+       arrived. 'Other' bars stand for all values without their own bar. */
+    function client_rows() {
+        const n_rows = source.get_length() || 0;
+        const c = codes.data;
+        const b = bars.data;
+        if (b.categ === undefined || c[lab_col] === undefined ||
+                c[lab_col].length != n_rows)
+            return null;  // data not complete yet
+        // lookup tables of selected codes per category, for included and
+        // excluded bars: OR within, AND across categories
+        const bar_modes = selected_modes();
+        const luts = {include: {}, exclude: {}};
+        const other_categs = {include: [], exclude: []};
+        for (const i of counts.selected.indices) {
+            if (b.is_all[i])
+                continue;
+            const mode = bar_modes[JSON.stringify(counts.data.categ_val[i])]
+                == 'exclude' ? 'exclude' : 'include';
+            const categ = b.categ[i];
+            if (!(categ in luts[mode]))
+                luts[mode][categ] = new Uint8Array(b.n_values[i]);
+            if (b.is_other[i])
+                other_categs[mode].push(categ);
+            else if (b.code[i] >= 0)
+                luts[mode][categ][b.code[i]] = 1;
+        }
+        for (const mode in luts) {
+            for (const categ of other_categs[mode]) {
+                const lut = luts[mode][categ];
+                const other = new Uint8Array(lut.length).fill(1);
+                for (let i = 0; i < b.categ.length; i++)
+                    if (b.categ[i] == categ && b.code[i] >= 0 &&
+                            !b.is_other[i])
+                        other[b.code[i]] = 0;
+                for (let k = 0; k < other.length; k++)
+                    lut[k] |= other[k];
+            }
+        }
+        const term = search_input.value.trim().toLowerCase();
+        if (term && source._search_data !== source.data) {
+            const cols = Object.keys(source.data);
+            source._search_text = [];
+            for (let r = 0; r < n_rows; r++)
+                source._search_text.push(cols.map((col) => source.data[col][r])
+                                         .join('\\t').toLowerCase());
+            source._search_data = source.data;
+        }
+        const rows = [];
+        for (let r = 0; r < n_rows; r++) {
+            let keep = true;
+            for (const mode in luts) {
+                for (const categ in luts[mode]) {
+                    if ((luts[mode][categ][c[categ][r]] === 1) ==
+                            (mode == 'exclude')) {
+                        keep = false;
+                        break;
+                    }
+                }
+            }
+            if (keep && term && !source._search_text[r].includes(term))
+                keep = false;
+            if (keep)
+                rows.push(r);
+        }
+        return rows;
+    }
 
-col_dict = {
-    'Name': 'submitter',
-    'Description': 'desc',
-    'Lab': 'lab',
-    'Benchling File': 'benchling_url',
-    'Entry #': 'entry',
-    'Organism': 'organism',
-    'Marker 1': 'marker1',
-    'Marker 2': 'marker2',
-    'Origin': 'origin',
-    'Origin 2': 'origin2',
-    'Plasmid': 'plasmid',
-    'Promoter': 'promoter',
-    'Strain': 'strain',
-}
-col_dict_r = {col_dict[i]: i for i in col_dict}
-
-table_cols = OrderedDict([
-    ('lab', {'width': 70}),
-    ('entry', {'width': 38}),
-    ('organism', {'width': 60}),
-    ('strain', {'width': 80}),
-    ('plasmid', {'width': 165}),
-    ('marker1', {'width': 55}),
-    ('marker2', {'width': 55}),
-    ('origin', {'width': 55}),
-    ('origin2', {'width': 45}),
-    ('promoter', {'width': 60}),
-    ('benchling_url', {'width': 90}),
-    ('desc', {'width': 320}),
-    ('submitter', {'width': 70})])
-
-
-def get_gsheet_dict():
-    """Get dictionary of sheet_name: sheet object."""
-    scope = ['https://spreadsheets.google.com/feeds',
-             'https://www.googleapis.com/auth/drive']
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        CREDS_JSON, scope)
-
-    gc = gspread.authorize(credentials)
-    # display('List spreadsheet files:', gc.list_spreadsheet_files())
-    file = gc.open("C-GEM strains list")
-    wsheets = file.worksheets()
-    sheet_dict = OrderedDict([(i.title, i) for i in wsheets])
-    return sheet_dict
-
-
-def load_df(load_gsheet=False):
-    """Load COMPLETE strains dataframe from Google Sheets or local file."""
-    if os.path.exists(FEATHER_PATH) and not load_gsheet:
-        df = pd.read_feather(FEATHER_PATH)
-        df = df[[i for i in table_cols]]
-        return df
-    # labs = [i for i in sheet_dict if i != 'Introduction']
-    sheet_dict = get_gsheet_dict()
-    df_list = []
-    # headers_lists = []
-    for lab in LABS:
-        sheet = sheet_dict[lab]
-        vals = sheet.get_all_records()
-        # headers_lists.append(sheet.row_values(1))
-        # print('headers: %s' % headers)
-        vals = [i for i in vals if set(i.values()) != {''}]  # remove empty rows
-        temp_df = pd.DataFrame(vals, dtype=str)
-        temp_df.insert(0, 'Lab', lab)
-        df_list.append(temp_df)
-    # GET FULL COLUMN SET (in case not exact duplicates)
-    all_cols = []
-    for temp_df in df_list:
-        for header in temp_df.columns:
-            if header not in all_cols:
-                all_cols.append(header)
-    # print('Columns: %s' % all_cols)
-    df = pd.concat(df_list, axis=0, ignore_index=True, sort=False)[all_cols]
-    df.rename(columns=col_dict, inplace=True)
-    df = df[[i for i in table_cols]].copy()
-    df = df.applymap(lambda v: '<blank>' if v == '' else v)
-    df.to_feather(FEATHER_PATH)
-    return df
-
-
-def counts_from_strains(strains, pairs_df=None):
-    """Get counts dataframe from strains table."""
-    n_strains = len(strains)
-    count_name = 'n'
-    count_list = []
-    for col in PLOT_COLS:
-        if col == LAB_COL:
-            vc = strains[col].value_counts().reindex(LABS, fill_value=0).sort_values(ascending=False)
-        else:
-            vc = strains[col].value_counts()
-        # if (vc > 1).any() & (len(vc) < 10):
-        vc.index.name = 'val'
-        vc.name = 'n'
-        if len(vc) > 1:
-            s_all = pd.Series(name='n', 
-                              index=pd.Index(name='val', data=['All']), 
-                              data=[n_strains])
-            vc = s_all.append(vc)
-        vcd = vc.reset_index()
-        vcd.insert(0, 'categ', col)
-        count_list.append(vcd)
-    counts = pd.concat(count_list, axis=0, ignore_index=True, sort=False)
-    if pairs_df is not None:
-        counts = pairs_df.merge(counts, how='left', on=['categ', 'val']).fillna(0)
-    return counts
-
-
-def update_data_dict(data_dict=None, strains=None, write_orig=False):
-    data_dict['current'] = strains
-    if write_orig:
-        # Update all data
-        data_dict['df'] = strains.copy()
-        counts = counts_from_strains(strains)
-        data_dict['counts'] = counts.copy()
-        data_dict['pairs_df'] = counts[['categ', 'val']]
-    else:
-        # Update counts but don't overwrite pairs_df.
-        counts = counts_from_strains(strains, pairs_df=data_dict['pairs_df'])
-        data_dict['counts'] = counts.copy()
-    return
-
+    function selected_modes() {
+        // {JSON of [categ, val]: mode} of selected bars
+        const modes = {};
+        const sel = selected.data;
+        for (let i = 0; i < (sel.categ_val || []).length; i++)
+            modes[JSON.stringify(sel.categ_val[i])] = sel.mode[i];
+        return modes;
+    }
+    """
+client_select_code = client_rows_code + """
+    /* mark newly selected bars as included or excluded, per filter_mode, as
+       on_select on the server. Bars selected by the server are already in
+       source_sel, so keep their marks. */
+    const bar_modes = selected_modes();
+    const mode = modes[filter_mode.active];
+    const orig_n = {};
+    for (let i = 0; i < counts_orig.data.categ_val.length; i++)
+        orig_n[JSON.stringify(counts_orig.data.categ_val[i])] =
+            counts_orig.data.n[i];
+    const data = {categ_val: [], n: [], mode: []};
+    for (const i of counts.selected.indices) {
+        const pair = counts.data.categ_val[i];
+        const key = JSON.stringify(pair);
+        data.categ_val.push(pair);
+        data.n.push(orig_n[key] || 0);
+        data.mode.push(key in bar_modes ? bar_modes[key] : mode);
+    }
+    if (JSON.stringify([data.categ_val, data.mode]) !== JSON.stringify(
+            [selected.data.categ_val, selected.data.mode]))
+        selected.data = data;
+    """
+client_filter_code = client_rows_code + """
+    /* table view: rows found by client_update_code, unless strains changed */
+    const view = codes._view_rows;
+    if (view !== undefined && view.data === source.data)
+        return view.rows;
+    return client_rows() || [...Array(source.get_length() || 0).keys()];
+    """
+client_update_code = client_rows_code + """
+    /* filter strains in the browser, on changes of selection, search term or
+       bars: recount bars as data.counts_from_codes, keep the
+       filter key (as filters.filter_key) in the page URL, and update the
+       table view */
+    const rows = client_rows();
+    if (rows !== null) {
+        codes._view_rows = {rows: rows, data: source.data};
+        recount(rows);
+        const query = client_filter_key();
+        window.history.replaceState(
+            null, '', window.location.pathname + (query ? '?' + query : ''));
+    }
+    source.change.emit();
+
+    function recount(rows) {
+        // recount bars for remaining rows
+        const c = codes.data;
+        const b = bars.data;
+        const bar_n = counts.data.n;
+        if (bar_n.length == b.categ.length) {
+            const col_n = {};
+            for (let i = 0; i < b.categ.length; i++) {
+                const categ = b.categ[i];
+                if (categ in col_n)
+                    continue;
+                const n = new Int32Array(b.n_values[i]);
+                const col_codes = c[categ];
+                for (const r of rows)
+                    if (col_codes[r] >= 0)
+                        n[col_codes[r]]++;
+                col_n[categ] = n;
+            }
+            const other_n = {};  // rows not counted by a value's own bar
+            for (const categ in col_n)
+                other_n[categ] = col_n[categ].reduce((x, y) => x + y, 0);
+            for (let i = 0; i < bar_n.length; i++) {
+                const n = col_n[b.categ[i]];
+                if (b.is_all[i]) {
+                    const n_vals = b.categ[i] == lab_col ? n.length :
+                        n.filter((x) => x > 0).length;
+                    bar_n[i] = n_vals > 1 ? rows.length : 0;
+                } else if (!b.is_other[i]) {
+                    bar_n[i] = b.code[i] >= 0 ? n[b.code[i]] : 0;
+                    other_n[b.categ[i]] -= bar_n[i];
+                }
+            }
+            for (let i = 0; i < bar_n.length; i++)
+                if (b.is_other[i])
+                    bar_n[i] = other_n[b.categ[i]];
+            counts.change.emit();
+        }
+    }
 
-def get_refresh_msg():
-    """Get modification time message to accompany refresh button."""
-    modtime = dt.datetime.utcfromtimestamp(os.path.getmtime(FEATHER_PATH))
-    modtime_str = modtime.strftime('%Y-%m-%d %H:%M:%S')
-    return 'Spreadsheet last loaded at {} UTC.'.format(modtime_str)
+    function client_filter_key() {
+        // urlencode of filter_key quotes as urllib.parse.quote_plus
+        const quote = (s) => encodeURIComponent(s).replace(/[!'()*]/g,
+            (ch) => '%' + ch.charCodeAt(0).toString(16).toUpperCase())
+            .replace(/%20/g, '+');
+        const bar_modes = selected_modes();
+        const selection = {include: {}, exclude: {}};
+        for (const i of counts.selected.indices) {
+            const [categ, val] = counts.data.categ_val[i];
+            const mode = bar_modes[JSON.stringify([categ, val])] == 'exclude'
+                ? 'exclude' : 'include';
+            const vals = selection[mode];
+            if (val != all_val)
+                (vals[categ] = vals[categ] || []).push(val);
+        }
+        const args = [];
+        for (const mode of ['include', 'exclude']) {
+            const prefix = mode == 'exclude' ? exclude_prefix : '';
+            for (const categ of Object.keys(selection[mode]).sort())
+                for (const val of selection[mode][categ].sort())
+                    args.push(quote(prefix + categ) + '=' + quote(val));
+        }
+        const expanded = expand_group.active.map((i) => expand_group.labels[i]);
+        for (const categ of expanded.sort())
+            args.push(expand_arg + '=' + quote(categ));
+        const term = search_input.value.trim();
+        if (term)
+            args.push(search_arg + '=' + quote(term));
+        return args.join('&');
+    }
+    """
+activity_code = """
+    /* report user activity to the server at most every ping_ms, delaying
+       expiry of the idle session (see sessions.py) */
+    const now = Date.now();
+    if (now - (activity._last_ping || 0) >= ping_ms) {
+        activity._last_ping = now;
+        activity.text = String(now);
+    }
+    """
 
 
-def initialize_counts_fig(counts):
-    """Create bar plot from counts dataframe."""
-    group = counts.groupby(['categ', 'val'])
-    counts_x = [(i.categ, i.val) for ind, i in counts[['categ', 'val']].iterrows()]  # for xrange
+def initialize_counts_fig(layout):
+    """Create bar plot from precomputed layout metadata (see data.py)."""
+    counts = layout['counts']
+    counts_x = list(zip(counts['categ'], counts['val']))  # for xrange
 
-    source_c = ColumnDataSource(group)
-    source_c_orig = ColumnDataSource(group)  # will hold persistent original counts
+    source_c = ColumnDataSource(counts_source_data(counts))
+    # will hold persistent original counts
+    source_c_orig = ColumnDataSource(counts_source_data(counts))
+    # selected bars, with full counts, marked by filter mode
+    source_sel = ColumnDataSource(data=dict(categ_val=[], n=[], mode=[]))
 
-    index_cmap = factor_cmap('categ_val', palette=Spectral8, factors=counts.categ.unique(), end=1)
+    index_cmap = factor_cmap('categ_val', palette=Spectral8, factors=layout['categs'], end=1)
 
     p = figure(plot_width=FIG_WIDTH, plot_height=FIG_HEIGHT, title="",
-               x_range=FactorRange(*counts_x), toolbar_location=None, tools="tap",)
+               x_range=FactorRange(*counts_x), toolbar_location=None, tools="",)
 
-    p.vbar(x='categ_val', top='n_max', width=1, source=source_c_orig,
+    p.vbar(x='categ_val', top='n', width=1, source=source_c_orig,
            **bar_bg_dict)
-    bars_front = p.vbar(x='categ_val', top='n_max', width=1, source=source_c,
+    bars_front = p.vbar(x='categ_val', top='n', width=1, source=source_c,
                         line_color="white", fill_color=index_cmap, )
+    p.vbar(x='categ_val', top='n', width=1, source=source_sel,
+           fill_color=None, line_color=None, hatch_color='black',
+           hatch_alpha=0.6, hatch_pattern=factor_hatch('mode', MODE_HATCH,
+                                                       MODES))
     p.yaxis.axis_label = "Number of strains"
     p.yaxis.axis_label_text_font_size = "10pt"
     p.y_range.start = 0
@@ -226,29 +356,59 @@ def initialize_counts_fig(counts):
     p.xaxis.group_text_font_size = "10pt"
     p.yaxis.major_label_text_font_size = "10pt"
     p.outline_line_color = None
-    p.add_tools(HoverTool(tooltips=[("Count", "@n_max"), ("selector", "@categ_val")],
+    p.add_tools(HoverTool(tooltips=[("Count", "@n"), ("selector", "@categ_val")],
                           renderers=[bars_front]))
-    return p, source_c, source_c_orig
+    p.add_tools(TapTool(renderers=[bars_front]))
+    return p, source_c, source_c_orig, source_sel
 
 
-df = load_df(load_gsheet=False)
+df, manifest = load_snapshot(load_gsheet=False)
+layout = manifest['layout']
 data_dict = {}
-update_data_dict(data_dict=data_dict, strains=df, write_orig=True)
+update_data_dict(data_dict=data_dict, strains=df, write_orig=True,
+                 layout=layout)
+data_dict['version'] = manifest['version']
+data_dict['expanded'] = []
+session_id = None  # set if served by bokeh server
+_syncing = False  # True while widgets are set from server-side state
 
 source_s = ColumnDataSource(data=dict())  # strain data
-p_counts, source_c, source_c_orig = initialize_counts_fig(data_dict['counts'])
+p_counts, source_c, source_c_orig, source_sel = initialize_counts_fig(layout)
 columns = []  # FOR DataTable
-for col in data_dict['df'].columns:
+for col in layout['columns']:
     if col in LINK_COLS:
         columns.append(TableColumn(field=col, title=col, 
             formatter=HTMLTemplateFormatter(template=url_template), **table_cols[col]))
     else:
         columns.append(TableColumn(field=col, title=col, 
             formatter=HTMLTemplateFormatter(template=cell_template), **table_cols[col]))
-data_table = DataTable(source=source_s, columns=columns, width=FIG_WIDTH)
 # DATA REFRESH WIDGETS
 button_refresh = Button(label="Refresh data", button_type="warning")
-text_refresh = Div(text=get_refresh_msg())
+text_refresh = Div(text=get_status_msg(manifest))
+# FILTER WIDGETS: show or hide strains matching bars selected next; search
+filter_mode = RadioButtonGroup(labels=FILTER_MODES, active=0)
+search_input = TextInput(placeholder='Search strains', width=300)
+expand_group = CheckboxButtonGroup(labels=list(data_dict['other']), active=[],
+                                   visible=bool(data_dict['other']))
+url_state = Div(text='', visible=False)  # filter key, mirrored to page URL
+activity = Div(text='', visible=False)  # time of user activity, client mode
+export_menu = Dropdown(label='Export', menu=EXPORT_MENU, width=90)
+# BASKET: request strains selected in table (shift/ctrl-click for several)
+button_basket = Button(label=BASKET_LABEL, button_type='primary',
+                       disabled=True, width=160)
+# CLIENT-SIDE FILTERING: codes of plotted columns, and of each bar's value
+source_codes = ColumnDataSource(data=dict())
+source_bars = ColumnDataSource(data=dict())
+if CLIENT_FILTERING:
+    table_view = CDSView(source=source_s, filters=[CustomJSFilter(
+        args=dict(codes=source_codes, bars=source_bars, counts=source_c,
+                  selected=source_sel, search_input=search_input,
+                  lab_col=LAB_COL),
+        code=client_filter_code)])
+else:
+    table_view = CDSView(source=source_s)
+data_table = DataTable(source=source_s, view=table_view, columns=columns,
+                       width=FIG_WIDTH)
 
 
 # UPDATES
@@ -259,79 +419,360 @@ def update_sources(data_dict, update_orig=False):
     new_dict = {col: list(current[col].replace('<blank>', ''))
                 for col in current.columns}
     source_s.data = new_dict
-    # UPDATE COUNTS LIST FROM NEW STRAIN LIST
-    group = data_dict['counts'].groupby(['categ', 'val'])
-    new_counts_dict = OrderedDict(ColumnDataSource(group).data)
+    source_s.selected.indices = []  # rows changed
+    update_counts_sources(data_dict, update_orig=update_orig)
+
+
+def update_counts_sources(data_dict, update_orig=False):
+    """Update counts data source, and bars in full data if update_orig."""
+    new_counts_dict = counts_source_data(data_dict['counts'])
     source_c.data = new_counts_dict
     if update_orig:
-        counts_x = [(i.categ, i.val) for ind, i in data_dict['pairs_df'].iterrows()]
+        counts_x = new_counts_dict['categ_val']
         p_counts.x_range.factors = counts_x
         source_c_orig.data = new_counts_dict.copy()
 
 
-def refresh_data(data_dict):
-    """Data refresh button response: fetch new data from gsheet, update page."""
-    text_refresh.text = 'Loading...'
-    df = load_df(load_gsheet=True)
-    text_refresh.text = get_refresh_msg()
-    update_data_dict(data_dict=data_dict, strains=df, write_orig=True)
+def update_client_sources(data_dict):
+    """Send full strains data and codes to browser, for client filtering."""
+    codes = data_dict['codes']
+    pairs_df = data_dict['pairs_df']
+    # codes before strains, whose update triggers filtering in the browser
+    source_codes.data = {col: codes[col][0].astype('int32')
+                         for col in PLOT_COLS}
+    pairs = zip(pairs_df['categ'], pairs_df['val'])
+    source_bars.data = bar_codes(codes, pairs)
+    data_dict['current'] = data_dict['df']
     update_sources(data_dict, update_orig=True)
 
 
+def set_expanded(data_dict, categs):
+    """Set full counts and bars, with 'Other' bars of categs expanded."""
+    categs = [i for i in categs if i in data_dict['other']]
+    data_dict['expanded'] = categs
+    counts = expand_counts(data_dict['counts_orig'], data_dict['codes'],
+                           data_dict['other'], categs)
+    data_dict['counts'] = counts
+    data_dict['pairs_df'] = counts[['categ', 'val']]
+
+
+def show_expanded(data_dict, categs):
+    """Show bars with 'Other' bars of categs expanded."""
+    set_expanded(data_dict, categs)
+    if CLIENT_FILTERING:
+        pairs_df = data_dict['pairs_df']
+        source_bars.data = bar_codes(
+            data_dict['codes'], zip(pairs_df['categ'], pairs_df['val']))
+    update_counts_sources(data_dict, update_orig=True)
+
+
+def on_expand_change(attr, old, new):
+    """Expand or collapse 'Other' bars, keeping selected values."""
+    if _syncing:
+        return
+    touch_session()
+    state = get_filter_state()
+    show_expanded(data_dict, [expand_group.labels[i] for i in new])
+    # selected 'Other' bars become selections of each of their values
+    expanded = {i: data_dict['other'][i] for i in data_dict['expanded']}
+    state['selection'] = expand_other(state['selection'], expanded)
+    state['excluded'] = expand_other(state['excluded'], expanded)
+    set_filter_state(state)
+    apply_filters(data_dict)
+
+
+def refresh_data(data_dict):
+    """Data refresh button response: check gsheet for changes, update page.
+
+    The check runs in a thread, so that it doesn't block other sessions.
+    """
+    touch_session()
+    text_refresh.text = 'Checking for changes...'
+    doc = curdoc()
+
+    def run_refresh():
+        refresh()
+        doc.add_next_tick_callback(lambda: check_data_version(data_dict))
+    threading.Thread(target=run_refresh, daemon=True).start()
+
+
+def check_data_version(data_dict):
+    """Load latest snapshot if newer than session data, keeping filters."""
+    if not data_dict:
+        return  # session expired
+    if get_data_version() not in (None, data_dict['version']):
+        state = get_filter_state()
+        df, manifest = load_snapshot(load_gsheet=False)
+        update_data_dict(data_dict=data_dict, strains=df, write_orig=True,
+                         layout=manifest['layout'])
+        data_dict['version'] = manifest['version']
+        set_expanded(data_dict, data_dict['expanded'])
+        with syncing_widgets():
+            expand_group.labels = list(data_dict['other'])
+            set_expand_group(data_dict['expanded'])
+        expand_group.visible = bool(data_dict['other'])
+        if CLIENT_FILTERING:
+            update_client_sources(data_dict)
+        else:
+            update_sources(data_dict, update_orig=True)
+        set_filter_state(state)
+        apply_filters(data_dict)
+    text_refresh.text = get_status_msg()
+
+
+@contextmanager
+def syncing_widgets():
+    """Set widgets without running their filter callbacks."""
+    global _syncing
+    _syncing = True
+    try:
+        yield
+    finally:
+        _syncing = False
+
+
+def selected_modes():
+    """Get {(categ, val): mode} of selected bars."""
+    data = source_sel.data
+    return OrderedDict((tuple(pair), mode) for pair, mode
+                       in zip(data['categ_val'], data['mode']))
+
+
+def set_selected_bars(modes):
+    """Mark bars in {(categ, val): mode} as selected, with full counts."""
+    counts_orig = source_c_orig.data
+    n_orig = {tuple(pair): n for pair, n
+              in zip(counts_orig['categ_val'], counts_orig['n'])}
+    source_sel.data = dict(categ_val=list(modes),
+                           n=[n_orig.get(i, 0) for i in modes],
+                           mode=list(modes.values()))
+
+
+def get_filter_state():
+    """Get filter state from bar selection and filter widgets."""
+    categ_val = source_c.data['categ_val']
+    modes = selected_modes()
+    pairs = OrderedDict((mode, []) for mode in MODES)  # (categ, val) tuples
+    for ind in source_c.selected.indices:
+        pair = tuple(categ_val[ind])
+        pairs[modes.get(pair, MODES[0])].append(pair)
+    return new_filter_state(selection=selection_from_pairs(pairs['include']),
+                            excluded=selection_from_pairs(pairs['exclude']),
+                            search=search_input.value.strip(),
+                            expanded=data_dict.get('expanded'))
+
+
+def set_filter_state(state):
+    """Set bar selection and filter widgets from filter state.
+
+    Filters are not applied: callers apply them once all widgets are set.
+    """
+    inds = []
+    modes = OrderedDict()
+    for ind, (categ, val) in enumerate(source_c.data['categ_val']):
+        for mode, key in zip(MODES, ['selection', 'excluded']):
+            if val in state[key].get(categ, ()):
+                inds.append(ind)
+                modes[(categ, val)] = mode
+                break
+    with syncing_widgets():
+        set_selected_bars(modes)  # before indices, read by client callbacks
+        source_c.selected.indices = inds
+        search_input.value = state['search']
+
+
+def set_expand_group(categs):
+    """Set active expand buttons to those of categs."""
+    expand_group.active = [expand_group.labels.index(i) for i in categs]
+
+
+def get_session_arg(name, default=''):
+    """Get argument of the request that created this session."""
+    session_context = curdoc().session_context
+    request = getattr(session_context, 'request', None)
+    args = getattr(request, 'arguments', None) or {}
+    return args.get(name, [default.encode('utf-8')])[0].decode('utf-8')
+
+
+def get_url_filter_state():
+    """Get filter state from the request that created this session."""
+    return parse_filter_key(get_session_arg(FILTER_ARG), PLOT_COLS)
+
+
+def filter_result(data_dict, state):
+    """Get (rows, counts) of strains matching filter state.
+
+    Results are shared across sessions via RESULT_CACHE, keyed by data
+    version and filter key (which includes expanded categories, as they
+    change the bars).
+    """
+    cache_key = (data_dict['version'], filter_key(state))
+    res = RESULT_CACHE.get(cache_key)
+    if res is None:
+        if state['search'] and 'search_text' not in data_dict:
+            data_dict['search_text'] = build_search_text(data_dict['df'])
+        rows = filter_rows(data_dict['codes'], state,
+                           search_text=data_dict.get('search_text'),
+                           other=data_dict['other'])
+        counts = counts_from_codes(data_dict['codes'], rows,
+                                   data_dict['pairs_df'],
+                                   other=data_dict['other'])
+        res = (rows, counts)
+        RESULT_CACHE.put(cache_key, res)
+    return res
+
+
 def plot_select(data_dict):
-    # prog_list.append('called plot_select')
-    inds = list(source_c.selected.indices)
-    current = data_dict['df']  # full strains list, for filtering
-    if inds:
-        # FILTER DATA BASED ON SELECTED INDICES IN COUNTS PLOT
-        # prog_list.append('no inds')
-        s = source_c.data['categ_val'][inds]  # array of (categ, val) tuples
-        categs, vals = zip(*s)
-        sd = pd.DataFrame({'categ': categs, 'val': vals})
-        sd = sd[sd.val != 'All']  # ignore 'All' selections.
-        filter_dict = sd.groupby('categ')['val'].apply(set).to_dict()
-        for categ in filter_dict:
-            current = current[current[categ].isin(filter_dict[categ])]
-        # prog_list.append(str(s))
-        # text_div.text = '; '.join([str((categ, val)) for categ, val in s])
-        # prog_list.append('updated text_div')
-        for categ, val in s:
-            if val == 'All':
-                continue
-            # prog_list.append((categ, val))
-            current = current[current[categ] == val]
-    update_data_dict(data_dict=data_dict, strains=current, write_orig=False)
+    """Filter strains by selected bars and search term.
+
+    The filter key is mirrored to the page URL.
+    """
+    state = get_filter_state()
+    rows, counts = filter_result(data_dict, state)
+    data_dict['current'] = data_dict['df'].iloc[rows]
+    data_dict['counts'] = counts
     update_sources(data_dict)
+    url_state.text = filter_key(state)
+
+
+def touch_session():
+    """Record user activity, delaying expiry of idle session."""
+    if session_id is not None:
+        sessions.touch(session_id)
+
+
+def apply_filters(data_dict):
+    """Filter strains on server, unless filtered in the browser."""
+    if not CLIENT_FILTERING:
+        plot_select(data_dict)
+
+
+def on_filter_change(attr, old, new):
+    if _syncing:
+        return
+    touch_session()
+    apply_filters(data_dict)
+
+
+def on_select(attr, old, new):
+    """Mark newly selected bars with the filter mode, then filter."""
+    if _syncing:
+        return
+    categ_val = source_c.data['categ_val']
+    prev = selected_modes()
+    modes = OrderedDict()
+    for ind in new:
+        pair = tuple(categ_val[ind])
+        modes[pair] = prev.get(pair, MODES[filter_mode.active])
+    set_selected_bars(modes)
+    on_filter_change(attr, old, new)
+
+
+def on_activity(attr, old, new):
+    touch_session()
 
 
-source_c.selected.on_change('indices', lambda attr, old, new: plot_select(data_dict))
+def release_session(session_context, data_dict=data_dict):
+    """Drop references to session data once the session ends."""
+    data_dict.clear()
+
+
+def expire_session():
+    """Release data of idle or evicted session, asking user to reload."""
+    release_session(None)
+    source_s.data = {}
+    source_codes.data = {}
+    doc = curdoc()
+    doc.remove_periodic_callback(check_callback)
+    doc.clear()
+    doc.add_root(Div(text=EXPIRED_MSG))
+
+
+# filters from page URL: expand 'Other' bars first, so values shown only
+# while expanded can be selected
+url_filter_state = get_url_filter_state()
+show_expanded(data_dict, url_filter_state['expanded'])
+set_expand_group(data_dict['expanded'])
+set_filter_state(url_filter_state)
+expand_group.on_change('active', on_expand_change)
 button_refresh.on_click(lambda: refresh_data(data_dict))
-update_sources(data_dict)
+if CLIENT_FILTERING:
+    update_client_sources(data_dict)
+    # bars for filters from page URL; recounted in the browser from now on
+    data_dict['counts'] = filter_result(data_dict, get_filter_state())[1]
+    update_counts_sources(data_dict)
+    client_select = CustomJS(
+        args=dict(counts=source_c, counts_orig=source_c_orig,
+                  selected=source_sel, filter_mode=filter_mode,
+                  modes=MODES),
+        code=client_select_code)
+    client_update = CustomJS(
+        args=dict(source=source_s, codes=source_codes, bars=source_bars,
+                  counts=source_c, selected=source_sel,
+                  search_input=search_input, expand_group=expand_group,
+                  lab_col=LAB_COL, all_val=ALL_VAL,
+                  exclude_prefix=EXCLUDE_PREFIX, expand_arg=EXPAND_ARG,
+                  search_arg=SEARCH_ARG),
+        code=client_update_code)
+    ping = CustomJS(args=dict(activity=activity, ping_ms=ACTIVITY_PING_MS),
+                    code=activity_code)
+    source_c.selected.js_on_change('indices', client_select, client_update,
+                                   ping)
+    filter_mode.js_on_change('active', ping)
+    search_input.js_on_change('value', client_update, ping)
+    source_c.js_on_change('data', client_update)  # new bars from server
+    activity.on_change('text', on_activity)
+else:
+    source_c.selected.on_change('indices', on_select)
+    filter_mode.on_change('active', on_activity)
+    search_input.on_change('value', on_filter_change)
+    apply_filters(data_dict)
+
+url_state.js_on_change('text', CustomJS(code="""
+    /* keep filter state in page URL, for bookmarking and sharing */
+    var query = cb_obj.text;
+    var url = window.location.pathname + (query ? '?' + query : '');
+    window.history.replaceState(null, '', url);
+    """))
+
+export_menu.js_on_event('menu_item_click', CustomJS(
+    args=dict(export_url=get_session_arg(EXPORT_ARG, EXPORT_URL)), code="""
+    /* download filtered strains, streamed by the Flask app, given the
+       filter key in the page URL */
+    window.location.href = export_url + cb_obj.item + window.location.search;
+    """))
 
 source_s.selected.js_on_change('indices', CustomJS(
+    args=dict(button=button_basket, label=BASKET_LABEL), code="""
+    var n = cb_obj.indices.length;
+    button.disabled = (n == 0);
+    button.label = n > 1 ? label + ' (' + n + ')' : label;
+    """))
+
+button_basket.js_on_click(CustomJS(
     args=dict(source=source_s, col_names=list(table_cols)), code="""
-    var inds = cb_obj.indices;
-    if (inds.length == 1){
-        /* update form with data from selected row */
-        var use_ind = inds[0]
-        var $form = document.getElementById('ship-form');
-        var el_dict = $form.getElementsByTagName('input');
-        for (var col_ind = 0; col_ind < col_names.length; col_ind++){
-            var var_name = col_names[col_ind];
-            el_dict[var_name].value = source.data[var_name][use_ind];
-        }
-        $form.submit()
-    }
-    else {
-        console.log('Multiple rows selected: ' + inds);
+    /* post selected rows to request form, as one basket */
+    var rows = [];
+    for (const ind of source.selected.indices) {
+        var row = {};
+        for (const col of col_names)
+            row[col] = source.data[col][ind];
+        rows.push(row);
     }
+    if (rows.length == 0)
+        return;
+    var $form = document.getElementById('ship-form');
+    $form.elements['strains'].value = JSON.stringify(rows);
+    $form.submit();
     """))
 
 
 # LAYOUT
 table_row = row(data_table, sizing_mode="scale_width")  # (inputs, table)
+filter_row = row(search_input, filter_mode, expand_group, export_menu,
+                 button_basket, url_state, activity)
 refresh_row = row(button_refresh, text_refresh)
-full = column(p_counts, table_row, refresh_row,
+full = column(p_counts, filter_row, table_row, refresh_row,
               sizing_mode="scale_width")  # widgetbox(text_div)
 
 
@@ -340,9 +781,17 @@ if __name__ != '__main__':
     curdoc().title = "Strains dashboard"
     curdoc().add_root(full)
     curdoc().template_variables["col_names"] = list(table_cols)
+    check_callback = curdoc().add_periodic_callback(
+        lambda: check_data_version(data_dict), SESSION_CHECK_MS)
+    if curdoc().session_context is not None:
+        doc = curdoc()
+        session_id = doc.session_context.id
+        doc.on_session_destroyed(release_session)
+        sessions.register(
+            session_id, lambda: doc.add_next_tick_callback(expire_session))
 
 else:
-    from bokeh.io import output_notebook
+    from bokeh.io import show, output_notebook
     output_notebook()
 
     def make_doc(doc):
@@ -0,0 +1,140 @@
+"""Change detection and scheduled refresh of the strains data.
+
+Instead of downloading every worksheet on each refresh, the Drive metadata of
+the strains spreadsheet (its 'version', which increases with every edit) is
+checked first, and the worksheets are only fetched when it changed, or when
+the value vocabulary changed (see data.refresh_snapshot, which then only
+rewrites changed lab partitions).
+
+Each Bokeh server process runs a background thread (start_scheduler, called
+from app_hooks.py) that checks for changes every REFRESH_INTERVAL seconds,
+with random jitter, and with exponential backoff after failures. The refresh
+button calls the same refresh function. Refreshes are 'single-flight': calls
+made while a refresh is running wait for it and share its result, so
+concurrent clicks and scheduled checks result in a single fetch. Across server
+processes, refreshes hold the snapshot write lock, and a process that waited
+for it finds the new spreadsheet version in the manifest without refetching.
+
+Sessions pick up new snapshot versions from disk (see main.py).
+"""
+
+import time
+import random
+import logging
+import threading
+import datetime as dt
+
+from . import data, snapshot
+
+MAX_BACKOFF = 3600  # longest delay between checks after repeated failures
+JITTER = 0.2  # delays vary randomly by up to +/- 20%
+
+log = logging.getLogger(__name__)
+
+status = {
+    'last_check': None,  # UTC time of last successful check
+    'source_version': None,  # spreadsheet version of last check
+    'error': None,  # message of last failed check, if any
+    'n_failures': 0,  # consecutive failed checks
+    'generation': 0,  # number of completed refresh attempts
+}
+_lock = threading.Lock()  # held while refreshing
+_start_lock = threading.Lock()
+_thread = None
+
+
+def _utc_now():
+    return dt.datetime.utcnow().strftime(snapshot.TIME_FORMAT)
+
+
+def _refresh(check_source=True):
+    """Fetch worksheets if spreadsheet metadata changed. Returns manifest."""
+    manifest = snapshot.read_manifest(data.SNAPSHOT_DIR)
+    extra = {}
+    if check_source:
+        try:
+            meta = data.get_sheet_metadata()
+        except Exception as e:
+            # e.g. no Drive API access: fall back to comparing worksheets
+            log.warning('Spreadsheet metadata unavailable: %s', e)
+        else:
+            extra = {'source_version': meta['version'],
+                     'source_modified': meta['modifiedTime']}
+            known = {status['source_version'],
+                     manifest and manifest.get('source_version')}
+            if manifest is not None and meta['version'] in known and \
+                    not data.vocabulary_changed(manifest):
+                status['last_check'] = _utc_now()
+                return manifest
+    manifest, changed = data.refresh_snapshot(**extra)
+    status['source_version'] = extra.get('source_version')
+    status['last_check'] = _utc_now()
+    if changed:
+        log.info('Strains data updated to version %s (changed: %s)',
+                 manifest['version'], ', '.join(changed))
+    return manifest
+
+
+def refresh(check_source=True):
+    """Refresh snapshot if spreadsheet changed. Returns latest manifest.
+
+    Single-flight: if a refresh is already running, wait for it and return
+    its result instead of fetching again. Failures are recorded in status
+    rather than raised.
+
+    Args:
+        check_source (bool): check spreadsheet metadata before fetching
+            worksheets. If False, always fetch and compare worksheets.
+    """
+    generation = status['generation']
+    with _lock:
+        if status['generation'] == generation:
+            try:
+                with snapshot.write_lock(data.SNAPSHOT_DIR):
+                    _refresh(check_source=check_source)
+                status['error'] = None
+                status['n_failures'] = 0
+            except Exception as e:
+                log.exception('Strains data refresh failed')
+                status['error'] = str(e)
+                status['n_failures'] += 1
+            finally:
+                status['generation'] += 1
+    return snapshot.read_manifest(data.SNAPSHOT_DIR)
+
+
+def next_delay(interval, n_failures=0):
+    """Get seconds until next check: jittered, with exponential backoff."""
+    delay = min(interval * 2 ** n_failures, max(interval, MAX_BACKOFF))
+    return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def _run_scheduler(interval):
+    while True:
+        time.sleep(next_delay(interval, status['n_failures']))
+        refresh()
+
+
+def start_scheduler(interval=None):
+    """Start background thread checking for changes, once per process.
+
+    Args:
+        interval (float): seconds between checks. Defaults to
+            data.REFRESH_INTERVAL. Zero disables scheduled checks.
+    """
+    global _thread
+    interval = data.REFRESH_INTERVAL if interval is None else interval
+    with _start_lock:
+        if _thread is not None or not interval:
+            return
+        _thread = threading.Thread(target=_run_scheduler, args=(interval,),
+                                   name='strains-refresh', daemon=True)
+        _thread.start()
+
+
+def get_status_msg(manifest=None):
+    """Get message on last change and last check, for text_refresh."""
+    msg = data.get_refresh_msg(manifest, last_check=status['last_check'])
+    if status['error']:
+        msg += ' Last check failed.'
+    return msg
@@ -0,0 +1,119 @@
+"""Registry of live Bokeh sessions in this server process.
+
+Bokeh runs main.py once per session, so each session holds its own data
+sources and data_dict. To keep memory bounded when serving many users
+(optionally with several server processes, see start_strains_bokeh.sh):
+- session data is released as soon as Bokeh destroys a session (after its
+    browser tab is closed, see app_hooks.py).
+- sessions without user interaction for SESSION_IDLE_TIMEOUT seconds are
+    expired: their data is released and the page asks the user to reload.
+- at most MAX_SESSIONS sessions are live per process. A new session expires
+    the least recently used ones.
+Session counts and the process's resident memory (RSS) are logged every
+STATS_INTERVAL seconds.
+"""
+
+import os
+import sys
+import time
+import logging
+import resource
+import threading
+from collections import OrderedDict
+
+from .data import MAX_SESSIONS, SESSION_IDLE_TIMEOUT
+
+STATS_INTERVAL = 60
+
+log = logging.getLogger(__name__)
+
+_sessions = OrderedDict()  # {session_id: session info}, least recent first
+_lock = threading.Lock()
+_n_expired = 0
+_n_destroyed = 0
+
+
+def register(session_id, expire_func):
+    """Add new session, expiring the least recently used if over the cap.
+
+    Args:
+        session_id (str): Bokeh session id.
+        expire_func (callable): releases the session's data. Called without
+            arguments, from any thread.
+    """
+    now = time.time()
+    with _lock:
+        _sessions[session_id] = {'created': now, 'last_active': now,
+                                 'expire': expire_func}
+        n_over = len(_sessions) - MAX_SESSIONS
+        evicted = list(_sessions)[:max(n_over, 0)]
+    for i in evicted:
+        expire(i)
+
+
+def touch(session_id):
+    """Record user interaction with session."""
+    with _lock:
+        if session_id in _sessions:
+            _sessions[session_id]['last_active'] = time.time()
+            _sessions.move_to_end(session_id)
+
+
+def expire(session_id):
+    """Release session data and remove session from live sessions."""
+    global _n_expired
+    with _lock:
+        info = _sessions.pop(session_id, None)
+        if info is not None:
+            _n_expired += 1
+    if info is not None:
+        info['expire']()
+
+
+def release(session_id):
+    """Forget session destroyed by Bokeh."""
+    global _n_destroyed
+    with _lock:
+        if _sessions.pop(session_id, None) is not None:
+            _n_destroyed += 1
+
+
+def expire_idle(timeout=SESSION_IDLE_TIMEOUT):
+    """Expire sessions without interaction for timeout seconds."""
+    cutoff = time.time() - timeout
+    with _lock:
+        idle = [i for i, info in _sessions.items()
+                if info['last_active'] < cutoff]
+    for i in idle:
+        expire(i)
+    return idle
+
+
+def get_rss():
+    """Get resident memory of this process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # peak rather than current RSS, in bytes on macOS, else kilobytes
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def get_stats():
+    """Get session counts and memory use of this process."""
+    with _lock:
+        n_live = len(_sessions)
+    return OrderedDict([
+        ('pid', os.getpid()),
+        ('live', n_live),
+        ('expired', _n_expired),
+        ('destroyed', _n_destroyed),
+        ('rss_mb', round(get_rss() / 2 ** 20, 1)),
+    ])
+
+
+def log_stats():
+    log.info('Strains sessions (pid %(pid)s): %(live)s live, %(expired)s '
+             'expired, %(destroyed)s destroyed; RSS %(rss_mb)s MB',
+             get_stats())
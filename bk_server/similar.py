@@ -0,0 +1,233 @@
+"""Lookup of similar strains, e.g. the same plasmid held by another lab.
+
+Strains are compared by the character NGRAM-grams of their SIMILAR_COLS
+(plasmid, strain and description), using MinHash signatures: N_HASHES
+minimum hash values per strain, the fraction of which two strains share
+estimates the Jaccard similarity of their n-gram sets. Signatures are
+computed once per distinct column value, and a strain's signature is the
+elementwise minimum of its columns' signatures (the signature of the union
+of their n-grams).
+
+Candidates are found by locality-sensitive hashing rather than by comparing
+a query with every strain: signatures are cut into N_BANDS bands, and
+strains sharing all hash values of any band with the query are ranked by
+estimated similarity. Each band is indexed as a sorted array of band keys, so
+a lookup is a binary search per band, plus the comparison of at most
+N_BANDS * MAX_BUCKET candidate signatures.
+
+The index is built in a background thread, started by the first call to
+get_index in a process (e.g. at Flask app startup), which returns None until
+it is ready. Snapshot versions are checked at most every INDEX_CHECK_INTERVAL
+seconds. When a new version is published, the index is rebuilt in the
+background too, and the previous index is used until it is ready.
+"""
+
+import time
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from . import snapshot
+from .data import SNAPSHOT_DIR, table_cols
+
+SIMILAR_COLS = ['plasmid', 'strain', 'desc']
+NGRAM = 3
+N_HASHES = 64
+N_BANDS = 16  # N_HASHES / N_BANDS hash values per band
+MAX_BUCKET = 200  # candidates taken from each band
+MIN_SIMILARITY = 0.2
+TOP_K = 5
+VALUE_CHUNK = 2000  # distinct values hashed at a time, bounds memory use
+INDEX_CHECK_INTERVAL = 5  # seconds between checks for new snapshot versions
+BLANK = '<blank>'
+EMPTY = np.iinfo(np.uint32).max  # signature of no n-grams
+
+log = logging.getLogger(__name__)
+
+# 64-bit random multipliers and offsets, for hashing 32-bit n-gram hashes
+_rs = np.random.RandomState(0)
+_HASH_A = _rs.randint(0, 2 ** 64, N_HASHES, dtype=np.uint64) | np.uint64(1)
+_HASH_B = _rs.randint(0, 2 ** 64, N_HASHES, dtype=np.uint64)
+_BAND_MULT = _rs.randint(1, 2 ** 63, N_HASHES // N_BANDS,
+                         dtype=np.uint64) | np.uint64(1)
+
+_index = None
+_building = None  # snapshot version being indexed in background, if any
+_thread = None  # background build thread
+_checked = 0  # time of last check for new snapshot version
+_lock = threading.Lock()
+
+
+def ngrams(text):
+    """Get set of character n-grams of text, lower case, spaces collapsed."""
+    text = ' {} '.format(' '.join(text.lower().split()))
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def signatures(values, seed=0):
+    """Get (n values, N_HASHES) array of MinHash signatures of values.
+
+    Blank values get signature EMPTY. seed distinguishes the n-grams of
+    different columns.
+    """
+    values = list(values)
+    sigs = np.full((len(values), N_HASHES), EMPTY, dtype=np.uint32)
+    for start in range(0, len(values), VALUE_CHUNK):
+        hashes = []
+        inds = []
+        offsets = []
+        for ind, value in enumerate(values[start:start + VALUE_CHUNK]):
+            grams = ngrams(value) if value != BLANK else ()
+            if grams:
+                inds.append(start + ind)
+                offsets.append(len(hashes))
+                hashes.extend(zlib.crc32(g.encode('utf-8'), seed)
+                              for g in grams)
+        if not inds:
+            continue
+        x = np.asarray(hashes, dtype=np.uint64)
+        # multiply-add-shift hashing: high 32 bits of (a * x + b) mod 2 ** 64
+        h = ((_HASH_A[:, None] * x[None, :] + _HASH_B[:, None]) >>
+             np.uint64(32)).astype(np.uint32)
+        sigs[inds] = np.minimum.reduceat(h, offsets, axis=1).T
+    return sigs
+
+
+def band_keys(sigs):
+    """Get (n, N_BANDS) array of hash keys of signature bands."""
+    bands = sigs.astype(np.uint64).reshape(len(sigs), N_BANDS, -1)
+    return (bands * _BAND_MULT).sum(axis=2)  # wraps mod 2 ** 64
+
+
+class SimilarityIndex(object):
+    """MinHash LSH index of strains dataframe (see module docstring)."""
+
+    def __init__(self, df, version=None):
+        self.df = df
+        self.version = version
+        sigs = np.full((len(df), N_HASHES), EMPTY, dtype=np.uint32)
+        for seed, col in enumerate(SIMILAR_COLS):
+            codes, uniques = pd.factorize(df[col].astype(str))
+            col_sigs = signatures(uniques, seed)
+            np.minimum(sigs, col_sigs[codes], out=sigs)
+        self.sigs = sigs
+        self.has_text = (sigs != EMPTY).any(axis=1)
+        keys = band_keys(sigs)
+        self.order = np.argsort(keys, axis=0, kind='stable').T
+        self.sorted_keys = np.take_along_axis(keys, self.order.T, axis=0).T
+        self.ids = pd.Index(df['lab'].astype(str) + '_' +
+                            df['entry'].astype(str))
+        self.id_rows = dict(zip(self.ids, range(len(df))))
+
+    def __len__(self):
+        return len(self.df)
+
+    def get_strain(self, strain_id):
+        """Get strain dict for strain id (lab_entry), or None if unknown."""
+        row = self.id_rows.get(strain_id)
+        return None if row is None else self._strain_dict(row)
+
+    def _strain_dict(self, row):
+        return OrderedDict(
+            (col, str(self.df[col].iat[row]).replace(BLANK, ''))
+            for col in table_cols)
+
+    def query(self, fields, k=TOP_K, exclude_id=None, exclude_lab=None):
+        """Get list of (row, similarity) of most similar strains to fields.
+
+        Args:
+            fields (dict): {col: value} of SIMILAR_COLS, e.g. a strain dict.
+            k (int): most results.
+            exclude_id (str): strain id (lab_entry) to leave out, e.g. the
+                strain being compared.
+            exclude_lab (str): lab whose strains are left out.
+        """
+        sig = np.full(N_HASHES, EMPTY, dtype=np.uint32)
+        for seed, col in enumerate(SIMILAR_COLS):
+            value = str(fields.get(col) or BLANK)
+            np.minimum(sig, signatures([value], seed)[0], out=sig)
+        if (sig == EMPTY).all():
+            return []
+        keys = band_keys(sig[None, :])[0]
+        cands = []
+        for band in range(N_BANDS):
+            sorted_keys = self.sorted_keys[band]
+            lo = np.searchsorted(sorted_keys, keys[band], side='left')
+            hi = np.searchsorted(sorted_keys, keys[band], side='right')
+            cands.append(self.order[band][lo:min(hi, lo + MAX_BUCKET)])
+        cands = np.unique(np.concatenate(cands))
+        cands = cands[self.has_text[cands]]
+        if exclude_id is not None:
+            cands = cands[self.ids[cands] != exclude_id]
+        if exclude_lab is not None:
+            cands = cands[(self.df['lab'].values[cands] != exclude_lab)]
+        if not len(cands):
+            return []
+        similarity = (self.sigs[cands] == sig).mean(axis=1)
+        keep = similarity >= MIN_SIMILARITY
+        cands, similarity = cands[keep], similarity[keep]
+        top = np.lexsort((cands, -similarity))[:k]
+        return [(int(cands[i]), float(similarity[i])) for i in top]
+
+    def similar(self, fields, k=TOP_K, exclude_id=None, exclude_lab=None):
+        """Get list of strain dicts most similar to fields, with 'similarity'.
+
+        See query for arguments. Blank cells are empty strings.
+        """
+        results = []
+        for row, similarity in self.query(fields, k, exclude_id, exclude_lab):
+            strain = self._strain_dict(row)
+            strain['similarity'] = round(similarity, 2)
+            results.append(strain)
+        return results
+
+
+def _build(manifest, snapshot_dir):
+    global _index, _building
+    try:
+        start = time.perf_counter()
+        df = snapshot.read_snapshot(snapshot_dir, manifest)
+        index = SimilarityIndex(df, version=manifest['version'])
+        with _lock:
+            _index = index
+        log.info('Indexed %s strains for similarity in %.1fs (version %s)',
+                 len(index), time.perf_counter() - start, index.version)
+    except Exception:
+        log.exception('Similarity index not updated')
+    finally:
+        with _lock:
+            _building = None
+
+
+def get_index(snapshot_dir=SNAPSHOT_DIR, wait=False):
+    """Get similarity index of latest snapshot, or None if not built yet.
+
+    Snapshot versions not yet indexed are indexed in a background thread,
+    meanwhile the previous index (if any) is returned.
+
+    Args:
+        snapshot_dir (str): snapshot directory.
+        wait (bool): wait for a running build to finish, e.g. in scripts.
+    """
+    global _building, _thread, _checked
+    now = time.time()
+    with _lock:
+        check = now - _checked >= INDEX_CHECK_INTERVAL
+        if check:
+            _checked = now
+    if check:
+        manifest = snapshot.read_manifest(snapshot_dir)
+        with _lock:
+            if manifest is not None and _building is None and (
+                    _index is None or _index.version != manifest['version']):
+                _building = manifest['version']
+                _thread = threading.Thread(
+                    target=_build, args=(manifest, snapshot_dir), daemon=True)
+                _thread.start()
+    if wait and _thread is not None:
+        _thread.join()
+    return _index
@@ -0,0 +1,254 @@
+"""Versioned, immutable snapshots of the strains data, partitioned by lab.
+
+Each lab's worksheet is stored as its own Arrow IPC 'partition' file in the
+snapshot directory. A snapshot version is published by atomically replacing
+manifest.json, which records:
+- version: integer, incremented whenever any partition changes.
+- partitions: {lab: partition metadata}, where partition metadata includes
+    the partition file name ('path', relative to the snapshot directory), its
+    own 'version', 'n_rows', source worksheet 'revision' and 'mtime'.
+- n_rows, columns: shape of the combined data.
+- mtime: UTC time the snapshot was published (ISO format).
+- sheet_revisions: {sheet title: revision} of the source worksheets.
+- any extra metadata passed by the writer (e.g. plot layout, see data.py).
+
+A refresh writes new files only for partitions whose worksheet changed, and
+the new manifest reuses the metadata of the others. Files are never modified
+after publishing, so a reader either sees the previous or the new version,
+never a partially written file. Files are uncompressed and memory-mapped when
+read, so all processes reading a version share one copy of the files in the
+OS page cache. Columns are dictionary-encoded and load as pandas categoricals,
+but the dataframe is private to each process: pandas re-encodes the codes
+against categories unified across partitions (1-4 bytes per row and column),
+and holds every distinct value as a Python string. For columns with mostly
+unique values (entry, description) the strings dominate, so each process
+holds two to three times the size of the files. Both sizes are logged, and
+kept in last_memory, when a snapshot is read.
+
+Partition files not referenced by the last SNAPSHOT_KEEP manifests are removed
+after publishing, once older than MIN_AGE. Processes that already mapped a
+removed file can keep using it. Writers in different processes (e.g. several
+Bokeh server processes) serialise updates with write_lock.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+import datetime as dt
+from collections import OrderedDict
+
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.lock'
+HISTORY_NAME = 'manifest-{:06d}.json'
+SNAPSHOT_KEEP = 3
+MIN_AGE = 600  # seconds before unused partition files can be removed
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+log = logging.getLogger(__name__)
+
+last_memory = OrderedDict()  # {'shared', 'private': bytes} of last read
+_tables = {}  # {partition path: memory-mapped arrow table}
+_loaded = {}  # {partition paths: dataframe}, latest snapshot read per process
+_lock = threading.Lock()
+
+
+def _write_atomic(path, write_func):
+    """Write file via temporary file in same directory, then rename."""
+    temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+    try:
+        with open(temp_path, 'wb') as f:
+            write_func(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _utc_now():
+    return dt.datetime.utcnow().strftime(TIME_FORMAT)
+
+
+@contextmanager
+def write_lock(snapshot_dir):
+    """Hold exclusive lock on snapshot directory, across processes."""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, LOCK_NAME), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(snapshot_dir):
+    """Get manifest dictionary for latest snapshot, or None if no snapshot."""
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST_NAME)) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return None
+
+
+def table_from_df(df):
+    """Get Arrow table with dictionary-encoded string columns."""
+    arrays = []
+    for col in df.columns:
+        arr = pa.array(df[col].astype(str).values, type=pa.string())
+        arrays.append(arr.dictionary_encode())
+    return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+
+def write_partition(snapshot_dir, name, df, prev=None, **extra):
+    """Write df as new, unpublished partition file. Returns its metadata.
+
+    Args:
+        snapshot_dir (str): snapshot directory.
+        name (str): partition name (lab).
+        df (pd.DataFrame or pa.Table): partition data. Tables must already
+            be encoded (see table_from_df).
+        prev (dict): metadata of the partition being replaced, if any.
+        extra: additional metadata, e.g. revision of source worksheet.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    version = prev['version'] + 1 if prev else 1
+    slug = re.sub(r'\W+', '_', name)
+    file_name = 'part-{}-{:06d}-{}.arrow'.format(slug, version,
+                                                 uuid.uuid4().hex[:8])
+    table = df if isinstance(df, pa.Table) else table_from_df(df)
+
+    def write_table(f):
+        writer = pa.ipc.new_file(f, table.schema)
+        writer.write_table(table)
+        writer.close()
+    _write_atomic(os.path.join(snapshot_dir, file_name), write_table)
+
+    part = OrderedDict([
+        ('path', file_name),
+        ('version', version),
+        ('n_rows', table.num_rows),
+        ('mtime', _utc_now()),
+    ])
+    part.update(extra)
+    return part
+
+
+def publish(snapshot_dir, partitions, columns, **extra):
+    """Publish new snapshot version made of partitions. Returns manifest.
+
+    Args:
+        snapshot_dir (str): snapshot directory.
+        partitions (OrderedDict): {name: partition metadata}, in row order.
+        columns (list): column names, common to all partitions.
+        extra: additional manifest entries.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    prev = read_manifest(snapshot_dir)
+    # never reuse version numbers, even if manifest.json was removed
+    versions = [int(i[9:-5]) for i in os.listdir(snapshot_dir)
+                if re.match(r'manifest-\d+\.json$', i)]
+    version = max(versions + [prev['version'] if prev else 0]) + 1
+    manifest = OrderedDict([
+        ('version', version),
+        ('partitions', partitions),
+        ('n_rows', sum(i['n_rows'] for i in partitions.values())),
+        ('columns', list(columns)),
+        ('mtime', _utc_now()),
+        ('sheet_revisions', OrderedDict(
+            (name, part.get('revision')) for name, part in partitions.items())),
+    ])
+    manifest.update(extra)
+    manifest_bytes = json.dumps(manifest).encode('utf-8')
+    # keep copy of manifest in history, to know which files are in use
+    _write_atomic(os.path.join(snapshot_dir, HISTORY_NAME.format(version)),
+                  lambda f: f.write(manifest_bytes))
+    _write_atomic(os.path.join(snapshot_dir, MANIFEST_NAME),
+                  lambda f: f.write(manifest_bytes))
+    remove_old_snapshots(snapshot_dir)
+    return manifest
+
+
+def partition_paths(manifest):
+    """Get list of partition file names in snapshot manifest."""
+    if 'partitions' not in manifest:
+        return [manifest['path']]  # single-file snapshot, before partitions
+    return [i['path'] for i in manifest['partitions'].values()]
+
+
+def _read_table(path):
+    table = _tables.get(path)
+    if table is None:
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        _tables[path] = table
+    return table
+
+
+def read_snapshot(snapshot_dir, manifest):
+    """Get combined dataframe for snapshot in manifest, via memory maps.
+
+    Partitions are concatenated as Arrow tables without copying, then
+    converted to pandas, which copies the data into the process (see module
+    docstring). The dataframe is cached per process, so that all sessions
+    in a process share it. It must not be modified.
+    """
+    paths = tuple(os.path.join(snapshot_dir, i)
+                  for i in partition_paths(manifest))
+    with _lock:
+        df = _loaded.get(paths)
+        if df is None:
+            tables = [_read_table(i) for i in paths]
+            df = pa.concat_tables(tables).to_pandas()
+            _loaded.clear()
+            _loaded[paths] = df
+            last_memory['shared'] = sum(i.nbytes for i in tables)
+            last_memory['private'] = int(df.memory_usage(deep=True).sum())
+            log.info('Read snapshot of %s rows: %.1f MB mapped (shared), '
+                     '%.1f MB dataframe (per process)', len(df),
+                     last_memory['shared'] / 1e6,
+                     last_memory['private'] / 1e6)
+            for path in list(_tables):
+                if path not in paths:
+                    del _tables[path]
+    return df
+
+
+def remove_old_snapshots(snapshot_dir, n_keep=SNAPSHOT_KEEP):
+    """Delete history and partition files not used by last n_keep versions."""
+    names = os.listdir(snapshot_dir)
+    history = sorted(i for i in names
+                     if re.match(r'manifest-\d+\.json$', i))
+    in_use = set()
+    for name in history[-n_keep:]:
+        try:
+            with open(os.path.join(snapshot_dir, name)) as f:
+                in_use.update(partition_paths(json.load(f)))
+        except (OSError, ValueError):
+            return  # unreadable history: keep everything
+    old = history[:-n_keep]
+    now = time.time()
+    for name in names:
+        if name.endswith('.arrow') and name not in in_use:
+            # skip recent files, which may be awaiting publication
+            path = os.path.join(snapshot_dir, name)
+            if now - os.path.getmtime(path) > MIN_AGE:
+                old.append(name)
+    for name in old:
+        try:
+            os.remove(os.path.join(snapshot_dir, name))
+        except OSError:
+            pass
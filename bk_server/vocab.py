@@ -0,0 +1,160 @@
+"""Canonical labels for different spellings of markers, origins and organisms.
+
+Lab worksheets spell the same value differently (e.g. 'KanR', 'Kan',
+'kanamycin '), which would split bar counts and filters. On ingest (see
+ingest.py), values of the VOCAB_COLS columns are mapped to canonical labels
+by a synonym vocabulary, a JSON file at VOCAB_PATH of the form:
+
+    {"marker": {"KanR": ["Kan", "kanamycin", "KmR"], ...},
+     "origin": {...}, "organism": {...}}
+
+Matching ignores case and repeated or surrounding whitespace. Values not in
+the vocabulary are kept, with whitespace trimmed, and reported for curation:
+their counts are stored in the snapshot manifest ('unknown_values') and can
+be listed with:
+
+    python -m bk_server.vocab
+
+Each column is normalised over its distinct values only, then the labels are
+gathered back by integer code. The vocabulary is read once per process and
+re-read when the file changes. Partitions record the digest of the
+vocabulary they were built with, so editing it rebuilds all partitions on the
+next refresh.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict, Counter
+
+import numpy as np
+import pandas as pd
+
+BLANK = '<blank>'
+# column: vocabulary kind, shared by columns holding the same kind of value
+VOCAB_COLS = OrderedDict([
+    ('organism', 'organism'),
+    ('marker1', 'marker'),
+    ('marker2', 'marker'),
+    ('origin', 'origin'),
+    ('origin2', 'origin'),
+])
+
+_cache = {}  # {path: (mtime, Vocabulary)}
+_lock = threading.Lock()
+
+
+def match_key(value):
+    """Get key for vocabulary lookup: case-folded, whitespace collapsed."""
+    return ' '.join(value.split()).casefold()
+
+
+class Vocabulary(object):
+    """Synonym vocabulary: {kind: {canonical label: list of synonyms}}."""
+
+    def __init__(self, terms=None):
+        terms = terms or {}
+        self.terms = OrderedDict(
+            (kind, OrderedDict(terms.get(kind, {})))
+            for kind in OrderedDict.fromkeys(VOCAB_COLS.values()))
+        self.lookup = {}  # {kind: {match key: canonical label}}
+        for kind, kind_terms in self.terms.items():
+            lookup = self.lookup[kind] = {}
+            for label, synonyms in kind_terms.items():
+                for synonym in [label] + list(synonyms):
+                    lookup[match_key(synonym)] = label
+        data = json.dumps(self.terms, sort_keys=True).encode('utf-8')
+        self.digest = hashlib.sha1(data).hexdigest()[:12]
+
+    @classmethod
+    def from_file(cls, path):
+        """Read vocabulary JSON file. Empty vocabulary if there is none."""
+        try:
+            with open(path) as f:
+                return cls(json.load(f, object_pairs_hook=OrderedDict))
+        except FileNotFoundError:
+            return cls()
+
+    def normalise_values(self, kind, values):
+        """Get (labels, is_unknown) arrays for array of distinct values."""
+        lookup = self.lookup[kind]
+        labels = np.empty(len(values), dtype=object)
+        is_unknown = np.zeros(len(values), dtype=bool)
+        for ind, value in enumerate(values):
+            if value == BLANK:
+                labels[ind] = value
+                continue
+            label = lookup.get(match_key(value))
+            if label is None:
+                label = ' '.join(value.split()) or BLANK
+                is_unknown[ind] = label != BLANK
+            labels[ind] = label
+        return labels, is_unknown
+
+    def normalise(self, df):
+        """Get (df with canonical labels, unknown values).
+
+        Args:
+            df (pd.DataFrame): strains data, blank cells as '<blank>'.
+
+        Returns:
+            (pd.DataFrame, OrderedDict of {kind: Counter of {value: rows}}),
+            where unknown values are those not in the vocabulary.
+        """
+        df = df.copy()
+        unknown = OrderedDict()
+        for col, kind in VOCAB_COLS.items():
+            if col not in df.columns:
+                continue
+            codes, uniques = pd.factorize(df[col], sort=False)
+            labels, is_unknown = self.normalise_values(kind, uniques)
+            df[col] = labels[codes]
+            counts = np.bincount(codes, minlength=len(uniques))
+            kind_unknown = unknown.setdefault(kind, Counter())
+            for ind in np.flatnonzero(is_unknown):
+                kind_unknown[labels[ind]] += int(counts[ind])
+        return df, unknown
+
+
+def load_vocabulary(path):
+    """Get vocabulary in file at path, cached until the file changes."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    with _lock:
+        cached = _cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _cache[path] = (mtime, Vocabulary.from_file(path))
+    return cached[1]
+
+
+def sum_unknown(partitions):
+    """Get {kind: {value: rows}} of unknown values in partitions, by count."""
+    totals = OrderedDict()
+    for part in partitions:
+        for kind, values in part.get('unknown_values', {}).items():
+            totals.setdefault(kind, Counter()).update(values)
+    return OrderedDict((kind, OrderedDict(counts.most_common()))
+                       for kind, counts in totals.items())
+
+
+def main():
+    """Print values of latest snapshot that are not in the vocabulary."""
+    from . import snapshot
+    from .data import SNAPSHOT_DIR, VOCAB_PATH
+
+    manifest = snapshot.read_manifest(SNAPSHOT_DIR)
+    if manifest is None:
+        print('No snapshot in {}'.format(SNAPSHOT_DIR))
+        return
+    print('Vocabulary: {}'.format(VOCAB_PATH))
+    for kind, values in manifest.get('unknown_values', {}).items():
+        print('\n{} ({} values not in vocabulary):'.format(kind, len(values)))
+        for value, n in values.items():
+            print('  {:>6}  {}'.format(n, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import os
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request
 from flask_login import LoginManager, current_user
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
@@ -9,12 +8,15 @@ from datetime import datetime
 
 from .oauth import OAuthSignIn
 from .config import config, table_cols
+from .database import RoutingSQLAlchemy, get_engine_options, init_app
 
 
 app = Flask(__name__)
 app.config.from_object(config[os.getenv('FLASK_ENV') or 'default'])
 
-db = SQLAlchemy(app)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config)
+db = RoutingSQLAlchemy(app)
+init_app(app, db)
 
 bootstrap = Bootstrap()
 bootstrap.init_app(app)
@@ -25,11 +27,20 @@ lm.login_view = 'index'
 mail = Mail()
 mail.init_app(app)
 
+OAuthSignIn.load_providers(app.config)
+
 MEMBERS_DICT = {}
 
 
+# long-polls, mostly answered from memory (see feed.py). These check the
+# user's membership as last set by other pages, without writing to the user.
+NO_USER_ENDPOINTS = {'request_updates'}
+
+
 @app.before_request
 def before_request():
+    if request.endpoint in NO_USER_ENDPOINTS:
+        return
     if current_user.is_authenticated:
         current_user.last_seen = datetime.utcnow()
         current_user.in_cgem = current_user.social_id in MEMBERS_DICT
@@ -53,5 +64,12 @@ def update_members_and_emails():
     load_lab_emails()
 
 
+@app.before_first_request
+def start_similarity_index():
+    """Start indexing strains snapshot in the background."""
+    from bk_server import similar
+    similar.get_index()
+
+
 from oauth import models
 from oauth import routes
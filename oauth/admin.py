@@ -1,13 +1,13 @@
 from collections import OrderedDict
 
-import pandas as pd
 from flask import current_app
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
 
 def get_members_dict():
     """Get dictionary of {google_id: email_address}."""
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+
     CREDS_JSON = current_app.config['CREDS_JSON']
     GROUP_KEY = current_app.config['GROUP_KEY']
     SCOPES = current_app.config['SCOPES']
@@ -24,6 +24,8 @@ def get_members_dict():
 
 
 def get_requests_df(requests):
+    import pandas as pd
+
     rq_cols = ['id', 'strain_lab', 'strain_entry', 'creation_time', 'status']
     strain_cols = ['organism', 'strain', 'plasmid']
     requester_names = [i.requester.display_name for i in requests]
@@ -0,0 +1,149 @@
+"""Conditional GET (ETag, Last-Modified) and compression for Flask pages.
+
+Request pages are given a cheap data version, computed before rendering:
+- request lists: the number of requests listed and the latest request event
+    (see events.py) among them. Every request creation and every status,
+    shipper or comment change adds an event.
+- single requests: Request.version, bumped by every change (see feed.py).
+The ETag combines the version with the user, so a page that has not changed
+for that user gets '304 Not Modified' without being rendered. Pages showing
+flashed messages are never cached. So that cached forms can still be
+submitted, the ETag also depends on the session's CSRF secret, which changes
+when the session is reset (e.g. on logging in again), and changes at least
+every half CSRF token lifetime.
+
+Larger text responses are compressed with brotli if available and accepted
+by the browser, else gzip.
+"""
+
+import gzip
+import time
+import hashlib
+from functools import wraps
+
+from flask import request, session, make_response, current_app
+from flask_login import current_user
+
+from oauth import app, db
+from .models import Request, RequestEvent
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024  # bytes; smaller responses are sent as they are
+COMPRESS_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'text/csv',
+                      'application/json', 'application/javascript'}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def get_list_version(requester_id=None, shipper_id=None):
+    """Get (version, last modified time) of list of requests.
+
+    Args:
+        requester_id (int): only requests made by this user.
+        shipper_id (int): only requests handled by this user.
+    """
+    filters = []
+    if requester_id is not None:
+        filters.append(Request.requester_id == requester_id)
+    if shipper_id is not None:
+        filters.append(Request.shipper_id == shipper_id)
+    n_requests = db.session.query(db.func.count(Request.id)).\
+        filter(*filters).scalar()
+    query = db.session.query(db.func.max(RequestEvent.id),
+                             db.func.max(RequestEvent.time))
+    if filters:
+        query = query.join(Request, RequestEvent.request_id == Request.id).\
+            filter(*filters)
+    last_id, last_time = query.one()
+    return '{}-{}'.format(n_requests, last_id), last_time
+
+
+def get_request_version(request_id):
+    """Get (version, last modified time) of single request page."""
+    version, last_time = db.session.query(
+        Request.version, db.func.max(RequestEvent.time)).\
+        outerjoin(RequestEvent, RequestEvent.request_id == Request.id).\
+        filter(Request.id == request_id).group_by(Request.version).first() \
+        or (None, None)
+    return version, last_time
+
+
+def _csrf_period():
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time.time() // (limit / 2)) if limit else 0
+
+
+def cached_page(version_func):
+    """Decorate view to answer unchanged GETs with 304, before rendering.
+
+    Args:
+        version_func (callable): takes the view's arguments, returns
+            (version, last modified time) of page data. Version None skips
+            caching.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            version, last_modified = version_func(*args, **kwargs)
+            if version is None:
+                return view(*args, **kwargs)
+            key = '{}:{}:{}:{}:{}:{}'.format(
+                request.path, current_user.get_id(), current_user.in_cgem,
+                version, _csrf_period(), session.get('csrf_token'))
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = last_modified is not None and \
+                    request.if_modified_since is not None and \
+                    last_modified.replace(microsecond=0) <= \
+                    request.if_modified_since.replace(tzinfo=None)
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+
+def _accepted(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+@app.after_request
+def compress_response(response):
+    """Compress larger text responses, if accepted by browser."""
+    if (response.status_code != 200 or response.direct_passthrough or
+            response.is_streamed or 'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and _accepted('br'):
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+        encoding = 'br'
+    elif _accepted('gzip'):
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+        encoding = 'gzip'
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
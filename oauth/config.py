@@ -32,7 +32,18 @@ class Config(object):
     OAUTH_CREDENTIALS = {
         'google': {
             'id': os.environ.get('GOOGLE_CLIENT_ID'),
-            'secret': os.environ.get('GOOGLE_SECRET')
+            'secret': os.environ.get('GOOGLE_SECRET'),
+            # endpoints, overridable e.g. for a local stand-in server
+            'authorize_url': os.environ.get('GOOGLE_AUTHORIZE_URL') or
+                'https://accounts.google.com/o/oauth2/auth',
+            'access_token_url': os.environ.get('GOOGLE_TOKEN_URL') or
+                'https://www.googleapis.com/oauth2/v3/token',
+            'base_url': os.environ.get('GOOGLE_API_URL') or
+                'https://people.googleapis.com/v1/',
+            'certs_url': os.environ.get('GOOGLE_CERTS_URL') or
+                'https://www.googleapis.com/oauth2/v3/certs',
+            'issuer': os.environ.get('GOOGLE_ISSUER') or
+                'https://accounts.google.com',
         }
     }
     DB_CNF = os.environ.get('DB_CNF')
@@ -41,6 +52,19 @@ class Config(object):
     # recycle connection before mysql default 8hr wait timeout
     SQLALCHEMY_POOL_RECYCLE = int(
         os.environ.get('SQLALCHEMY_POOL_RECYCLE', 3600))
+    # DATABASE ENGINES (see database.py)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 10)
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT') or 30)
+    DB_PRE_PING = os.environ.get('DB_PRE_PING', 'True') == 'True'
+    # seconds; 0 disables statement timeout
+    DB_STATEMENT_TIMEOUT = float(os.environ.get('DB_STATEMENT_TIMEOUT') or 10)
+    DB_SLOW_STATEMENT = float(os.environ.get('DB_SLOW_STATEMENT') or 0.5)
+    DB_SLOW_POOL_WAIT = float(os.environ.get('DB_SLOW_POOL_WAIT') or 0.1)
+    DB_REPLICA_LAG = float(os.environ.get('DB_REPLICA_LAG') or 5)
+    DATABASE_URL_REPLICA = os.environ.get('DATABASE_URL_REPLICA')
+    SQLALCHEMY_BINDS = {'replica': DATABASE_URL_REPLICA} \
+        if DATABASE_URL_REPLICA else None
 
     CREDS_JSON = os.environ.get('CREDS_JSON')
     SERVICE_USER = os.environ.get('SERVICE_USER')
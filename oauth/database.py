@@ -0,0 +1,262 @@
+"""Database engines: pool settings, timeouts, read replica and reporting.
+
+Engine settings come from the app config (see config.py):
+- pool size, overflow and checkout timeout (DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT), for server databases. SQLite files keep SQLAlchemy's
+    default of one connection per checkout. Pool options are chosen per
+    database, as the primary and replica may be of different kinds.
+- pre-ping (DB_PRE_PING): connections are tested before use, so that
+    connections dropped by the server are replaced instead of failing.
+- statement timeout (DB_STATEMENT_TIMEOUT, seconds). MySQL enforces it for
+    SELECT statements (max_execution_time). MariaDB has no such setting, and
+    enforces it for all statements, writes included (max_statement_time).
+    SQLite statements are interrupted via a progress handler.
+- read replica (DATABASE_URL_REPLICA, optional). Views decorated with
+    replica_reads send their queries to the replica on GET requests. Writes
+    always go to the primary, as do a user's reads for DB_REPLICA_LAG
+    seconds after one of their POST requests, so that they see their own
+    changes.
+
+Pool checkouts waiting longer than DB_SLOW_POOL_WAIT seconds and statements
+slower than DB_SLOW_STATEMENT seconds are logged, and counted in get_stats.
+A summary is logged every STATS_INTERVAL seconds.
+
+Session routing and engine hooks extend Flask-SQLAlchemy 2.x, and pool
+timing extends SQLAlchemy's QueuePool internals, hence the pins of both in
+requirements.txt.
+"""
+
+import time
+import logging
+import sqlite3
+import threading
+import weakref
+from functools import wraps
+from collections import OrderedDict
+
+from flask import request, session, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+REPLICA_BIND = 'replica'
+STATS_INTERVAL = 300
+SQLITE_PROGRESS_OPS = 10000  # sqlite VM steps between timeout checks
+
+log = logging.getLogger(__name__)
+
+_stats = OrderedDict([
+    ('checkouts', 0),
+    ('slow_checkouts', 0),
+    ('max_wait', 0.0),
+    ('statements', 0),
+    ('slow_statements', 0),
+    ('replica_statements', 0),
+    ('max_statement', 0.0),
+])
+_stats_lock = threading.Lock()
+_last_report = [time.time()]
+_watched = weakref.WeakSet()  # engines with reporting set up
+
+
+def _count(**values):
+    with _stats_lock:
+        for key, value in values.items():
+            if key.startswith('max_'):
+                _stats[key] = max(_stats[key], value)
+            else:
+                _stats[key] += value
+
+
+def get_stats():
+    """Get counts of pool checkouts and statements, slow and otherwise."""
+    with _stats_lock:
+        return OrderedDict(_stats)
+
+
+def log_stats():
+    log.info('Database: %(checkouts)s checkouts (%(slow_checkouts)s slow, '
+             'longest wait %(max_wait).3fs); %(statements)s statements '
+             '(%(slow_statements)s slow, %(replica_statements)s on replica, '
+             'longest %(max_statement).3fs)', get_stats())
+
+
+def get_engine_options(config):
+    """Get SQLALCHEMY_ENGINE_OPTIONS, common to all databases in config."""
+    return {'pool_pre_ping': config['DB_PRE_PING'],
+            'pool_recycle': config['SQLALCHEMY_POOL_RECYCLE']}
+
+
+def get_pool_options(config, url):
+    """Get engine pool options for database at url (none for SQLite)."""
+    if make_url(url).drivername.startswith('sqlite'):
+        return {}
+    return {'poolclass': TimedQueuePool,
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT']}
+
+
+class TimedQueuePool(QueuePool):
+    """Queue pool recording how long checkouts wait for a connection.
+
+    Wraps QueuePool._do_get, internal to SQLAlchemy 1.x (see requirements.txt).
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            slow = wait > self._slow_wait
+            _count(checkouts=1, slow_checkouts=int(slow), max_wait=wait)
+            if slow:
+                log.warning('Waited %.3fs for database connection '
+                            '(pool size %s, overflow %s)', wait, self.size(),
+                            self.overflow())
+
+    _slow_wait = 0.1  # set per engine, see watch_engine
+
+
+def _set_mysql_timeout(dbapi_connection, timeout):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SET SESSION max_execution_time = {:d}'.format(
+            int(timeout * 1000)))
+    except Exception:  # MariaDB
+        cursor.execute('SET SESSION max_statement_time = {:f}'.format(
+            timeout))
+    finally:
+        cursor.close()
+
+
+def _set_sqlite_timeout(dbapi_connection, connection_record, timeout):
+    record_info = connection_record.info
+
+    def check_timeout():
+        start = record_info.get('statement_start')
+        return int(start is not None and
+                   time.perf_counter() - start > timeout)
+    dbapi_connection.set_progress_handler(check_timeout, SQLITE_PROGRESS_OPS)
+
+
+def watch_engine(engine, config, is_replica=False):
+    """Add statement timeout and slow statement reporting to engine."""
+    timeout = config['DB_STATEMENT_TIMEOUT']
+    slow_statement = config['DB_SLOW_STATEMENT']
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool._slow_wait = config['DB_SLOW_POOL_WAIT']
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        if not timeout:
+            return
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            _set_sqlite_timeout(dbapi_connection, connection_record, timeout)
+        elif engine.dialect.name == 'mysql':
+            _set_mysql_timeout(dbapi_connection, timeout)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info['statement_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context,
+                      executemany):
+        start = conn.info.pop('statement_start', None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        slow = duration > slow_statement
+        _count(statements=1, slow_statements=int(slow),
+               replica_statements=int(is_replica), max_statement=duration)
+        if slow:
+            log.warning('Slow statement (%.3fs%s): %s', duration,
+                        ' on replica' if is_replica else '',
+                        ' '.join(statement.split())[:300])
+
+    @event.listens_for(engine, 'handle_error')
+    def on_error(context):
+        # statement interrupted or failed: not counted as running
+        if context.connection is not None:
+            context.connection.info.pop('statement_start', None)
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads to the replica when flagged (see replica_reads).
+
+    Flushes, i.e. all ORM writes, use the primary database.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get(REPLICA_BIND) and not self._flushing:
+            return get_state(self.app).db.get_engine(self.app,
+                                                     bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and engine reporting."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # called per engine, i.e. for primary and replica databases
+        options.update(get_pool_options(app.config, sa_url))
+        return super(RoutingSQLAlchemy, self).apply_driver_hacks(
+            app, sa_url, options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(RoutingSQLAlchemy, self).get_engine(app, bind)
+        with _stats_lock:
+            watched = engine in _watched
+            _watched.add(engine)
+        if not watched:
+            watch_engine(engine, self.get_app(app).config,
+                         is_replica=bind == REPLICA_BIND)
+        return engine
+
+
+def has_replica(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def replica_reads(view):
+    """Decorate view to run its queries on the replica, for GET requests.
+
+    Reads stay on the primary if there is no replica, or if the user made a
+    POST request in the last DB_REPLICA_LAG seconds.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replica = (request.method == 'GET' and
+                       has_replica(current_app) and
+                       session.get('db_primary_until', 0) < time.time())
+        if not use_replica:
+            return view(*args, **kwargs)
+        db = get_state(current_app).db
+        db.session.info[REPLICA_BIND] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            db.session.info.pop(REPLICA_BIND, None)
+    return wrapper
+
+
+def init_app(app, db):
+    """Keep user's reads on primary after writes; log stats periodically."""
+
+    @app.after_request
+    def after_request(response):
+        if request.method == 'POST' and has_replica(app):
+            session['db_primary_until'] = \
+                time.time() + app.config['DB_REPLICA_LAG']
+        now = time.time()
+        if now - _last_report[0] > STATS_INTERVAL:
+            _last_report[0] = now
+            log_stats()
+        return response
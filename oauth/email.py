@@ -4,9 +4,6 @@ from threading import Thread
 
 from flask import current_app, render_template, url_for
 from flask_mail import Message
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-
 
 from oauth import mail
 
@@ -37,50 +34,70 @@ def send_email(subject, recipients, text_body, html_body,
                args=(current_app._get_current_object(), msg)).start()
 
 
-def notify_lab(rq):
-    """Send notification email to lab handling strain."""
-    lab_emails = EMAIL_DICT[rq.strain_lab]
-    requester_name = rq.requester.display_name
-    strain = rq.strain
-    subject = "[Strains] New REQUEST from {}: {}".format(requester_name, strain.plasmid)
-    text_body = render_template('email/new_request.txt', rq=rq)
-    html_body = render_template('email/new_request.html', rq=rq)
+def notify_lab(rqs):
+    """Send one notification email to lab handling the strains of requests."""
+    lab = rqs[0].strain_lab
+    lab_emails = EMAIL_DICT[lab]
+    requester_name = rqs[0].requester.display_name
+    if len(rqs) == 1:
+        subject = "[Strains] New REQUEST from {}: {}".format(
+            requester_name, rqs[0].strain.plasmid)
+    else:
+        subject = "[Strains] New REQUESTS from {}: {} strains".format(
+            requester_name, len(rqs))
+    text_body = render_template('email/new_request.txt', rqs=rqs, lab=lab)
+    html_body = render_template('email/new_request.html', rqs=rqs, lab=lab)
     send_email(subject,
                recipients=lab_emails,
                text_body=text_body, html_body=html_body)
 
 
-def email_comment(comment):
-    """Send new comment notification.
+def notify_labs(rqs):
+    """Send notification emails for new requests, one per strain lab."""
+    lab_requests = OrderedDict()
+    for rq in rqs:
+        lab_requests.setdefault(rq.strain_lab, []).append(rq)
+    for lab_rqs in lab_requests.values():
+        notify_lab(lab_rqs)
 
-    If commenter is requester, either 1) email volunteer if exists or
+
+def get_recipients(rq, user):
+    """Get email addresses to notify of user's change to request.
+
+    If user is requester, either 1) email volunteer if exists or
     2) email lab emails.
 
-    If commenter is shipper, email requester.
+    If user is shipper, email requester.
 
-    If commenter is not shipper or requester, either 1) email requester
+    If user is not shipper or requester, either 1) email requester
     and shipper if shipper exists, or 2) email requester and lab emails.
     """
-    rq = comment.request
-    commenter = comment.commenter
-    requester = comment.request.requester
-    shipper = comment.request.shipper
+    requester = rq.requester
+    shipper = rq.shipper
 
     lab_emails = EMAIL_DICT[rq.strain_lab]
     recipients = []
-    if commenter == requester:
+    if user == requester:
         if shipper:
             recipients.append(shipper.email)
         else:
             recipients.extend(lab_emails)
-    if commenter == shipper:
+    if user == shipper:
         recipients.append(requester.email)
-    if commenter not in (shipper, requester):
+    if user not in (shipper, requester):
         recipients.append(requester.email)
         if shipper:
             recipients.append(shipper.email)
         else:
             recipients.extend(lab_emails)
+    return recipients
+
+
+def email_comment(comment):
+    """Send new comment notification (see get_recipients)."""
+    rq = comment.request
+    commenter = comment.commenter
+    recipients = get_recipients(rq, commenter)
 
     subject = "[Strains] New COMMENT from {} on request {}".format(commenter.display_name, rq.id)
     text_body = render_template('email/new_comment.txt', rq=rq, comment=comment)
@@ -93,33 +110,9 @@ def email_comment(comment):
 def email_new_status(rq, user):
     """Send new status notification, including user that modified status.
 
-    If user is requester, either 1) email volunteer if exists or
-    2) email lab emails.
-
-    If user is shipper, email requester.
-
-    If user is not shipper or requester, either 1) email requester
-    and shipper if shipper exists, or 2) email requester and lab emails.
+    Recipients depend on user's role in request (see get_recipients).
     """
-
-    requester = rq.requester
-    shipper = rq.shipper
-
-    lab_emails = EMAIL_DICT[rq.strain_lab]
-    recipients = []
-    if user == requester:
-        if shipper:
-            recipients.append(shipper.email)
-        else:
-            recipients.extend(lab_emails)
-    if user == shipper:
-        recipients.append(requester.email)
-    if user not in (shipper, requester):
-        recipients.append(requester.email)
-        if shipper:
-            recipients.append(shipper.email)
-        else:
-            recipients.extend(lab_emails)
+    recipients = get_recipients(rq, user)
     time = datetime.utcnow().strftime('%Y-%m-%d %H:%M')
     subject = "[Strains] New STATUS on request {}".format(rq.id)
     text_body = render_template('email/new_status.txt', rq=rq, user=user, time=time)
@@ -129,6 +122,44 @@ def email_new_status(rq, user):
                text_body=text_body, html_body=html_body)
 
 
+def email_bulk_update(rqs, user, old_shippers=None):
+    """Send notifications of status/shipper changes to many requests.
+
+    Each recipient (see get_recipients) gets one email listing all of their
+    affected requests.
+
+    Args:
+        rqs (list): updated requests, only those whose status or shipper
+            changed (see routes.update_requests).
+        user (User): user that made the changes.
+        old_shippers (dict): {request id: previous shipper}, also notified
+            when a request is reassigned.
+    """
+    old_shippers = old_shippers or {}
+    recipient_rqs = OrderedDict()
+    for rq in rqs:
+        recipients = get_recipients(rq, user)
+        old_shipper = old_shippers.get(rq.id)
+        if old_shipper not in (None, user, rq.shipper):
+            recipients.append(old_shipper.email)
+        for email in OrderedDict.fromkeys(recipients):
+            recipient_rqs.setdefault(email, []).append(rq)
+    time = datetime.utcnow().strftime('%Y-%m-%d %H:%M')
+    for email, email_rqs in recipient_rqs.items():
+        if len(email_rqs) == 1:
+            subject = "[Strains] New STATUS on request {}".format(
+                email_rqs[0].id)
+        else:
+            subject = "[Strains] New STATUS on {} requests".format(
+                len(email_rqs))
+        text_body = render_template('email/bulk_status.txt', rqs=email_rqs,
+                                    user=user, time=time)
+        html_body = render_template('email/bulk_status.html', rqs=email_rqs,
+                                    user=user, time=time)
+        send_email(subject, recipients=[email],
+                   text_body=text_body, html_body=html_body)
+
+
 def email_new_volunteer(rq):
     """Send new volunteer notification to requester."""
     time = datetime.utcnow().strftime('%Y-%m-%d %H:%M')
@@ -141,6 +172,9 @@ def email_new_volunteer(rq):
 
 def get_gsheet_dict():
     """Get dictionary of sheet_name: sheet object."""
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
     scope = ['https://spreadsheets.google.com/feeds',
              'https://www.googleapis.com/auth/drive']
     credentials = ServiceAccountCredentials.from_json_keyfile_name(
@@ -0,0 +1,100 @@
+"""Request history, from the append-only request_events table.
+
+An event is added in the same transaction as every request creation and
+every status, shipper or comment change (see routes.py), so the history of a
+request can be shown without reconstructing it from the requests and
+comments tables. Per-lab reports aggregate events only, reading the
+(lab, time) index of request_events (see models.RequestEvent).
+"""
+
+import statistics
+from collections import OrderedDict
+
+from oauth import db
+from .models import RequestEvent
+
+KINDS = ('created', 'status', 'shipper', 'comment')
+
+
+def log_event(rq, kind, user=None, value=None):
+    """Add event for change to request to the current transaction."""
+    event = RequestEvent(request=rq, lab=rq.strain_lab or rq.strain.lab,
+                         kind=kind, user=user, value=value)
+    db.session.add(event)
+    return event
+
+
+def log_events(request_labs, kind, user=None, value=None):
+    """Add same event for many requests to the current transaction.
+
+    Args:
+        request_labs (dict): {request id: strain lab}.
+        kind (str): one of KINDS.
+        user (User): user making the change.
+        value (str): new status or shipper name.
+    """
+    user_id = user.id if user is not None else None
+    db.session.bulk_insert_mappings(RequestEvent, [
+        dict(request_id=request_id, lab=lab, kind=kind, user_id=user_id,
+             value=value) for request_id, lab in request_labs.items()])
+
+
+def get_timeline(request_id):
+    """Get list of request's events, oldest first."""
+    return RequestEvent.query.filter(RequestEvent.request_id == request_id).\
+        order_by(RequestEvent.time, RequestEvent.id).\
+        options(db.joinedload(RequestEvent.user)).all()
+
+
+def _hours(start, end):
+    return (end - start).total_seconds() / 3600
+
+
+def _median(values):
+    return round(statistics.median(values), 1) if values else None
+
+
+def get_lab_stats(since=None):
+    """Get request counts and median handling times per lab, from events.
+
+    Args:
+        since (datetime): only include requests created since then.
+
+    Returns:
+        list of OrderedDict: per lab, number of requests created, shipped
+            and received, with median hours from creation to shipping and
+            from shipping to receipt.
+    """
+    E = RequestEvent
+
+    def first_time(condition):
+        return db.func.min(db.case((condition, E.time), else_=None))
+    created = first_time(E.kind == 'created')
+    shipped = first_time((E.kind == 'status') & (E.value == 'shipped'))
+    received = first_time((E.kind == 'status') & (E.value == 'received'))
+    query = db.session.query(E.lab, E.request_id, created, shipped, received).\
+        group_by(E.lab, E.request_id)
+    if since is not None:
+        query = query.filter(E.time >= since).having(created.isnot(None))
+
+    labs = OrderedDict()
+    for lab, _, t_created, t_shipped, t_received in query.order_by(E.lab):
+        lab_times = labs.setdefault(lab, {'n': 0, 'ship': [], 'receive': [],
+                                          'n_shipped': 0, 'n_received': 0})
+        lab_times['n'] += 1
+        if t_shipped is not None:
+            lab_times['n_shipped'] += 1
+            if t_created is not None:
+                lab_times['ship'].append(_hours(t_created, t_shipped))
+        if t_received is not None:
+            lab_times['n_received'] += 1
+            if t_shipped is not None:
+                lab_times['receive'].append(_hours(t_shipped, t_received))
+    return [OrderedDict([
+        ('lab', lab),
+        ('requests', i['n']),
+        ('shipped', i['n_shipped']),
+        ('received', i['n_received']),
+        ('median_hours_to_ship', _median(i['ship'])),
+        ('median_hours_to_receive', _median(i['receive'])),
+    ]) for lab, i in labs.items()]
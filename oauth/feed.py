@@ -0,0 +1,94 @@
+"""Change feed for request threads (status, shipper and comments).
+
+Every write to a request's status, shipper or comments increments its
+Request.version. Request pages long-poll the feed endpoint (see routes.py)
+with the version they show, and fetch only new comments once it changes.
+
+Most polls find nothing changed. These are answered from an in-memory map of
+{request id: version}, without a database query. The map is updated by writes
+in this process, which also wake up waiting polls. Versions written by other
+processes are picked up by re-reading the version of a request once its map
+entry is older than VERSION_TTL seconds. Waiting polls are only woken up when
+a version increased, not by re-reads finding the same version.
+
+A waiting poll holds a server thread, so at most MAX_WAITERS polls wait at
+once in each process (see waiter_slot). Others are answered at once, and the
+client is asked to poll again after POLL_INTERVAL seconds.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from oauth import db
+
+VERSION_TTL = 5  # seconds before a version is re-read from the database
+POLL_TIMEOUT = 25  # longest wait for a change, before an empty response
+MAX_WAITERS = 4  # polls waiting at once per process, each holding a thread
+POLL_INTERVAL = 10  # seconds before polls answered without waiting retry
+
+_versions = {}  # {request id: (version, time read)}
+_changed = threading.Condition()
+_n_waiting = 0
+
+
+def set_version(request_id, version):
+    """Record version of request, waking up waiting polls if it increased."""
+    with _changed:
+        old = _versions.get(request_id, (0, 0))[0]
+        _versions[request_id] = (max(old, version), time.time())
+        if version > old:
+            _changed.notify_all()
+
+
+def get_version(request_id):
+    """Get current version of request, or None if no such request."""
+    with _changed:
+        cached = _versions.get(request_id)
+    if cached is not None and time.time() - cached[1] < VERSION_TTL:
+        return cached[0]
+    from .models import Request
+    version = db.session.query(Request.version).filter(
+        Request.id == request_id).scalar()
+    if version is not None:
+        set_version(request_id, version)
+    return version
+
+
+@contextmanager
+def waiter_slot():
+    """Reserve one of MAX_WAITERS slots. Yields whether one was free."""
+    global _n_waiting
+    with _changed:
+        reserved = _n_waiting < MAX_WAITERS
+        if reserved:
+            _n_waiting += 1
+    try:
+        yield reserved
+    finally:
+        if reserved:
+            with _changed:
+                _n_waiting -= 1
+
+
+def wait_for_version(request_id, since, timeout=None):
+    """Wait until request version exceeds since, or timeout. Returns version.
+
+    Returns None if there is no such request.
+
+    Args:
+        request_id (int): request id.
+        since (int): version known to client.
+        timeout (float): longest wait in seconds. Defaults to POLL_TIMEOUT.
+    """
+    deadline = time.time() + (POLL_TIMEOUT if timeout is None else timeout)
+    while True:
+        version = get_version(request_id)
+        remaining = deadline - time.time()
+        if version is None or version > since or remaining <= 0:
+            return version
+        db.session.remove()  # release connection while waiting
+        with _changed:
+            _changed.wait_for(
+                lambda: _versions.get(request_id, (0, 0))[0] > since,
+                timeout=min(remaining, VERSION_TTL))
@@ -1,5 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, TextAreaField, SelectField
+from wtforms import StringField, SubmitField, TextAreaField, SelectField, \
+    HiddenField, SelectMultipleField
 from wtforms.validators import DataRequired, Length, Email
 
 
@@ -19,7 +20,13 @@ class StrainForm(FlaskForm):
     submitter = StringField('submitter', [Length(min=0, max=64)])
 
 
+class BasketForm(FlaskForm):
+    """Strains selected in dashboard table, as JSON list of row dicts."""
+    strains = HiddenField('strains', [DataRequired()])
+
+
 class RequestForm(FlaskForm):
+    strains = HiddenField('strains')
     email = StringField('Your preferred email address',
                         [DataRequired(), Email()])
     address = TextAreaField('Delivery address',
@@ -27,17 +34,28 @@ class RequestForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+STATUS_CHOICES = [('processing', 'Processing'),
+                  ('shipped', 'Shipped'),
+                  ('received', 'Received'),
+                  ('problem', 'Problem'),
+                  ('cancelled', 'Cancelled'),
+                  ]
+
+
 class StatusForm(FlaskForm):
-    status = SelectField('Status',
-                         choices=[('processing', 'Processing'),
-                                  ('shipped', 'Shipped'),
-                                  ('received', 'Received'),
-                                  ('problem', 'Problem'),
-                                  ('cancelled', 'Cancelled'),
-                                  ])
+    status = SelectField('Status', choices=STATUS_CHOICES)
     submit = SubmitField('Update status')
 
 
+class BulkUpdateForm(FlaskForm):
+    """Status and/or shipper for many requests. Choices set by view."""
+    request_ids = SelectMultipleField('Requests', coerce=int,
+                                      validators=[DataRequired()])
+    status = SelectField('Status', choices=[('', 'Unchanged')] + STATUS_CHOICES)
+    shipper_id = SelectField('Shipper', coerce=int)
+    submit = SubmitField('Update selected')
+
+
 class VolunteerForm(FlaskForm):
     submit = SubmitField('Volunteer')
 
@@ -59,6 +59,9 @@ class Request(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     delivery_address = db.Column(db.String(255))
     preferred_email = db.Column(db.String(64), nullable=True)
+    # incremented on changes to status, shipper or comments (see feed.py)
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
 
     __table_args__ = (
         db.ForeignKeyConstraint(
@@ -78,6 +81,10 @@ class Request(db.Model):
     def url(self):
         return url_for('show_request', request_id=self.id, _external=True)
 
+    def bump_version(self):
+        """Mark change to request thread, incremented by the database."""
+        self.version = Request.version + 1
+
     def __repr__(self):
         return '<Request {}: {}_{}>'.format(self.requester.email,
                                             self.strain_lab,
@@ -100,4 +107,38 @@ class Comment(db.Model):
                                          self.commenter.email)
 
 
+class RequestEvent(db.Model):
+    """Append-only log of request changes, written with each change.
+
+    Rows are never updated or deleted. The indexes lead with (request_id,
+    time) for timelines and (lab, time) for per-lab reports, and include the
+    remaining queried columns, so that reports read only the indexes (see
+    events.py).
+    """
+    __tablename__ = 'request_events'
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, db.ForeignKey('requests.id'),
+                           nullable=False)
+    lab = db.Column(db.String(64), nullable=False)
+    time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    kind = db.Column(db.String(16), nullable=False)  # see events.KINDS
+    value = db.Column(db.String(64))  # new status or shipper name
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+
+    __table_args__ = (
+        db.Index('ix_request_events_request_time',
+                 'request_id', 'time', 'kind', 'value', 'user_id'),
+        db.Index('ix_request_events_lab_time',
+                 'lab', 'time', 'kind', 'value', 'request_id'),
+    )
+
+    request = db.relationship('Request', backref=db.backref(
+        'events', lazy='dynamic'))
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return '<RequestEvent {}: {} {}>'.format(self.request_id, self.kind,
+                                                 self.value)
+
+
 db.create_all()
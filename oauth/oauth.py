@@ -1,15 +1,110 @@
+"""OAuth sign-in providers.
+
+Sign-in verifies the ID token returned with the access token locally, against
+the provider's signing keys (JWKS), which are cached and refreshed in the
+background when they expire. The profile API is only called if there is no
+valid ID token. Providers are built once at startup (see __init__.py), when
+the fetch of their signing keys is started in the background, so the first
+sign-in need not wait for it.
+"""
+
+import re
 import json
+import time
+import base64
+import logging
+import threading
 
+import requests as http
 from rauth import OAuth1Service, OAuth2Service
 from flask import current_app, url_for, request, redirect, session
 
+KEYS_TTL = 3600  # seconds to cache signing keys, if not given by provider
+KEYS_MIN_REFRESH = 60  # least seconds between fetches for unknown key ids
+KEYS_TIMEOUT = 10  # seconds
+
+log = logging.getLogger(__name__)
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def jwk_to_pem(jwk):
+    """Get PEM (PKCS#1) public key from RSA JSON web key."""
+    import rsa
+    n = int.from_bytes(_b64decode(jwk['n']), 'big')
+    e = int.from_bytes(_b64decode(jwk['e']), 'big')
+    return rsa.PublicKey(n, e).save_pkcs1()
+
+
+class KeySet(object):
+    """Signing keys of OAuth provider, from its JWKS URL, cached.
+
+    Keys are kept for the max-age given by the provider (else KEYS_TTL). Once
+    expired, they are still used while being refreshed in the background.
+    Unknown key ids, e.g. after key rotation, trigger an immediate fetch, at
+    most once every KEYS_MIN_REFRESH seconds.
+    """
+
+    def __init__(self, url, ttl=KEYS_TTL):
+        self.url = url
+        self.ttl = ttl
+        self.keys = {}  # {key id: PEM public key}
+        self.fetched = 0
+        self.expires = 0
+        self._lock = threading.Lock()
+        self._thread = None  # background fetch
+
+    def fetch(self):
+        response = http.get(self.url, timeout=KEYS_TIMEOUT)
+        response.raise_for_status()
+        max_age = re.search(r'max-age=(\d+)',
+                            response.headers.get('Cache-Control', ''))
+        ttl = int(max_age.group(1)) if max_age else self.ttl
+        keys = {i['kid']: jwk_to_pem(i) for i in response.json()['keys']
+                if i.get('kty') == 'RSA'}
+        with self._lock:
+            self.keys = keys
+            self.fetched = time.time()
+            self.expires = self.fetched + ttl
+
+    def _refresh(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            log.warning('Signing keys not refreshed: %s', e)
+
+    def refresh_async(self):
+        """Fetch keys in a background thread, unless already fetching."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._refresh, daemon=True)
+            self._thread.start()
+
+    def get(self, key_id):
+        """Get PEM public key for key id, or None if unknown."""
+        thread = self._thread
+        if key_id not in self.keys and thread is not None:
+            thread.join(KEYS_TIMEOUT)  # e.g. fetch started at startup
+        now = time.time()
+        if key_id not in self.keys:
+            if now - self.fetched > KEYS_MIN_REFRESH:
+                self.fetch()
+        elif now > self.expires:
+            self.refresh_async()
+        return self.keys.get(key_id)
+
 
 class OAuthSignIn(object):
     providers = None
 
-    def __init__(self, provider_name):
+    def __init__(self, provider_name, config=None):
         self.provider_name = provider_name
-        credentials = current_app.config['OAUTH_CREDENTIALS'][provider_name]
+        config = current_app.config if config is None else config
+        credentials = config['OAUTH_CREDENTIALS'][provider_name]
+        self.credentials = credentials
         self.consumer_id = credentials['id']
         self.consumer_secret = credentials['secret']
 
@@ -19,6 +114,10 @@ class OAuthSignIn(object):
     def callback(self):
         pass
 
+    def prepare(self):
+        """Start fetching what sign-in will need, in the background."""
+        pass
+
     def get_callback_url(self):
         callback_url = url_for('oauth_callback', provider=self.provider_name,
                                _external=True, _scheme='https')
@@ -29,47 +128,92 @@ class OAuthSignIn(object):
         return callback_url
 
 
+    @classmethod
+    def load_providers(cls, config):
+        """Build all providers, e.g. at startup."""
+        cls.providers = {}
+        for provider_class in cls.__subclasses__():
+            provider = provider_class(config)
+            provider.prepare()
+            cls.providers[provider.provider_name] = provider
+
     @classmethod
     def get_provider(self, provider_name):
         if self.providers is None:
-            self.providers = {}
-            for provider_class in self.__subclasses__():
-                provider = provider_class()
-                self.providers[provider.provider_name] = provider
+            self.load_providers(current_app.config)
         return self.providers[provider_name]
 
 
 class GoogleSignIn(OAuthSignIn):
-    def __init__(self):
-        super(GoogleSignIn, self).__init__('google')
+    def __init__(self, config=None):
+        super(GoogleSignIn, self).__init__('google', config)
         self.service = OAuth2Service(
             name='google',
             client_id=self.consumer_id,
             client_secret=self.consumer_secret,
-            authorize_url='https://accounts.google.com/o/oauth2/auth',
-            access_token_url='https://www.googleapis.com/oauth2/v3/token',
-            base_url='https://people.googleapis.com/v1/'
+            authorize_url=self.credentials['authorize_url'],
+            access_token_url=self.credentials['access_token_url'],
+            base_url=self.credentials['base_url']
         )
+        self.keys = KeySet(self.credentials['certs_url'])
+        issuer = self.credentials['issuer']
+        self.issuers = {issuer, issuer.replace('https://', '')}
+
+    def prepare(self):
+        self.keys.refresh_async()
 
     def authorize(self):
         return redirect(self.service.get_authorize_url(
-            scope='email profile',
+            scope='openid email profile',
             response_type='code',
             redirect_uri=self.get_callback_url())
         )
 
-    def callback(self):
-        def decode_json(payload):
-            return json.loads(payload.decode('utf-8'))
+    def verify_id_token(self, id_token):
+        """Get claims of ID token, checking signature, audience and issuer.
+
+        Raises ValueError if the token is not valid, or its email address is
+        not verified (membership is granted by email domain, see
+        __init__.py).
+        """
+        from google.auth import jwt
+        if not id_token:
+            raise ValueError('No ID token.')
+        header = json.loads(_b64decode(id_token.split('.')[0]))
+        key = self.keys.get(header.get('kid'))
+        if key is None:
+            raise ValueError('Unknown signing key: {}'.format(
+                header.get('kid')))
+        claims = jwt.decode(id_token, certs={header['kid']: key},
+                            audience=self.consumer_id)
+        if claims.get('iss') not in self.issuers:
+            raise ValueError('Wrong issuer: {}'.format(claims.get('iss')))
+        if not claims.get('sub') or not claims.get('email'):
+            raise ValueError('No account id or email in ID token.')
+        if claims.get('email_verified') is not True:
+            raise ValueError('Email not verified: {}'.format(claims['email']))
+        return claims
 
+    def callback(self):
         if 'code' not in request.args:
             return None, None, None
-        oauth_session = self.service.get_auth_session(
+        response = self.service.get_raw_access_token(
             data={'code': request.args['code'],
                   'grant_type': 'authorization_code',
-                  'redirect_uri': self.get_callback_url()},
-            decoder=decode_json
-        )
+                  'redirect_uri': self.get_callback_url()})
+        token = response.json()
+        if 'access_token' not in token:
+            return None, None, None
+        try:
+            claims = self.verify_id_token(token.get('id_token'))
+        except Exception as e:
+            log.warning('ID token not verified, using profile API: %s', e)
+        else:
+            display_name = claims.get('name') or claims['email'].split('@')[0]
+            return claims['sub'], display_name, claims['email']
+
+        # FALLBACK: PROFILE API
+        oauth_session = self.service.get_session(token['access_token'])
         me = oauth_session.get('people/me?personFields=emailAddresses,names').json()
         account_id, email_primary, email_list = self.parse_email_addreses(me)
         display_name = self.parse_display_name(me)
@@ -1,20 +1,28 @@
+import json
 from collections import OrderedDict
+from datetime import datetime, timedelta
 
 from flask import redirect, url_for, render_template, flash, abort, \
-    current_app, request, session
+    current_app, request, session, Response, jsonify
 from flask_login import login_user, logout_user,\
     current_user, login_required
-import bokeh.client as bk_client
-import bokeh.embed as bk_embed
+from sqlalchemy.exc import IntegrityError
 
 from oauth import app, db, OAuthSignIn, update_members_and_emails, MEMBERS_DICT
+from . import feed, events
+from .caching import cached_page, get_list_version, get_request_version
+from .database import replica_reads
 from .admin import get_requests_df
 from .config import table_cols
 from .models import User, Strain, Request, Comment
-from .forms import StrainForm, RequestForm, StatusForm, VolunteerForm, \
-    CommentForm
-from .email import notify_lab, email_comment, email_new_status, \
-    email_new_volunteer
+from .forms import StrainForm, BasketForm, RequestForm, StatusForm, \
+    VolunteerForm, CommentForm, BulkUpdateForm
+from .email import notify_labs, email_comment, email_new_status, \
+    email_new_volunteer, email_bulk_update
+
+MAX_BASKET = 100  # most strains per request form
+N_SIMILAR_BASKET = 3  # similar strains shown per strain on request form
+MAX_SIMILAR = 20  # most similar strains per JSON response
 
 
 @app.route('/reload')
@@ -34,25 +42,140 @@ def load_members_list():
 def index():
     if not (current_user.is_authenticated and current_user.in_cgem):
         return render_template("index.html", script=None, form=None)
-    form = StrainForm()  # prefix='ship-'
-    if form.validate_on_submit():
-        # remember strain object in session, redirect to order form
-        strain = [(col, getattr(form, col).data) for col in table_cols]
-        session['strain'] = strain
-        return redirect(url_for('request_strain'))
-    # pull a new session from a running Bokeh server
+    # basket of selected strains, filled in and posted to request form by
+    # the bokeh app (see bk_server/main.py)
+    form = BasketForm()
+    # script for browser to open a new session on the Bokeh server. The
+    # session is created by whichever server process handles the browser's
+    # request, so this works with multi-process serving.
+    import bokeh.embed as bk_embed
     url = current_app.config['APP_URL']
-    with bk_client.pull_session(url=url) as bk_session:
-        # generate a script to load the customized session
-        script = bk_embed.server_session(session_id=bk_session.id, url=url)
-        # use the script in the rendered page
-        return render_template("index.html", script=script, form=form)
+    # pass filter state from page URL (e.g. /?lab=Soll) to bokeh session,
+    # and the URL of the export route, followed by format and filter state
+    arguments = {'filter': request.query_string.decode('utf-8'),
+                 'export': url_for('export_strains', fmt='')}
+    script = bk_embed.server_document(url=url, arguments=arguments)
+    return render_template("index.html", script=script, form=form)
+
+
+@app.route('/export/<fmt>')
+@login_required
+def export_strains(fmt):
+    """Stream strains matching filter key (query string) as csv/tsv/parquet."""
+    if not current_user.in_cgem:
+        abort(403)
+    from bk_server import export
+    if fmt not in export.FORMATS:
+        abort(404)
+    manifest = export.snapshot.read_manifest(export.SNAPSHOT_DIR)
+    if manifest is None:
+        abort(404)
+    mimetype, ext = export.FORMATS[fmt]
+    query = request.query_string.decode('utf-8')
+    file_name = 'strains-v{}.{}'.format(manifest['version'], ext)
+    return Response(export.iter_export(fmt, query, manifest=manifest),
+                    mimetype=mimetype, headers={
+                        'Content-Disposition':
+                            'attachment; filename={}'.format(file_name)})
+
+
+def parse_basket(strains_json):
+    """Get list of valid strain dicts from JSON basket, without duplicates."""
+    try:
+        rows = json.loads(strains_json or '[]')
+    except ValueError:
+        return []
+    strains = OrderedDict()
+    for row in rows[:MAX_BASKET] if isinstance(rows, list) else []:
+        if not isinstance(row, dict):
+            continue
+        data = {col: str(row.get(col) or '') for col in table_cols}
+        strain_form = StrainForm(formdata=None, data=data, meta={'csrf': False})
+        if data['lab'] and data['entry'] and strain_form.validate():
+            strains[(data['lab'], data['entry'])] = data
+    return list(strains.values())
+
+
+def _new_requests(strains, requester, address, email):
+    """Add new requests for list of strain dicts to the current transaction.
+
+    Strains already in the database are fetched in one query; the others are
+    inserted along with the requests.
+    """
+    labs = {i['lab'] for i in strains}
+    entries = {i['entry'] for i in strains}
+    known = {(i.lab, i.entry): i for i in Strain.query.filter(
+        Strain.lab.in_(labs), Strain.entry.in_(entries))}
+    rqs = []
+    for strain_dict in strains:
+        strain = known.get((strain_dict['lab'], strain_dict['entry']))
+        if strain is None:
+            strain = Strain(**strain_dict)
+        rq = Request(requester=requester, strain=strain,
+                     delivery_address=address, preferred_email=email)
+        events.log_event(rq, 'created', user=requester)
+        rqs.append(rq)
+    db.session.add_all(rqs)
+    return rqs
+
+
+def add_requests(strains, requester, address, email):
+    """Add requests for list of strain dicts, in a single transaction.
+
+    If a concurrent request inserts one of the new strains first, the
+    transaction is retried once, with that strain fetched instead. Returns
+    list of new requests.
+    """
+    for attempt in range(2):
+        try:
+            rqs = _new_requests(strains, requester, address, email)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if attempt:
+                raise
+            app.logger.info('Strain added concurrently, retrying requests.')
+        except Exception:
+            db.session.rollback()
+            raise
+        else:
+            return rqs
+
+
+def get_similar(fields, k=None, exclude_id=None, exclude_lab=None):
+    """Get list of catalogue strain dicts similar to fields, with similarity.
+
+    Empty if there is no strains snapshot, or while it is being indexed (see
+    bk_server/similar.py).
+    """
+    from bk_server import similar
+    index = similar.get_index()
+    if index is None:
+        return []
+    return index.similar(fields, k or similar.TOP_K, exclude_id=exclude_id,
+                         exclude_lab=exclude_lab)
+
+
+def get_request_page_version(request_id):
+    """Get version of request page: request and similarity index versions.
+
+    The index version follows the strains snapshot, checked at most every
+    few seconds (see bk_server/similar.py), so no file is read per page.
+    """
+    from bk_server import similar
+    version, last_modified = get_request_version(request_id)
+    if version is None:
+        return version, last_modified
+    index = similar.get_index()
+    return '{}-{}'.format(version, index and index.version), last_modified
 
 
 @app.route('/request',  methods=['POST', 'GET'])
 @login_required
 def request_strain():
-    if 'strain' not in session:
+    # strains posted by dashboard, then kept in hidden field of request form
+    strains = parse_basket(request.form.get('strains'))
+    if not strains:
         flash('You must select a strain for request.', 'error')
         return redirect(url_for('index'))
 
@@ -63,31 +186,34 @@ def request_strain():
     address = prev.delivery_address if prev else ''
 
     # SHIP REQUEST FORM
-    form = RequestForm(email=email, address=address)
-    if form.validate_on_submit():
-        strain_dict = dict(session.pop('strain'))
-        strain = Strain.query.filter_by(lab=strain_dict['lab'],
-                                        entry=strain_dict['entry']).first()
-        if not strain:
-            strain = Strain(**strain_dict)
-        rq = Request()
-        rq.requester = current_user
-        rq.strain = strain
-        rq.delivery_address = form.address.data
-        rq.preferred_email = form.email.data
-        db.session.add(rq)
-        db.session.commit()
-        flash('Success! Your strain request has been placed.', 'message')
-        notify_lab(rq)  # NOTIFY STRAIN LAB
+    form = RequestForm(email=email, address=address,
+                       strains=json.dumps(strains))
+    if form.submit.data and form.validate_on_submit():
+        rqs = add_requests(strains, current_user, form.address.data,
+                           form.email.data)
+        if len(rqs) == 1:
+            flash('Success! Your strain request has been placed.', 'message')
+        else:
+            flash('Success! Your {} strain requests have been placed.'.format(
+                len(rqs)), 'message')
+        notify_labs(rqs)  # NOTIFY STRAIN LABS, ONE EMAIL PER LAB
         return redirect(url_for('my_requests'))
 
+    # EQUIVALENT STRAINS HELD BY OTHER LABS
+    similar = OrderedDict(
+        ('{}_{}'.format(i['lab'], i['entry']),
+         get_similar(i, k=N_SIMILAR_BASKET, exclude_lab=i['lab']))
+        for i in strains)
+
     return render_template("basic.html", title='Strain Request',
-                           strain_data=session['strain'],
-                           form=form)
+                           strains=strains, cols=list(table_cols),
+                           form=form, similar=similar)
 
 
 @app.route('/requests')
 @login_required
+@replica_reads
+@cached_page(lambda: get_list_version())
 def list_requests():
     requests = Request.query.order_by(Request.creation_time.desc()).all()
     if not requests:
@@ -101,6 +227,8 @@ def list_requests():
 
 @app.route('/my-requests')
 @login_required
+@replica_reads
+@cached_page(lambda: get_list_version(requester_id=current_user.id))
 def my_requests():
     requests = Request.query.filter(Request.requester == current_user).\
             order_by(Request.creation_time.desc()).all()
@@ -114,8 +242,60 @@ def my_requests():
                            df=df, categ="my-requests")
 
 
-@app.route('/my-shipments')
+def update_requests(request_ids, user, status=None, shipper_id=None):
+    """Set status and/or shipper of many requests with a single UPDATE.
+
+    Only requests whose status or shipper changes are updated, and get
+    events for the fields that changed. Notifies each recipient once,
+    listing all of their changed requests. Returns list of updated requests.
+    """
+    if not request_ids or not (status or shipper_id):
+        return []
+    old_rqs = Request.query.filter(Request.id.in_(request_ids)).options(
+        db.joinedload(Request.shipper)).all()
+    values = {}
+    changes = []  # conditions for a row to change
+    status_labs = {}  # {request id: strain lab} of status changes
+    shipper_labs = {}
+    if status:
+        values['status'] = status
+        changes.append(db.or_(Request.status.is_(None),
+                              Request.status != status))
+        status_labs = {i.id: i.strain_lab for i in old_rqs
+                       if i.status != status}
+    if shipper_id:
+        values['shipper_id'] = shipper_id
+        changes.append(db.or_(Request.shipper_id.is_(None),
+                              Request.shipper_id != shipper_id))
+        shipper_labs = {i.id: i.strain_lab for i in old_rqs
+                        if i.shipper_id != shipper_id}
+    changed_ids = sorted(set(status_labs) | set(shipper_labs))
+    if not changed_ids:
+        return []
+    values['version'] = Request.version + 1
+    old_shippers = {i.id: i.shipper for i in old_rqs if i.id in shipper_labs}
+    Request.query.filter(Request.id.in_(changed_ids), db.or_(*changes)).\
+        update(values, synchronize_session=False)
+    if shipper_labs:
+        shipper = User.query.get(shipper_id)
+        events.log_events(shipper_labs, 'shipper', user=user,
+                          value=shipper.display_name)
+    if status_labs:
+        events.log_events(status_labs, 'status', user=user, value=status)
+    db.session.commit()
+    rqs = Request.query.filter(Request.id.in_(changed_ids)).options(
+        db.joinedload(Request.requester), db.joinedload(Request.shipper),
+        db.joinedload(Request.strain)).order_by(Request.id).all()
+    for rq in rqs:
+        feed.set_version(rq.id, rq.version)
+    email_bulk_update(rqs, user, old_shippers=old_shippers)
+    return rqs
+
+
+@app.route('/my-shipments', methods=['POST', 'GET'])
 @login_required
+@replica_reads
+@cached_page(lambda: get_list_version(shipper_id=current_user.id))
 def my_shipments():
     requests = Request.query.filter(Request.shipper == current_user).\
             order_by(Request.creation_time.desc()).all()
@@ -123,14 +303,35 @@ def my_shipments():
         flash("You haven't volunteered for any shipments.", 'error')
         return redirect(url_for('list_requests'))
 
+    # BULK STATUS/SHIPPER UPDATE OF SELECTED SHIPMENTS
+    form = BulkUpdateForm()
+    form.request_ids.choices = [(i.id, i.id) for i in requests]
+    shippers = User.query.filter_by(in_cgem=True).order_by(User.display_name)
+    form.shipper_id.choices = [(0, 'Unchanged')] + [
+        (i.id, i.display_name) for i in shippers]
+    if form.validate_on_submit():
+        rqs = update_requests(form.request_ids.data, current_user,
+                              status=form.status.data,
+                              shipper_id=form.shipper_id.data)
+        if rqs:
+            flash('Updated {} requests.'.format(len(rqs)), 'message')
+        else:
+            flash('Choose a new status or shipper to update requests.',
+                  'error')
+        return redirect(url_for('my_shipments'))
+    elif form.is_submitted():
+        flash('Select your shipments to update.', 'error')
+
     df = get_requests_df(requests)
 
     return render_template("requests.html", title='My Shipments',
-                           df=df, categ="my-shipments")
+                           df=df, categ="my-shipments", form=form)
 
 
 @app.route('/request/<request_id>', methods=['POST', 'GET'])
 @login_required
+@replica_reads
+@cached_page(get_request_page_version)
 def show_request(request_id):
 
     rq = Request.query.filter_by(id=request_id).first_or_404()
@@ -152,11 +353,15 @@ def show_request(request_id):
     if volunteer_form.submit.data:
         rq.shipper = current_user
         rq.status = 'processing'
+        rq.bump_version()
+        events.log_event(rq, 'shipper', user=current_user,
+                         value=current_user.display_name)
+        events.log_event(rq, 'status', user=current_user, value=rq.status)
         db.session.add(rq)
         db.session.commit()
+        feed.set_version(rq.id, rq.version)
         email_new_volunteer(rq)
         flash('Thanks for volunteering to handle this request!', 'message')
-        meta['Shipper'] = rq.shipper.display_name
 
     # STATUS FOLLOWS VOLUNTEER FORM TO ALLOW STATUS UPDATE
     status = rq.status if rq.status != 'unassigned' else 'processing'
@@ -166,8 +371,11 @@ def show_request(request_id):
         new_status = status_form.status.data
         if old_status != new_status:
             rq.status = new_status
+            rq.bump_version()
+            events.log_event(rq, 'status', user=current_user, value=new_status)
             db.session.add(rq)
             db.session.commit()
+            feed.set_version(rq.id, rq.version)
             email_new_status(rq, current_user)
             flash('Status changed to {}.'.format(new_status), 'message')
         else:
@@ -179,17 +387,130 @@ def show_request(request_id):
         comment.content = comment_form.content.data
         comment.commenter = current_user
         comment.request = rq
+        rq.bump_version()
+        events.log_event(rq, 'comment', user=current_user)
         db.session.add(comment)
         db.session.commit()
+        feed.set_version(rq.id, rq.version)
         flash('Thanks for your comment!', 'message')
         email_comment(comment)
 
+    # LIVE FIELDS, UPDATED BY PAGE FROM FEED
+    meta['Status'] = rq.status
+    meta['Shipper'] = rq.shipper.display_name if rq.shipper else ''
+
     return render_template("request_single.html", title='Current Requests',
                            meta=meta, rq=rq, strain_dict=strain_dict,
                            status_form=status_form,
                            volunteer_form=volunteer_form,
                            comment_form=comment_form,
-                           comments=rq.comments)
+                           comments=rq.comments,
+                           timeline=events.get_timeline(rq.id),
+                           similar=get_similar(
+                               strain_dict, exclude_id=strain.get_strain_id(),
+                               exclude_lab=strain.lab))
+
+
+@app.route('/request-stats')
+@login_required
+@replica_reads
+def request_stats():
+    """Show request counts and handling times per lab, from event log."""
+    if not current_user.in_cgem:
+        abort(403)
+    days = request.args.get('days', type=int)
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    stats = events.get_lab_stats(since=since)
+    return render_template("stats.html", title='Request Statistics',
+                           stats=stats, days=days)
+
+
+def comment_dict(comment):
+    return OrderedDict([
+        ('id', comment.id),
+        ('commenter', comment.commenter.display_name),
+        ('creation_time', str(comment.creation_time)),
+        ('content', comment.content),
+    ])
+
+
+@app.route('/strains/similar')
+@login_required
+def similar_strains():
+    """Get strains similar to a catalogue strain, or to given text, as JSON.
+
+    The strain is given by 'lab' and 'entry' arguments. Only strains of other
+    labs are returned, unless 'all_labs' is set. Without lab and entry,
+    strains similar to 'plasmid', 'strain' and 'desc' arguments are returned.
+    'k' is the number of strains (see bk_server/similar.py). Answers 503
+    while the strains snapshot is being indexed.
+    """
+    if not current_user.in_cgem:
+        abort(403)
+    from bk_server import similar
+    index = similar.get_index()
+    if index is None:
+        abort(503)
+    k = max(1, min(request.args.get('k', similar.TOP_K, type=int),
+                   MAX_SIMILAR))
+    lab = request.args.get('lab')
+    entry = request.args.get('entry')
+    strain_id = None
+    exclude_lab = None
+    if lab and entry:
+        strain_id = '{}_{}'.format(lab, entry)
+        fields = index.get_strain(strain_id)
+        if fields is None:
+            abort(404)
+        if not request.args.get('all_labs'):
+            exclude_lab = lab
+    else:
+        fields = {col: request.args.get(col, '')
+                  for col in similar.SIMILAR_COLS}
+    return jsonify(OrderedDict([
+        ('version', index.version),
+        ('strain', strain_id),
+        ('similar', index.similar(fields, k, exclude_id=strain_id,
+                                  exclude_lab=exclude_lab)),
+    ]))
+
+
+@app.route('/request/<int:request_id>/updates')
+def request_updates(request_id):
+    """Long-poll for changes to request after version 'since'.
+
+    Responds with 204 if nothing changed within feed.POLL_TIMEOUT. If
+    feed.MAX_WAITERS polls are already waiting, answers at once instead, with
+    Retry-After (feed.POLL_INTERVAL) if nothing changed. Otherwise responds
+    with the request's version, status, shipper and the comments newer than
+    comment id 'after'. The user is loaded as for other pages (e.g. from
+    the remember-me cookie), but not updated (see before_request); unchanged
+    versions need no other database query.
+    """
+    if not current_user.is_authenticated:
+        abort(401)
+    if not current_user.in_cgem:
+        abort(403)
+    since = request.args.get('since', 0, type=int)
+    after = request.args.get('after', 0, type=int)
+    with feed.waiter_slot() as wait:
+        version = feed.wait_for_version(request_id, since,
+                                        timeout=None if wait else 0)
+    if version is None:
+        abort(404)
+    if version <= since:
+        headers = {} if wait else {'Retry-After': str(feed.POLL_INTERVAL)}
+        return '', 204, headers
+    rq = Request.query.get_or_404(request_id)
+    comments = Comment.query.filter(Comment.request_id == request_id,
+                                    Comment.id > after).\
+        order_by(Comment.id).options(db.joinedload(Comment.commenter)).all()
+    return jsonify(OrderedDict([
+        ('version', rq.version),
+        ('status', rq.status),
+        ('shipper', rq.shipper.display_name if rq.shipper else ''),
+        ('comments', [comment_dict(i) for i in comments]),
+    ]))
 
 
 @app.route('/logout')
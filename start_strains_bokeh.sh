@@ -9,9 +9,16 @@ source ${ROOT_DIR}/${ENV_NAME:-.env}
 export FLASK_ENV=${FLASK_ENV:-production}
 PORT_BOKEH=${PORT_BOKEH:-5101}
 ADDRESS=${ADDRESS:-127.0.0.1}
+# server processes (0: one per CPU); all share the on-disk strains snapshot
+BOKEH_NUM_PROCS=${BOKEH_NUM_PROCS:-1}
+# milliseconds before sessions without open connections are discarded
+UNUSED_SESSION_LIFETIME=${UNUSED_SESSION_LIFETIME:-60000}
 
 ${PY_HOME}/bin/bokeh serve --port ${PORT_BOKEH} \
  --allow-websocket-origin=${HOST_URL} \
  --allow-websocket-origin=${ADDRESS}:${PORT_BOKEH} \
  --address 127.0.0.1 \
+ --num-procs ${BOKEH_NUM_PROCS} \
+ --unused-session-lifetime ${UNUSED_SESSION_LIFETIME} \
+ --check-unused-sessions 10000 \
  --show ${ROOT_DIR}/bk_server
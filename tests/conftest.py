@@ -0,0 +1,52 @@
+"""Test setup: the apps are pointed at a temporary directory.
+
+The environment is configured as for the benchmarks (see benchmarks/run.py)
+before any app module is imported, so no local env file or database is used.
+"""
+
+import tempfile
+
+import pytest
+
+from benchmarks.run import configure_env
+
+WORKDIR = tempfile.mkdtemp(prefix='strains-tests-')
+configure_env(WORKDIR)
+
+
+@pytest.fixture(scope='session')
+def strains_df():
+    from benchmarks import synthetic
+    return synthetic.make_strains(n_rows=500)
+
+
+@pytest.fixture(scope='session')
+def flask_app(strains_df):
+    """Get Flask app, with a database of members' requests and comments.
+
+    Google Sheets, Directory and SMTP are served by the benchmark fakes.
+    """
+    from benchmarks import synthetic, fakes
+    from benchmarks.run import populate_db
+    from bk_server import data
+    data.save_snapshot(strains_df)
+    from oauth import app, db
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        members = populate_db(db, strains_df, n_requests=50)
+    spreadsheet = fakes.make_spreadsheet(
+        synthetic.make_sheet_records(strains_df))
+    with fakes.patch_google_sheets(spreadsheet), \
+            fakes.patch_directory(members), fakes.patch_smtp():
+        yield app
+
+
+@pytest.fixture
+def client(flask_app):
+    """Get test client, logged in as user 1, a member, after a first page."""
+    client = flask_app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+        sess['_fresh'] = True
+    client.get('/my-requests')  # records membership of user
+    return client
@@ -0,0 +1,52 @@
+"""Tests of bulk status/shipper updates on My Shipments (oauth/routes.py)."""
+
+import pytest
+
+from oauth import db, routes
+from oauth.models import Request, RequestEvent
+
+
+@pytest.fixture
+def shipments(flask_app):
+    """Get ids of two requests shipped by user 1: processing, and shipped."""
+    with flask_app.app_context():
+        rqs = Request.query.order_by(Request.id).limit(2).all()
+        for rq, status in zip(rqs, ['processing', 'shipped']):
+            rq.shipper_id = 1
+            rq.status = status
+        db.session.commit()
+        return [i.id for i in rqs]
+
+
+def n_events(request_id, kind):
+    return RequestEvent.query.filter_by(request_id=request_id,
+                                        kind=kind).count()
+
+
+def test_only_changed_requests_updated(flask_app, client, shipments,
+                                       monkeypatch):
+    emailed = []
+    monkeypatch.setattr(routes, 'email_bulk_update',
+                        lambda rqs, *args, **kwargs: emailed.extend(rqs))
+    changed, unchanged = shipments
+    with flask_app.app_context():
+        versions = {i: Request.query.get(i).version for i in shipments}
+        events = {i: n_events(i, 'status') for i in shipments}
+    response = client.post('/my-shipments', data={
+        'request_ids': shipments, 'status': 'shipped', 'shipper_id': '0',
+        'submit': 'Update selected'})
+    assert response.status_code == 302
+    with flask_app.app_context():
+        assert Request.query.get(changed).status == 'shipped'
+        assert Request.query.get(changed).version == versions[changed] + 1
+        assert Request.query.get(unchanged).version == versions[unchanged]
+        assert n_events(changed, 'status') == events[changed] + 1
+        assert n_events(unchanged, 'status') == events[unchanged]
+    assert [i.id for i in emailed] == [changed]
+
+
+def test_unchanged_selection_updates_nothing(flask_app, shipments):
+    with flask_app.app_context():
+        from oauth.models import User
+        user = User.query.get(1)
+        assert routes.update_requests(shipments, user, shipper_id=1) == []
@@ -0,0 +1,34 @@
+"""Tests of conditional GETs of request pages (oauth/caching.py)."""
+
+
+def get_etag(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    return response.headers['ETag']
+
+
+def test_matching_etag_not_modified(client):
+    get_etag(client, '/requests')  # first render sets the CSRF secret
+    etag = get_etag(client, '/requests')
+    response = client.get('/requests', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+
+def test_other_etag_rendered(client):
+    get_etag(client, '/requests')
+    response = client.get('/requests', headers={'If-None-Match': 'W/"old"'})
+    assert response.status_code == 200
+    assert response.data
+
+
+def test_etag_changes_with_request(client):
+    get_etag(client, '/request/1')
+    etag = get_etag(client, '/request/1')
+    response = client.post('/request/1', data={
+        'comment-content': 'Ready soon', 'comment-submit': 'Post comment'})
+    assert response.status_code in (200, 302)
+    response = client.get('/request/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,65 @@
+"""Tests of the request change feed (oauth/feed.py)."""
+
+import time
+
+from oauth import feed
+
+
+def get_version(client, request_id=1):
+    return client.get('/request/{}/updates'.format(request_id)).\
+        get_json()['version']
+
+
+def test_changed_request_answered_with_changes(client):
+    response = client.get('/request/1/updates?since=0')
+    assert response.status_code == 200
+    assert response.get_json()['version'] >= 1
+
+
+def test_unchanged_request_waits_for_timeout(client, monkeypatch):
+    monkeypatch.setattr(feed, 'POLL_TIMEOUT', 0.2)
+    version = get_version(client)
+    start = time.time()
+    response = client.get('/request/1/updates?since={}'.format(version))
+    assert response.status_code == 204
+    assert time.time() - start >= 0.2
+    assert 'Retry-After' not in response.headers
+
+
+def test_poll_beyond_max_waiters_answered_at_once(client, monkeypatch):
+    monkeypatch.setattr(feed, 'POLL_TIMEOUT', 5)
+    monkeypatch.setattr(feed, 'MAX_WAITERS', 0)
+    version = get_version(client)
+    start = time.time()
+    response = client.get('/request/1/updates?since={}'.format(version))
+    assert response.status_code == 204
+    assert time.time() - start < 1
+    assert response.headers['Retry-After'] == str(feed.POLL_INTERVAL)
+
+
+def test_waiter_slots_released(monkeypatch):
+    monkeypatch.setattr(feed, 'MAX_WAITERS', 1)
+    with feed.waiter_slot() as first:
+        with feed.waiter_slot() as second:
+            assert (first, second) == (True, False)
+    with feed.waiter_slot() as third:
+        assert third
+
+
+def test_unknown_request_not_found(client):
+    assert client.get('/request/100000/updates').status_code == 404
+
+
+def test_remember_cookie_login_accepted(flask_app, client):
+    from flask_login.utils import encode_cookie
+    with flask_app.test_request_context():
+        remember = encode_cookie('1')
+    remembered = flask_app.test_client()
+    remembered.set_cookie('localhost', flask_app.config.get(
+        'REMEMBER_COOKIE_NAME', 'remember_token'), remember)
+    assert remembered.get('/request/1/updates?since=0').status_code == 200
+
+
+def test_anonymous_poll_unauthorized(flask_app):
+    client = flask_app.test_client()
+    assert client.get('/request/1/updates?since=0').status_code == 401
@@ -0,0 +1,151 @@
+"""Tests of the strains filter engine (bk_server/filters.py)."""
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bk_server import filters
+
+COLS = ['lab', 'marker1', 'organism']
+
+
+@pytest.fixture
+def strains():
+    return pd.DataFrame(OrderedDict([
+        ('lab', ['Cate', 'Cate', 'Soll', 'Soll', 'Mukh', 'Mukh']),
+        ('marker1', ['KanR', 'AmpR', 'KanR', 'CmR', 'AmpR', 'SpecR']),
+        ('organism', ['E. coli', 'E. coli', 'Yeast', 'E. coli', 'Yeast',
+                      'E. coli']),
+    ]))
+
+
+@pytest.fixture
+def codes(strains):
+    return filters.encode_strains(strains, COLS)
+
+
+def rows(mask):
+    return list(np.flatnonzero(mask))
+
+
+def test_no_selection_matches_all(codes):
+    assert rows(filters.filter_mask(codes)) == list(range(6))
+
+
+def test_or_within_category(codes):
+    mask = filters.filter_mask(codes, include={'marker1': {'KanR', 'AmpR'}})
+    assert rows(mask) == [0, 1, 2, 4]
+
+
+def test_and_across_categories(codes):
+    mask = filters.filter_mask(codes, include={
+        'marker1': {'KanR', 'AmpR'}, 'organism': {'Yeast'}})
+    assert rows(mask) == [2, 4]
+
+
+def test_exclude(codes):
+    mask = filters.filter_mask(codes, exclude={
+        'marker1': {'KanR'}, 'lab': {'Mukh'}})
+    assert rows(mask) == [1, 3]
+
+
+def test_include_and_exclude(codes):
+    mask = filters.filter_mask(codes, include={'lab': {'Cate', 'Soll'}},
+                               exclude={'organism': {'Yeast'}})
+    assert rows(mask) == [0, 1, 3]
+
+
+def test_unknown_value_matches_nothing(codes):
+    mask = filters.filter_mask(codes, include={'marker1': {'TetR'}})
+    assert rows(mask) == []
+    mask = filters.filter_mask(codes, include={'marker1': {'TetR', 'CmR'}})
+    assert rows(mask) == [3]
+    mask = filters.filter_mask(codes, exclude={'marker1': {'TetR'}})
+    assert rows(mask) == list(range(6))
+
+
+def test_categorical_input(strains, codes):
+    cat_strains = strains.astype('category')
+    cat_codes = filters.encode_strains(cat_strains, COLS)
+    selection = {'marker1': {'KanR', 'AmpR'}, 'organism': {'E. coli'}}
+    cat_mask = filters.filter_mask(cat_codes, include=selection)
+    assert rows(cat_mask) == rows(filters.filter_mask(codes,
+                                                      include=selection))
+    assert rows(cat_mask) == [0, 1]
+    subset = filters.filter_strains(cat_strains, cat_codes,
+                                    exclude={'lab': {'Cate'}})
+    assert list(subset.index) == [2, 3, 4, 5]
+
+
+def test_selection_from_pairs_ignores_all():
+    selection = filters.selection_from_pairs([
+        ('lab', 'Cate'), ('lab', filters.ALL_VAL), ('marker1', 'KanR'),
+        ('lab', 'Soll'), ('organism', filters.ALL_VAL)])
+    assert selection == {'lab': {'Cate', 'Soll'}, 'marker1': {'KanR'}}
+
+
+def test_expand_other(codes):
+    other = {'marker1': ['CmR', 'SpecR']}
+    selection = {'marker1': {'KanR', filters.OTHER_VAL}, 'lab': {'Soll'}}
+    expanded = filters.expand_other(selection, other)
+    assert expanded == {'marker1': {'KanR', 'CmR', 'SpecR'},
+                        'lab': {'Soll'}}
+    assert rows(filters.filter_mask(codes, include=expanded)) == [2, 3]
+    # 'Other' of a category without a bucket matches nothing
+    unbucketed = {'lab': {filters.OTHER_VAL}}
+    assert filters.expand_other(unbucketed, other) == unbucketed
+    assert filters.expand_other(unbucketed, None) == unbucketed
+
+
+def test_filter_rows(codes):
+    state = filters.new_filter_state(
+        excluded=OrderedDict([('marker1', {filters.OTHER_VAL})]))
+    other = {'marker1': ['CmR', 'SpecR']}
+    assert list(filters.filter_rows(codes, state, other=other)) == [0, 1, 2, 4]
+
+
+def test_filter_rows_include_and_exclude_bars(codes):
+    # include a lab while excluding a marker, as separately selected bars
+    state = filters.new_filter_state(
+        OrderedDict([('lab', {'Cate', 'Soll'})]),
+        excluded=OrderedDict([('marker1', {'KanR'})]))
+    assert list(filters.filter_rows(codes, state)) == [1, 3]
+    # included and excluded bars of the same category
+    state = filters.new_filter_state(
+        OrderedDict([('organism', {'E. coli'})]),
+        excluded=OrderedDict([('organism', {'Yeast'}),
+                              ('lab', {'Mukh'})]))
+    assert list(filters.filter_rows(codes, state)) == [0, 1, 3]
+
+
+def test_filter_key_round_trip():
+    state = filters.new_filter_state(
+        OrderedDict([('marker1', {'KanR', 'AmpR'}), ('lab', {'Cate'})]),
+        excluded=OrderedDict([('organism', {'Yeast'})]), search='gfp')
+    key = filters.filter_key(state)
+    assert key == ('lab=Cate&marker1=AmpR&marker1=KanR&-organism=Yeast'
+                   '&q=gfp')
+    parsed = filters.parse_filter_key(key, COLS)
+    assert dict(parsed['selection']) == dict(state['selection'])
+    assert dict(parsed['excluded']) == dict(state['excluded'])
+    assert parsed['search'] == 'gfp'
+
+
+def test_parse_legacy_exclude_key():
+    parsed = filters.parse_filter_key('lab=Cate&marker1=KanR&mode=exclude',
+                                      COLS)
+    assert dict(parsed['selection']) == {}
+    assert dict(parsed['excluded']) == {'lab': {'Cate'},
+                                        'marker1': {'KanR'}}
+
+
+def test_filter_key_expanded():
+    state = filters.new_filter_state(
+        OrderedDict([('marker1', {'CmR'})]), expanded=['organism', 'marker1'])
+    key = filters.filter_key(state)
+    assert key == 'marker1=CmR&expand=marker1&expand=organism'
+    parsed = filters.parse_filter_key(key + '&expand=unknown', COLS)
+    assert parsed['expanded'] == ['marker1', 'organism']
+    assert dict(parsed['selection']) == {'marker1': {'CmR'}}
@@ -0,0 +1,57 @@
+"""Tests of staged ingest of lab worksheets (bk_server/ingest.py)."""
+
+import os
+import sys
+import types
+import uuid
+import importlib
+
+import pytest
+
+import bk_server
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def bokeh_app_ingest():
+    """Get ingest module imported as by `bokeh serve bk_server`."""
+    name = 'bokeh_app_' + uuid.uuid4().hex
+    package = types.ModuleType(name)
+    package.__package__ = name
+    package.__path__ = [os.path.dirname(os.path.abspath(bk_server.__file__))]
+    sys.modules[name] = package
+    module = importlib.import_module(name + '.ingest')
+    yield module
+    module.shutdown_pool()
+    for key in [i for i in sys.modules if i.split('.')[0] == name]:
+        del sys.modules[key]
+
+
+@pytest.fixture
+def jobs():
+    df = synthetic.make_strains(n_rows=300, n_labs=3)
+    return {lab: (records, None, None) for lab, records in
+            synthetic.make_sheet_records(df).items()}
+
+
+def test_pool_builds_partitions_of_bokeh_app_package(
+        bokeh_app_ingest, jobs, tmp_path, monkeypatch):
+    def build_in_process(*args, **kwargs):
+        raise AssertionError('built in-process, not in worker pool')
+    monkeypatch.setattr(bokeh_app_ingest, 'INGEST_WORKERS', 2)
+    monkeypatch.setattr(bokeh_app_ingest, 'INGEST_MIN_ROWS', 0)
+    monkeypatch.setattr(bokeh_app_ingest, 'build_partition', build_in_process)
+    parts, timings, workers = bokeh_app_ingest.build_partitions(
+        str(tmp_path), jobs)
+    assert workers == 2
+    assert list(parts) == list(jobs)
+    assert all(os.path.exists(os.path.join(str(tmp_path), i['path']))
+               for i in parts.values())
+    assert list(timings) == bokeh_app_ingest.BUILD_STAGES
+
+
+def test_small_builds_run_in_process(jobs, tmp_path):
+    from bk_server import ingest
+    parts, timings, workers = ingest.build_partitions(str(tmp_path), jobs)
+    assert workers == 1
+    assert list(parts) == list(jobs)
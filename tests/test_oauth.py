@@ -0,0 +1,77 @@
+"""Tests of ID token verification at sign-in (oauth/oauth.py)."""
+
+import time
+
+import pytest
+
+CLIENT_ID = 'client-1'
+ISSUER = 'https://accounts.google.com'
+KEY_ID = 'key-1'
+
+
+@pytest.fixture(scope='module')
+def private_pem():
+    import rsa
+    public_key, private_key = rsa.newkeys(1024)
+    return public_key.save_pkcs1(), private_key.save_pkcs1()
+
+
+@pytest.fixture
+def provider(private_pem):
+    from oauth.oauth import GoogleSignIn
+    credentials = {
+        'id': CLIENT_ID, 'secret': 'secret',
+        'authorize_url': 'https://example.com/auth',
+        'access_token_url': 'https://example.com/token',
+        'base_url': 'https://example.com/v1/',
+        'certs_url': 'https://example.com/certs', 'issuer': ISSUER}
+    provider = GoogleSignIn({'OAUTH_CREDENTIALS': {'google': credentials}})
+    provider.keys.keys = {KEY_ID: private_pem[0]}
+    provider.keys.fetched = time.time()
+    provider.keys.expires = time.time() + 3600
+    return provider
+
+
+@pytest.fixture
+def make_token(private_pem):
+    from google.auth import crypt, jwt
+
+    def make_token(key_id=KEY_ID, **claims):
+        now = int(time.time())
+        payload = {'iss': ISSUER, 'aud': CLIENT_ID, 'iat': now,
+                   'exp': now + 3600, 'sub': '123',
+                   'email': 'someone@gem-net.net', 'email_verified': True}
+        payload.update(claims)
+        signer = crypt.RSASigner.from_string(private_pem[1], key_id)
+        return jwt.encode(signer, payload).decode('ascii')
+    return make_token
+
+
+def test_valid_token(provider, make_token):
+    claims = provider.verify_id_token(make_token())
+    assert claims['sub'] == '123'
+    assert claims['email'] == 'someone@gem-net.net'
+
+
+@pytest.mark.parametrize('claims', [
+    {'aud': 'other-client'},
+    {'iss': 'https://accounts.example.com'},
+    {'iat': int(time.time()) - 7200, 'exp': int(time.time()) - 3600},
+    {'email_verified': False},
+    {'email_verified': 'true'},
+    {'email_verified': None},
+], ids=['audience', 'issuer', 'expired', 'unverified', 'string_verified',
+        'no_verified'])
+def test_invalid_claims_rejected(provider, make_token, claims):
+    with pytest.raises(ValueError):
+        provider.verify_id_token(make_token(**claims))
+
+
+def test_unknown_key_id_rejected(provider, make_token):
+    with pytest.raises(ValueError, match='Unknown signing key'):
+        provider.verify_id_token(make_token(key_id='key-2'))
+
+
+def test_no_token_rejected(provider):
+    with pytest.raises(ValueError):
+        provider.verify_id_token(None)
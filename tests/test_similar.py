@@ -0,0 +1,81 @@
+"""Tests of the similar strains lookup (bk_server/similar.py)."""
+
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+
+from bk_server import similar
+from bk_server.data import table_cols
+from oauth import routes
+
+
+@pytest.fixture
+def index():
+    plasmids = ['pUC19-sfGFP-KanR-v1', 'pUC19-sfGFP-KanR-v2',
+                'pUC19-sfGFP-KanR', 'pUC19-sfGFP-AmpR', 'pSC101-mCherry-CmR',
+                'xyzzy']
+    labs = ['Cate', 'Soll', 'Mukh', 'Cate', 'Soll', 'Mukh']
+    df = pd.DataFrame(OrderedDict(
+        (col, [similar.BLANK] * len(labs)) for col in table_cols))
+    df['lab'] = labs
+    df['entry'] = [str(i + 1) for i in range(len(labs))]
+    df['plasmid'] = plasmids
+    return similar.SimilarityIndex(df, version=1)
+
+
+def plasmids(results):
+    return [i['plasmid'] for i in results]
+
+
+def test_top_k_ranked_by_similarity(index):
+    fields = {'plasmid': 'pUC19-sfGFP-KanR-v1'}
+    results = index.similar(fields, k=3)
+    assert plasmids(results) == ['pUC19-sfGFP-KanR-v1', 'pUC19-sfGFP-KanR-v2',
+                                 'pUC19-sfGFP-KanR']
+    similarity = [i['similarity'] for i in results]
+    assert similarity[0] == 1
+    assert similarity == sorted(similarity, reverse=True)
+    assert plasmids(index.similar(fields, k=1)) == ['pUC19-sfGFP-KanR-v1']
+    assert 'xyzzy' not in plasmids(index.similar(fields, k=10))
+
+
+def test_excluded_strain_and_lab(index):
+    strain = index.get_strain('Cate_1')
+    results = index.similar(strain, exclude_id='Cate_1')
+    assert plasmids(results)[:2] == ['pUC19-sfGFP-KanR-v2', 'pUC19-sfGFP-KanR']
+    results = index.similar(strain, exclude_lab='Soll')
+    assert 'Soll' not in [i['lab'] for i in results]
+    assert index.get_strain('Cate_100') is None
+    assert index.similar({'plasmid': ''}) == []
+
+
+@pytest.fixture
+def index_ready(flask_app):
+    """Wait for index of the app's strains snapshot."""
+    index = similar.get_index(wait=True)
+    assert index is not None
+    return index
+
+
+def get_similar(client, **args):
+    response = client.get('/strains/similar', query_string=args)
+    assert response.status_code == 200
+    return response.get_json()['similar']
+
+
+def test_similar_route_clamps_k(client, index_ready, monkeypatch):
+    strain = index_ready.get_strain(index_ready.ids[0])
+    fields = {col: strain[col] for col in similar.SIMILAR_COLS}
+    assert len(get_similar(client, **fields)) == similar.TOP_K
+    monkeypatch.setattr(routes, 'MAX_SIMILAR', 2)
+    results = get_similar(client, k=0, **fields)
+    assert len(results) == 1
+    assert results[0]['similarity'] == 1
+    assert len(get_similar(client, k=-5, **fields)) == 1
+    assert len(get_similar(client, k=1000, **fields)) == 2
+
+
+def test_similar_route_unknown_strain(client, index_ready):
+    response = client.get('/strains/similar?lab=Nobody&entry=1')
+    assert response.status_code == 404
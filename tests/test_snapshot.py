@@ -0,0 +1,91 @@
+"""Tests of versioned strains snapshots (bk_server/snapshot.py)."""
+
+import os
+from collections import OrderedDict
+
+import pandas as pd
+
+from bk_server import snapshot
+
+COLUMNS = ['lab', 'entry', 'plasmid']
+
+
+def make_df(lab, n_rows, tag=''):
+    return pd.DataFrame(OrderedDict([
+        ('lab', [lab] * n_rows),
+        ('entry', [str(i + 1) for i in range(n_rows)]),
+        ('plasmid', ['p{}{}{}'.format(lab, tag, i) for i in range(n_rows)]),
+    ]))
+
+
+def publish_labs(snapshot_dir, dfs, prev=None):
+    """Publish {lab: df}, reusing partitions of prev manifest for others."""
+    partitions = OrderedDict(prev['partitions']) if prev else OrderedDict()
+    for lab, df in dfs.items():
+        old = partitions.get(lab)
+        partitions[lab] = snapshot.write_partition(snapshot_dir, lab, df,
+                                                   prev=old)
+    return snapshot.publish(snapshot_dir, partitions, COLUMNS)
+
+
+def test_publish_and_read(tmp_path):
+    snapshot_dir = str(tmp_path)
+    dfs = OrderedDict([('Cate', make_df('Cate', 3)),
+                       ('Soll', make_df('Soll', 2))])
+    manifest = publish_labs(snapshot_dir, dfs)
+    assert manifest == snapshot.read_manifest(snapshot_dir)
+    assert (manifest['version'], manifest['n_rows']) == (1, 5)
+    assert manifest['columns'] == COLUMNS
+    df = snapshot.read_snapshot(snapshot_dir, manifest)
+    expected = pd.concat(list(dfs.values()), ignore_index=True)
+    pd.testing.assert_frame_equal(df.astype(str), expected)
+    assert all(isinstance(df[i].dtype, pd.CategoricalDtype) for i in COLUMNS)
+    # cached per process, shared by sessions
+    assert snapshot.read_snapshot(snapshot_dir, manifest) is df
+    assert snapshot.last_memory['shared'] > 0
+    assert snapshot.last_memory['private'] > 0
+
+
+def test_publish_reuses_unchanged_partitions(tmp_path):
+    snapshot_dir = str(tmp_path)
+    first = publish_labs(snapshot_dir, OrderedDict([
+        ('Cate', make_df('Cate', 3)), ('Soll', make_df('Soll', 2))]))
+    second = publish_labs(snapshot_dir, {'Soll': make_df('Soll', 4, 'x')},
+                          prev=first)
+    assert second['version'] == 2
+    assert second['partitions']['Cate'] == first['partitions']['Cate']
+    assert second['partitions']['Soll']['version'] == 2
+    df = snapshot.read_snapshot(snapshot_dir, second)
+    assert len(df) == 7
+    assert list(df['plasmid'].astype(str))[-1] == 'pSollx3'
+    # readers of the previous version still see it
+    assert len(snapshot.read_snapshot(snapshot_dir, first)) == 5
+
+
+def test_remove_old_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, 'MIN_AGE', -1)
+    snapshot_dir = str(tmp_path)
+    manifests = [publish_labs(snapshot_dir, {'Cate': make_df('Cate', 2)})]
+    for i in range(3):
+        manifests.append(publish_labs(
+            snapshot_dir, {'Cate': make_df('Cate', 2, i)}, prev=manifests[-1]))
+    names = set(os.listdir(snapshot_dir))
+    # history and partition of the oldest of SNAPSHOT_KEEP + 1 versions
+    assert snapshot.HISTORY_NAME.format(1) not in names
+    assert snapshot.partition_paths(manifests[0])[0] not in names
+    for manifest in manifests[1:]:
+        assert snapshot.HISTORY_NAME.format(manifest['version']) in names
+        assert snapshot.partition_paths(manifest)[0] in names
+    snapshot.remove_old_snapshots(snapshot_dir, n_keep=1)
+    arrow_files = [i for i in os.listdir(snapshot_dir)
+                   if i.endswith('.arrow')]
+    assert arrow_files == snapshot.partition_paths(manifests[-1])
+
+
+def test_recent_unpublished_partition_kept(tmp_path):
+    snapshot_dir = str(tmp_path)
+    manifest = publish_labs(snapshot_dir, {'Cate': make_df('Cate', 2)})
+    part = snapshot.write_partition(snapshot_dir, 'Cate', make_df('Cate', 1),
+                                    prev=manifest['partitions']['Cate'])
+    snapshot.remove_old_snapshots(snapshot_dir)
+    assert part['path'] in os.listdir(snapshot_dir)